@@ -11,8 +11,30 @@ import sys
 import os
 import json
 import logging
-from logging.handlers import RotatingFileHandler
-import importlib
+
+from postprocessing.logging_pipeline import (
+    BatchRotatingFileHandler,
+    get_formatter,
+    start_log_pipeline,
+    stop_log_pipeline,
+)
+from postprocessing.processors import get_input_queue_name, get_queue_resources
+
+# Environment variable through which the consumer hands its configuration to the jobs
+SNAPSHOT_ENV = "POSTPROCESSING_CONFIG_SNAPSHOT"
+
+
+def get_file_version(config_file):
+    r"""
+    Version of a configuration file, changing whenever the file is modified
+    @param str config_file: path to the configuration file
+    @returns list: modification time (ns) and size of the file, or None if it cannot be read
+    """
+    try:
+        stat = os.stat(config_file)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
 
 
 class Configuration:
@@ -20,16 +42,30 @@ class Configuration:
     Read and process configuration file and provide an easy way to create a configured Client object
     """
 
-    def __init__(self, config_file):
-        try:
-            with open(config_file, "r") as cfg:
-                json_encoded = cfg.read()
-        except (PermissionError, FileNotFoundError, OSError) as e:
-            raise RuntimeError(f"Configuration file doesn't exist or is not readable: {config_file}") from e
-        config = json.loads(json_encoded)
+    def __init__(self, config_file, config=None, version=None):
+        r"""
+        @param str config_file: path to the configuration file
+        @param dict config: contents of the configuration file, read from the file if None
+        @param list version: version of the configuration file the contents were read from
+        """
+        if config is None:
+            try:
+                with open(config_file, "r") as cfg:
+                    json_encoded = cfg.read()
+                    stat = os.fstat(cfg.fileno())
+            except (PermissionError, FileNotFoundError, OSError) as e:
+                raise RuntimeError(f"Configuration file doesn't exist or is not readable: {config_file}") from e
+            config = json.loads(json_encoded)
+            version = [stat.st_mtime_ns, stat.st_size]
 
         # Keep a record of which config file we are using
         self.config_file = config_file
+        self.config_version = version
+        # contents of the file, and latest valid contents handed to the jobs
+        self._config = config
+        self._snapshot_config = config
+        self._snapshot_version = version
+        self._snapshot = None
         # ActiveMQ user creds
         self.amq_user = config["amq_user"]
         self.amq_pwd = config["amq_pwd"]
@@ -58,9 +94,18 @@ class Configuration:
         )
 
         self.heart_beat = config["heart_beat"]
+        # commands to pause, resume, cancel and retune the jobs, acknowledged on heart_beat (disabled if empty).
+        # Opt-in: the commands are not authenticated, any client allowed to publish on the topic runs them
+        self.control_topic = config.get("control_topic", "")
+        # messages of a paused instrument, and heavy messages while the node is under pressure, sent back to
+        # their queue and delivered again after this delay
+        self.defer_delay_sec = config.get("defer_delay_sec", 60.0)
         self.log_file = config["log_file"] if "log_file" in config else "post_processing.log"
         # log levels: DEBUG, INFO, WARNING, ERROR, CRITICAL
         self.log_level = getattr(logging, config.get("log_level", ""), logging.INFO)
+        # log file format ("text" or "json"), and records waiting to be written (0 to write them synchronously)
+        self.log_format = config.get("log_format", "text")
+        self.log_queue_size = config.get("log_queue_size", 10000)
         self.start_script = config["start_script"] if "start_script" in config else "python"
         self.task_script = config["task_script"] if "task_script" in config else "PostProcessAdmin.py"
         self.python_dir = (
@@ -81,6 +126,8 @@ class Configuration:
 
         self.task_script_queue_arg = config["task_script_queue_arg"] if "task_script_queue_arg" in config else None
         self.task_script_data_arg = config["task_script_data_arg"] if "task_script_data_arg" in config else None
+        # write the message payload to the standard input of the task script instead of the command line
+        self.task_payload_stdin = config.get("task_payload_stdin", False)
 
         self.exceptions = config["exceptions"] if "exceptions" in config else ["Error in logging framework"]
 
@@ -111,13 +158,12 @@ class Configuration:
             for p in self.processors:
                 toks = p.split(".")
                 if len(toks) == 2:
-                    # for instance, emulate `from oncat_processor import ONCatProcessor`
-                    processor_module = importlib.import_module(  # noqa: F841
-                        f"postprocessing.processors.{toks[0]}"
-                    )
+                    # resolved from the manifest of the processors, without importing them
                     try:
-                        processor_class = getattr(processor_module, toks[1])
-                        self.queues.append(processor_class.get_input_queue_name())
+                        queue = get_input_queue_name(p)
+                        # several processors may handle the same queue
+                        if queue not in self.queues:
+                            self.queues.append(queue)
                     except:  # noqa: E722
                         logging.error(
                             "Configuration: Error loading processor: %s",
@@ -128,6 +174,25 @@ class Configuration:
                         "Configuration: Processors can only be specified in the format module.Processor_class"
                     )
 
+        # Slots taken by the jobs of each queue, and maximum number of slots of each resource class,
+        # for the node ({"heavy": 4}) and for some instruments ({"SNAP": {"heavy": 1}, "HYS": {"light": 3}})
+        self.queue_slots = (
+            get_queue_resources(self.processors, config.get("queue_resources", {}))
+            if isinstance(self.processors, list)
+            else {}
+        )
+        self.slot_limits = config.get("slot_limits", {})
+        self.instrument_slot_limits = {
+            instrument.upper(): limits for instrument, limits in config.get("instrument_slot_limits", {}).items()
+        }
+
+        # Directory where the run metadata read from the event files is shared, none if empty
+        self.run_metadata_cache_dir = config.get("run_metadata_cache_dir", "")
+
+        # Timing spans of the tasks, attached to their COMPLETE/ERROR messages and written to trace_dir if set
+        self.tracing_enabled = config.get("tracing_enabled", False)
+        self.trace_dir = config.get("trace_dir", "")
+
         # Job memory monitoring
         self.system_mem_limit_perc = config.get("system_mem_limit_perc", 70.0)
         self.mem_check_interval_sec = config.get("mem_check_interval_sec", 0.2)
@@ -135,6 +200,76 @@ class Configuration:
         # Job runtime monitoring
         self.task_time_limit_minutes = config.get("task_time_limit_minutes", 60.0)
 
+        # Heavy jobs held while the pressure stall information (10 s averages, in %) of the node is above
+        # the thresholds, until all of them are below psi_recovery_ratio times their threshold
+        self.psi_enabled = config.get("psi_enabled", False)
+        self.psi_thresholds = config.get("psi_thresholds", {"cpu": 80.0, "memory": 10.0, "io": 30.0})
+        self.psi_recovery_ratio = config.get("psi_recovery_ratio", 0.5)
+
+        # Data files of the heavy jobs waiting for a free slot copied to local scratch, the least recently
+        # used copies removed to stay within scratch_budget_gb
+        self.scratch_staging = config.get("scratch_staging", False)
+        self.scratch_dir = config.get("scratch_dir", "/tmp/postprocessing_scratch")
+        self.scratch_budget_gb = config.get("scratch_budget_gb", 100.0)
+        self.scratch_copy_workers = config.get("scratch_copy_workers", 2)
+        self.scratch_copy_mb_per_sec = config.get("scratch_copy_mb_per_sec", 200.0)
+
+        # Data files of the heavy jobs waiting for a free slot read ahead into the page cache, unless they are
+        # larger than prewarm_memory_fraction of the available memory (ignored when scratch_staging is set)
+        self.page_cache_prewarm = config.get("page_cache_prewarm", False)
+        self.prewarm_max_mb = config.get("prewarm_max_mb", 8192.0)
+        self.prewarm_mb_per_sec = config.get("prewarm_mb_per_sec", 200.0)
+        self.prewarm_memory_fraction = config.get("prewarm_memory_fraction", 0.5)
+
+        # Jobs pinned to a share of the CPUs of the node, leased through files in cpu_lease_dir
+        self.cpu_pinning = config.get("cpu_pinning", False)
+        self.cpu_lease_dir = config.get("cpu_lease_dir", "/tmp/postprocessing_cpu_leases")
+
+        # Reductions terminated for exceeding the memory limit are sent to the high-memory queue, this many times
+        self.himem_max_reroutes = config.get("himem_max_reroutes", 1)
+
+        # Metrics endpoints: HTTP port (disabled if None, any free port if 0) and Unix socket (disabled if empty)
+        self.metrics_port = config.get("metrics_port", None)
+        self.metrics_host = config.get("metrics_host", "127.0.0.1")
+        self.metrics_socket = config.get("metrics_socket", "")
+
+        # Pre-warmed interpreters (zygotes) for reduction scripts, one per conda environment
+        self.zygote_enabled = config.get("zygote_enabled", False)
+        self.zygote_socket_dir = config.get("zygote_socket_dir", "/tmp")
+        self.zygote_preload = config.get("zygote_preload", ["mantid.simpleapi"])
+        self.zygote_idle_timeout_sec = config.get("zygote_idle_timeout_sec", 3600.0)
+
+    def snapshot(self):
+        r"""
+        Serialize the configuration for the jobs, which then skip reading and checking the file.
+        The file is read again if it changed, so that a new configuration is used by the next job.
+        @returns str: JSON snapshot of the configuration, see `Configuration.from_snapshot`
+        """
+        version = get_file_version(self.config_file)
+        if version is not None and version != self._snapshot_version:
+            try:
+                # check that the jobs will be able to use the new configuration
+                self._snapshot_config = Configuration(self.config_file)._config
+            except Exception as e:
+                logging.error("Invalid configuration %s, the jobs keep the previous one: %s", self.config_file, e)
+            self._snapshot_version = version
+            self._snapshot = None
+        if self._snapshot is None:
+            self._snapshot = json.dumps(
+                {"config_file": self.config_file, "version": self._snapshot_version, "config": self._snapshot_config}
+            )
+        return self._snapshot
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        r"""
+        Configuration from a snapshot made by `Configuration.snapshot`, without reading the file
+        @param str snapshot: JSON snapshot
+        @returns Configuration: the configuration
+        """
+        contents = json.loads(snapshot)
+        return cls(contents["config_file"], config=contents["config"], version=contents["version"])
+
     def log_configuration(self, logger=logging):
         """
         Log the current configuration
@@ -154,46 +289,59 @@ class Configuration:
 class StreamToLogger:
     r"""File-like stream object that redirects writes to a Logger instance."""
 
-    def __init__(self, logger, log_level=logging.INFO):
+    def __init__(self, logger, log_level=logging.INFO, echo=True):
         r"""
         @brief duck-typing for a file-stream object that redirects to a Logger instance
         @param Logger logger: instance of python standard Logger
         @param int log_level: one of DEBUG, INFO, WARNING, ERROR, CRITICAL
+        @param bool echo: also write the messages to stdout
         """
         self.logger = logger
         self.log_level = log_level
+        self.echo = echo
         self.linebuf = ""
 
     def write(self, buf):
         """
         Write a message to stdout so we can see it when running interactively
         """
-        sys.stdout.write(buf)
+        if self.echo:
+            sys.stdout.write(buf)
         for line in buf.rstrip().splitlines():
             self.logger.log(self.log_level, line.rstrip())
 
+    def flush(self):
+        pass
+
 
-def initialize_logging(log_file, level=logging.INFO, preemptive_cleanup=False):
+def initialize_logging(log_file, level=logging.INFO, preemptive_cleanup=False, log_format="text", queue_size=0):
     r"""
     @brief Set the default log level and the file where to append log messages
 
-    @details: also pipe sys.stderr to the STDERR channel of the root logger
+    @details: also pipe sys.stderr to the STDERR channel of the root logger. With a queue, the records
+    are written in batches by a background thread (see `postprocessing.logging_pipeline`).
 
     @param str log_file: absolute path to the file logging the messages
     @param int level: one of DEBUG, INFO, WARNING, ERROR, CRITICAL
     @param bool preemptive_cleanup: remove all existing handlers of the root looger before initializing
+    @param str log_format: "text" or "json"
+    @param int queue_size: maximum number of records waiting to be written, 0 to write them synchronously
     """
-    # logging.basicConfig does nothing if the root logger already has handlers
+    # like logging.basicConfig, do nothing if the root logger already has handlers
     if preemptive_cleanup:
-        for handler in logging.root.handlers:
+        stop_log_pipeline()
+        for handler in list(logging.root.handlers):
             handler.close()
             logging.root.removeHandler(handler)
 
-    logging.basicConfig(
-        handlers=[RotatingFileHandler(log_file, maxBytes=10_000_000, backupCount=100)],
-        level=level,
-        format="%(asctime)s %(levelname)s/%(process)d %(message)s",
-    )
+    if not logging.root.handlers:
+        file_handler = BatchRotatingFileHandler(log_file, maxBytes=10_000_000, backupCount=100)
+        file_handler.setFormatter(get_formatter(log_format))
+        if queue_size > 0:
+            logging.root.addHandler(start_log_pipeline(file_handler, queue_size))
+        else:
+            logging.root.addHandler(file_handler)
+        logging.root.setLevel(level)
 
     ### add a level for subprocess logging
     # credit: https://stackoverflow.com/a/35804945
@@ -214,7 +362,8 @@ def initialize_logging(log_file, level=logging.INFO, preemptive_cleanup=False):
 
     ###   redirect stderr
     stderr_logger = logging.getLogger("STDERR")
-    sl = StreamToLogger(stderr_logger, logging.ERROR)
+    # the messages are only echoed when running interactively
+    sl = StreamToLogger(stderr_logger, logging.ERROR, echo=sys.stdout.isatty())
     sys.stderr = sl
 
 
@@ -228,7 +377,10 @@ def read_configuration(config_file=None, defaults=[CONFIG_FILE, CONFIG_FILE_ALTE
     Returns a new configuration object for a given configuration file, and initializes the basic configuration
     of all log messages.
 
-    @details: also initialize the logging (see `initialize_logging`)
+    @details: also initialize the logging (see `initialize_logging`). When no configuration file is given and
+    the consumer passed a snapshot of its configuration in the environment (see `Configuration.snapshot`),
+    the snapshot is used instead of the default configuration files. The snapshot is removed from the
+    environment, so that the reduction scripts started by the job do not see the secrets it holds.
 
     @param str config_file: absolute path to custom configuration file to process
     @param list defaults: configuration files to be used when no custom configuration is provided
@@ -237,17 +389,32 @@ def read_configuration(config_file=None, defaults=[CONFIG_FILE, CONFIG_FILE_ALTE
     @returns Configuration: data structure representing the configuration file just read
     """
 
-    if config_file is None:
-        for config_default in defaults:
-            if os.access(config_default, os.R_OK):
-                config_file = config_default
-                break
-        else:
-            raise RuntimeError(f"Default configuration file(s) do not exist, or unreadable: {defaults}")
-
-    configuration = Configuration(config_file)
+    configuration = None
+    # jobs started by the consumer are given its configuration, with the broker password and the ONCat token
+    snapshot = os.environ.pop(SNAPSHOT_ENV, "")
+    if config_file is None and snapshot:
+        try:
+            configuration = Configuration.from_snapshot(snapshot)
+        except Exception:  # noqa: BLE001
+            configuration = None  # read the file instead
+
+    if configuration is None:
+        if config_file is None:
+            for config_default in defaults:
+                if os.access(config_default, os.R_OK):
+                    config_file = config_default
+                    break
+            else:
+                raise RuntimeError(f"Default configuration file(s) do not exist, or unreadable: {defaults}")
+
+        configuration = Configuration(config_file)
     if log_file:
         configuration.log_file = str(log_file)
-    initialize_logging(configuration.log_file, configuration.log_level)
+    initialize_logging(
+        configuration.log_file,
+        configuration.log_level,
+        log_format=configuration.log_format,
+        queue_size=configuration.log_queue_size,
+    )
 
     return configuration
@@ -6,6 +6,8 @@ The original code for this class was take from https://github.com/mantidproject/
 @copyright: 2014 Oak Ridge National Laboratory
 """
 
+import collections
+import concurrent.futures
 import json
 import logging
 import time
@@ -14,20 +16,93 @@ import sys
 import socket
 import os
 import signal
+import threading
+import psutil
 import stomp
 
+from postprocessing.Configuration import SNAPSHOT_ENV, Configuration, get_file_version
+from postprocessing.metrics import Metrics, start_metrics_servers
+from postprocessing.page_cache import PageCacheWarmer
+from postprocessing.pressure import PressureGate
+from postprocessing.scratch import ScratchStager
+from postprocessing.processors import DEFAULT_RESOURCE
+from postprocessing.processors.job_handling import get_total_memory_usage, terminate_or_kill_process_tree
+
 HEARTBEAT_DELAY = 30
+# Time between checks of the configuration file for changes
+CONFIG_CHECK_DELAY = 5
+# Settings that cannot change without restarting the consumer
+RESTART_SETTINGS = [
+    "brokers",
+    "amq_user",
+    "amq_pwd",
+    "log_file",
+    "metrics_port",
+    "metrics_host",
+    "metrics_socket",
+    "scratch_dir",
+    "scratch_copy_workers",
+]
+# Delays before reconnecting to a broker, doubled after each failed attempt (seconds)
+RECONNECT_DELAY = 1.0
+MAX_RECONNECT_DELAY = 60.0
+# Period over which the job throughput reported in the heartbeats is computed (seconds)
+THROUGHPUT_WINDOW = 900
+# Header of the delay before the broker delivers a message (milliseconds), needs schedulerSupport="true"
+SCHEDULED_DELAY_HEADER = "AMQ_SCHEDULED_DELAY"
+# Headers set by the broker on delivery, not sent again with a deferred message
+DELIVERY_HEADERS = {"destination", "message-id", "subscription", "ack", "redelivered", "timestamp", "content-length"}
+
+
+def describe_metrics(metrics):
+    """
+    Declare the metrics recorded by the consumer
+    @param Metrics metrics: metrics registry
+    """
+    metrics.describe("postprocessing_messages_total", "counter", "Messages received, by outcome")
+    metrics.describe("postprocessing_ack_latency_seconds", "summary", "Time from receiving a message to its ack/nack")
+    metrics.describe("postprocessing_dispatch_latency_seconds", "summary", "Time to start the job of a message")
+    metrics.describe("postprocessing_job_wall_time_seconds", "summary", "Wall time of the jobs")
+    metrics.describe("postprocessing_job_peak_memory_bytes", "summary", "Peak memory of the jobs (sampled)")
+    metrics.describe("postprocessing_jobs_running", "gauge", "Jobs running in the local scheduler")
+    metrics.describe("postprocessing_jobs_waiting", "gauge", "Accepted messages waiting for a free slot")
+    metrics.describe("postprocessing_broker_send_latency_seconds", "summary", "Time to send a message to the broker")
+    metrics.describe("postprocessing_broker_connected", "gauge", "Whether the consumer is connected to a broker")
+    metrics.describe("postprocessing_control_commands_total", "counter", "Commands received on the control topic")
+    metrics.describe("postprocessing_pressure_throttled", "gauge", "Whether heavy jobs are held for the node pressure")
+    metrics.describe("postprocessing_scratch_staging_total", "counter", "Data files of waiting jobs staged to scratch")
+    metrics.describe("postprocessing_page_cache_prewarm_total", "counter", "Data files of waiting jobs read ahead")
+    metrics.describe("postprocessing_config_reloads_total", "counter", "Reloads of the configuration file, by outcome")
 
 
 class Listener(stomp.ConnectionListener):
-    def __init__(self, config, connection):
+    def __init__(self, config, connection, metrics=None):
         super().__init__()
         self.config = config
         self.conn = connection
         self.procList = []
         self.instrument_jobs = {}
+        self.metrics = metrics if metrics is not None else Metrics()
+        # process -> [queue, instrument, start time, peak memory, {"instrument", "run_number"} of the message,
+        #             (resource class, slot weight)]
+        self.job_info = {}
+        # set by the commands of the control topic: instruments and queues whose messages are deferred,
+        # and maximum number of jobs of some instruments, instead of jobs_per_instrument
+        self.paused_instruments = set()
+        self.paused_queues = set()
+        self.instrument_limits = {}
+        # admission of the heavy jobs according to the pressure stall information of the node
+        self.pressure = PressureGate()
+        # copies of the data files on local scratch, and read-ahead of the data files, created when first needed
+        self.stager = None
+        self.warmer = None
+        # accepted messages waiting for a free slot, and end times of the recent jobs
+        self.waiting_jobs = 0
+        self.finished_jobs = collections.deque()
+        # the links to the brokers share the jobs and their limits
+        self.lock = threading.RLock()
 
-    def on_message(self, frame):
+    def on_message(self, frame, conn=None):
         """
         Consume an AMQ message.
 
@@ -50,36 +125,46 @@ class Listener(stomp.ConnectionListener):
           </redeliveryPlugin>
         </plugins>
 
-        @param client: Stomp connection object
         @param frame: StompFrame object
+        @param conn: connection the message was received on, the connection of the listener if None
+        """
+        received = time.monotonic()
+        # one message at a time: a link waiting for a free slot holds up the other links
+        with self.lock:
+            self.dispatch(frame, conn or self.conn, received)
+
+    def dispatch(self, frame, conn, received):
+        """
+        Accept, defer or reject a message, and start its job
+        @param frame: StompFrame object
+        @param conn: connection the message was received on
+        @param received: time.monotonic() when the message was received
         """
+        # the same configuration for the whole message, even if it is reloaded meanwhile
+        config = self.config
         try:
             headers = frame.headers
             destination = headers["destination"]
             data = frame.body
             data_dict = json.loads(data)
             # If we received a ping request, just ack
-            if self.config.heartbeat_ping in destination:
-                self.ack_ping(data_dict)
-                self.conn.ack(frame.headers["message-id"], frame.headers["subscription"])
+            if config.heartbeat_ping in destination:
+                self.ack_ping(data_dict, conn)
+                conn.ack(frame.headers["message-id"], frame.headers["subscription"])
+                self.metrics.inc("postprocessing_messages_total", queue=destination, instrument="", outcome="ping")
                 return
             logging.info("Received %s: %s", destination, data)
+            run = {
+                "instrument": str(data_dict.get("instrument", "")).upper(),
+                "run_number": str(data_dict.get("run_number", "")),
+            }
+            resource = getattr(config, "queue_slots", {}).get(destination, DEFAULT_RESOURCE)
             instrument = None
-            if self.config.jobs_per_instrument > 0 and "instrument" in data_dict:
+            if (config.jobs_per_instrument > 0 or self.instrument_limits) and "instrument" in data_dict:
                 instrument = data_dict["instrument"].upper()
-                if instrument in self.instrument_jobs:
-                    self.update_processes()
-                    if len(self.instrument_jobs[instrument]) >= self.config.jobs_per_instrument:
-                        self.conn.nack(frame.headers["message-id"], frame.headers["subscription"])
-                        logging.error(
-                            "Too many jobs for %s on %s: rejecting",
-                            instrument,
-                            os.getpid(),
-                        )
-                        return
-                else:
-                    self.instrument_jobs[instrument] = []
-            self.conn.ack(frame.headers["message-id"], frame.headers["subscription"])
+                self.instrument_jobs.setdefault(instrument, [])
+            if not self.admit(frame, conn, received, config, run, instrument, resource):
+                return
         except:  # noqa: E722
             logging.error(sys.exc_info()[1])
             # Raising an exception here may result in an ActiveMQ result being sent.
@@ -87,31 +172,62 @@ class Listener(stomp.ConnectionListener):
             raise RuntimeError("Error processing incoming message: contact post-processing expert")
 
         try:
+            staged = self.prepare_input(config, resource, data_dict)
+            if staged is not None:
+                data_dict["staged_data_file"] = staged
+            if staged is not None or "prewarmed_bytes" in data_dict:
+                data = json.dumps(data_dict)
+
             # Put together the command to execute, including any optional arguments
-            post_proc_script = os.path.join(self.config.python_dir, self.config.task_script)
-            command_args = [self.config.start_script, post_proc_script]
+            post_proc_script = os.path.join(config.python_dir, config.task_script)
+            command_args = [config.start_script, post_proc_script]
 
             # Format the queue name argument
-            if self.config.task_script_queue_arg is not None:
-                command_args.append(self.config.task_script_queue_arg)
+            if config.task_script_queue_arg is not None:
+                command_args.append(config.task_script_queue_arg)
             command_args.append(destination)
 
-            # Format the data argument
-            if self.config.task_script_data_arg is not None:
-                command_args.append(self.config.task_script_data_arg)
-            command_args.append(str(data).replace(" ", ""))
+            # Format the data argument: the payload is either written unchanged to the standard input
+            # of the job, or passed on the command line
+            use_stdin = config.task_script_data_arg is not None and getattr(config, "task_payload_stdin", False)
+            if config.task_script_data_arg is not None:
+                command_args.append(config.task_script_data_arg)
+            if use_stdin:
+                command_args.append("-")
+            else:
+                command_args.append(str(data).replace(" ", ""))
 
             logging.warning("Command: %s", str(command_args))
 
+            # Hand the configuration to the job, so it does not have to look for and read the file
+            env = dict(os.environ)
+            try:
+                env[SNAPSHOT_ENV] = config.snapshot()
+            except:  # noqa: E722
+                logging.error("Could not snapshot the configuration: %s", sys.exc_info()[1])
+
             ### open and log subprocess
             proc = subprocess.Popen(
-                command_args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+                command_args,
+                stdin=subprocess.PIPE if use_stdin else None,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                env=env,
             )  ### start subprocess
+            if use_stdin:
+                payload = data.encode() if isinstance(data, str) else data
+                threading.Thread(target=feed_input, args=(proc.stdin, payload), daemon=True).start()
+            self.job_info[proc] = [destination, instrument or "", time.monotonic(), 0.0, run, resource, staged]
+            self.metrics.observe(
+                "postprocessing_dispatch_latency_seconds",
+                time.monotonic() - received,
+                queue=destination,
+                instrument=instrument or "",
+            )
 
-            for line in proc.stdout.readlines():  ### log with custom level
-                logging.subprocess(line.decode().strip())
-
-            logging.warning("end")
+            # relay the output of the job in the background: the next messages are dispatched while
+            # the job runs, up to max_procs jobs at once
+            threading.Thread(target=relay_output, args=(proc.stdout,), name=f"job-{proc.pid}", daemon=True).start()
             self.procList.append(proc)
             if instrument is not None:
                 self.instrument_jobs[instrument].append(proc)
@@ -123,9 +239,17 @@ class Listener(stomp.ConnectionListener):
 
             # If we have reached the max number of processes, block until we have
             # at least on free slot
-            while len(self.procList) > self.config.max_procs:
-                time.sleep(1.0)
-                self.update_processes()
+            if max_procs_reached:
+                self.waiting_jobs += 1
+                self.metrics.set("postprocessing_jobs_waiting", self.waiting_jobs)
+            try:
+                while len(self.procList) > self.config.max_procs:
+                    time.sleep(1.0)
+                    self.update_processes()
+            finally:
+                if max_procs_reached:
+                    self.waiting_jobs -= 1
+                    self.metrics.set("postprocessing_jobs_waiting", self.waiting_jobs)
 
             if max_procs_reached:
                 logging.info("Resuming. Number of sub-processes: %s", len(self.procList))
@@ -136,34 +260,501 @@ class Listener(stomp.ConnectionListener):
             # We therefore pick a message that will mean someone to the users.
             raise RuntimeError("Error processing message: contact post-processing expert")
 
+    def admit(self, frame, conn, received, config, run, instrument, resource):
+        """
+        Ack the message of a job that may start. Otherwise, reject the message when its instrument has
+        too many jobs running or when its job would exceed the slot limits, or defer it while its
+        instrument is paused or, for a heavy job, while the node is under pressure.
+        @param frame: StompFrame object
+        @param conn: connection the message was received on
+        @param received: time.monotonic() when the message was received
+        @param config: configuration
+        @param dict run: "instrument" and "run_number" of the message
+        @param instrument: instrument whose number of jobs is limited, None if not limited
+        @param tuple resource: resource class and slot weight of the job
+        @returns bool: whether the job may start
+        """
+        destination = frame.headers["destination"]
+        if destination in self.paused_queues or run["instrument"] in self.paused_instruments:
+            # a message of a paused queue received before the queue was unsubscribed, or of a paused instrument
+            self.defer(frame, conn, config)
+            self.record_message(destination, run["instrument"], "deferred", received)
+            logging.warning(
+                "Paused: %s for %s sent back, delivered again in %s s",
+                destination,
+                run["instrument"],
+                config.defer_delay_sec,
+            )
+            return False
+        if self.exceeded_instrument_limit(config, instrument):
+            conn.nack(frame.headers["message-id"], frame.headers["subscription"])
+            self.record_message(destination, instrument, "rejected", received)
+            logging.error(
+                "Too many jobs for %s on %s: rejecting",
+                instrument,
+                os.getpid(),
+            )
+            return False
+        exceeded = self.exceeded_slot_limit(config, resource, run["instrument"])
+        if exceeded is not None:
+            conn.nack(frame.headers["message-id"], frame.headers["subscription"])
+            self.record_message(destination, run["instrument"], "rejected", received)
+            logging.error("No free %s slot for %s: rejecting %s", exceeded, run["instrument"], destination)
+            return False
+        if resource[0] == "heavy" and self.under_pressure(config):
+            # a heavy message received before its queue was unsubscribed
+            self.defer(frame, conn, config)
+            self.record_message(destination, run["instrument"], "throttled", received)
+            logging.warning(
+                "Node under pressure %s: %s sent back, delivered again in %s s",
+                self.pressure.averages,
+                destination,
+                config.defer_delay_sec,
+            )
+            return False
+        conn.ack(frame.headers["message-id"], frame.headers["subscription"])
+        self.record_message(destination, instrument, "accepted", received)
+        return True
+
+    def defer(self, frame, conn, config):
+        """
+        Send a message back to its queue, to be delivered again after defer_delay_sec by the scheduler of the
+        broker, then ack it. A rejected message would go to the dead letter queue after a few redeliveries,
+        and a message kept by the agent would be lost with it. The message is sent before it is acked, so
+        that it is delivered twice rather than lost if the agent stops in between.
+        @param frame: StompFrame object
+        @param conn: connection the message was received on
+        @param config: configuration
+        """
+        headers = {name: value for name, value in frame.headers.items() if name not in DELIVERY_HEADERS}
+        headers["persistent"] = "true"
+        headers[SCHEDULED_DELAY_HEADER] = str(int(config.defer_delay_sec * 1000))
+        conn.send(frame.headers["destination"], frame.body, headers=headers)
+        conn.ack(frame.headers["message-id"], frame.headers["subscription"])
+
+    def exceeded_instrument_limit(self, config, instrument):
+        """
+        @param config: configuration
+        @param instrument: instrument whose number of jobs is limited, None if not limited
+        @returns bool: whether the instrument has its maximum number of jobs running
+        """
+        if instrument is None or not self.instrument_jobs.get(instrument):
+            return False
+        self.update_processes()
+        limit = self.instrument_limits.get(instrument, config.jobs_per_instrument)
+        return 0 < limit <= len(self.instrument_jobs[instrument])
+
+    def subscribed_queues(self, config):
+        """
+        @param config: configuration
+        @returns list: queues to subscribe to, leaving on the broker the paused queues, the queues whose
+                       jobs have no free slot on the node, and the heavy queues while the node is under
+                       pressure, for the other nodes
+        """
+        queue_slots = getattr(config, "queue_slots", {})
+        queues = []
+        for q in config.queues:
+            resource = queue_slots.get(q, DEFAULT_RESOURCE)
+            if q in self.paused_queues or self.exceeded_slot_limit(config, resource, "") is not None:
+                continue
+            if resource[0] == "heavy" and self.under_pressure(config):
+                continue
+            queues.append(q)
+        return queues
+
+    def record_message(self, destination, instrument, outcome, received):
+        """
+        Record the metrics of a message that was just acked or nacked
+        @param destination: queue the message was received on
+        @param instrument: instrument of the message, or None
+        @param outcome: "accepted" or "rejected"
+        @param received: time.monotonic() when the message was received
+        """
+        labels = {"queue": destination, "instrument": instrument or ""}
+        self.metrics.observe("postprocessing_ack_latency_seconds", time.monotonic() - received, **labels)
+        self.metrics.inc("postprocessing_messages_total", outcome=outcome, **labels)
+
+    def used_slots(self, resource_class, instrument=None):
+        """
+        @param resource_class: resource class of the slots
+        @param instrument: count the jobs of this instrument only, all the jobs if None
+        @returns float: slots of the resource class taken by the jobs running
+        """
+        return sum(
+            info[5][1]
+            for proc, info in list(self.job_info.items())
+            if info[5][0] == resource_class and instrument in (None, info[4]["instrument"]) and proc.poll() is None
+        )
+
+    def exceeded_slot_limit(self, config, resource, instrument):
+        """
+        Check the slots that a new job would take against the limits of the node and of the instrument.
+        A job may always start when no other job of its resource class is running, even if it weighs
+        more than the limit.
+        @param config: configuration
+        @param resource: (resource class, slot weight) of the job
+        @param instrument: instrument of the job
+        @returns str: the limit the job would exceed, None if it may start
+        """
+        resource_class, weight = resource
+        limits = [
+            (resource_class, None, getattr(config, "slot_limits", {})),
+            (
+                f"{resource_class} {instrument}",
+                instrument,
+                getattr(config, "instrument_slot_limits", {}).get(instrument),
+            ),
+        ]
+        for name, scope, scope_limits in limits:
+            if not scope_limits or resource_class not in scope_limits:
+                continue
+            used = self.used_slots(resource_class, scope)
+            if used > 0 and used + weight > scope_limits[resource_class]:
+                return name
+        return None
+
+    def prepare_input(self, config, resource, data_dict):
+        """
+        Copy the data file of a heavy job to local scratch, or read it ahead into the page cache,
+        while the job waits for a free slot. The bytes read ahead are added to the payload as "prewarmed_bytes".
+        @param config: configuration
+        @param tuple resource: resource class and slot weight of the job
+        @param dict data_dict: message payload
+        @returns str: path of the copy, None if the job reads the shared file
+        """
+        staging = getattr(config, "scratch_staging", False)
+        prewarming = getattr(config, "page_cache_prewarm", False)
+        if not (staging or prewarming) or resource[0] != "heavy" or "data_file" not in data_dict:
+            return None
+        self.update_processes()
+        if len(self.procList) < self.config.max_procs:
+            # the job starts right away: reading the file twice would only delay it
+            return None
+        data_file = str(data_dict["data_file"])
+        if staging:
+            if self.stager is None:
+                self.stager = ScratchStager(config.scratch_dir, 0, config.scratch_copy_workers)
+            self.stager.budget_bytes = int(config.scratch_budget_gb * 1024**3)
+            self.stager.throttle.bandwidth_bytes = int(config.scratch_copy_mb_per_sec * 1024**2)
+            pending = self.stager.stage(data_file)
+        else:
+            if self.warmer is None:
+                self.warmer = PageCacheWarmer(0)
+            self.warmer.max_bytes = int(config.prewarm_max_mb * 1024**2)
+            self.warmer.throttle.bandwidth_bytes = int(config.prewarm_mb_per_sec * 1024**2)
+            self.warmer.memory_fraction = config.prewarm_memory_fraction
+            pending, cancel = self.warmer.submit(data_file)
+
+        self.waiting_jobs += 1
+        self.metrics.set("postprocessing_jobs_waiting", self.waiting_jobs)
+        try:
+            while len(self.procList) >= self.config.max_procs:
+                time.sleep(1.0)
+                self.update_processes()
+        finally:
+            self.waiting_jobs -= 1
+            self.metrics.set("postprocessing_jobs_waiting", self.waiting_jobs)
+
+        if not staging:
+            # what was not read ahead yet will be read by the job
+            cancel.set()
+            concurrent.futures.wait([pending], timeout=1.0)
+            outcome = "not_ready"
+            if pending.done() and pending.exception() is not None:
+                logging.warning("Could not prewarm %s: %s", data_file, pending.exception())
+                outcome = "error"
+            elif pending.done():
+                data_dict["prewarmed_bytes"] = pending.result()
+                outcome = "prewarmed"
+            self.metrics.inc("postprocessing_page_cache_prewarm_total", outcome=outcome)
+            return None
+        staged = self.stager.acquire(pending)
+        outcome = "staged" if staged is not None else "not_ready"
+        if staged is None and pending.done() and pending.exception() is not None:
+            logging.warning("Could not stage %s: %s", data_file, pending.exception())
+            outcome = "error"
+        self.metrics.inc("postprocessing_scratch_staging_total", outcome=outcome)
+        return staged
+
+    def under_pressure(self, config):
+        """
+        @param config: configuration
+        @returns bool: whether the node stalls on a resource, and should not start heavy jobs
+        """
+        if not getattr(config, "psi_enabled", False):
+            return False
+        closed = self.pressure.is_closed(config.psi_thresholds, config.psi_recovery_ratio)
+        self.metrics.set("postprocessing_pressure_throttled", int(closed))
+        return closed
+
     def update_processes(self):
         """
         Go through finished processed and process any log that came
         out of them.
         """
-        for i in self.procList:
+        for i in list(self.procList):
+            info = self.job_info.get(i)
             if i.poll() is not None:
                 for instrument in self.instrument_jobs:
                     if i in self.instrument_jobs[instrument]:
                         self.instrument_jobs[instrument].remove(i)
                 self.procList.remove(i)
+                self.finished_jobs.append(time.monotonic())
+                if info is not None:
+                    del self.job_info[i]
+                    queue, instrument, start, peak_memory = info[:4]
+                    if info[6] is not None:
+                        self.stager.release(info[6])
+                    labels = {"queue": queue, "instrument": instrument}
+                    self.metrics.observe("postprocessing_job_wall_time_seconds", time.monotonic() - start, **labels)
+                    self.metrics.observe("postprocessing_job_peak_memory_bytes", peak_memory, **labels)
+            elif info is not None:
+                try:
+                    info[3] = max(info[3], get_total_memory_usage(psutil.Process(i.pid)))
+                except psutil.Error:
+                    pass
+        while self.finished_jobs and time.monotonic() - self.finished_jobs[0] > THROUGHPUT_WINDOW:
+            self.finished_jobs.popleft()
+        self.metrics.set("postprocessing_jobs_running", len(self.procList))
+
+    def sample(self):
+        """
+        Sample the jobs from the main loop, so that their end, their memory and the number of jobs
+        running are recorded while no message arrives. Skipped while a message is being dispatched,
+        since the dispatch samples them itself.
+        @returns bool: whether the jobs were sampled
+        """
+        if not self.lock.acquire(blocking=False):
+            return False
+        try:
+            self.update_processes()
+        finally:
+            self.lock.release()
+        return True
+
+    def load_info(self):
+        """
+        Summarize the load of this node for the heartbeats, from the listener bookkeeping.
+        This may be called from another thread: it only reads the bookkeeping.
+        @returns dict: jobs running per instrument, free slots, memory headroom, load average and throughput
+        """
+        # a process may have finished since the last message: poll instead of trusting the lists
+        running = sum(1 for proc in list(self.procList) if proc.poll() is None)
+        instruments = {}
+        for instrument, procs in list(self.instrument_jobs.items()):
+            count = sum(1 for proc in list(procs) if proc.poll() is None)
+            if count:
+                instruments[instrument] = count
+        now = time.monotonic()
+        finished = sum(1 for end in list(self.finished_jobs) if now - end <= THROUGHPUT_WINDOW)
+        slots = {}
+        for proc, info in list(self.job_info.items()):
+            if proc.poll() is None:
+                slots[info[5][0]] = slots.get(info[5][0], 0.0) + info[5][1]
+
+        memory = psutil.virtual_memory()
+        # memory that can still be used before reaching the system memory limit of the jobs
+        headroom = memory.total * self.config.system_mem_limit_perc / 100.0 - (memory.total - memory.available)
+        return {
+            "jobs_running": running,
+            "jobs_waiting": self.waiting_jobs,
+            "jobs_per_instrument": instruments,
+            "slots_used": slots,
+            "pressure_throttled": self.pressure.closed,
+            "max_procs": self.config.max_procs,
+            "free_slots": max(self.config.max_procs - running, 0),
+            "memory_available_mb": round(memory.available / 1024**2),
+            "memory_headroom_mb": round(max(headroom, 0) / 1024**2),
+            "load_average": [round(value, 2) for value in os.getloadavg()],
+            "jobs_finished": finished,
+            "throughput_window_sec": THROUGHPUT_WINDOW,
+        }
 
-    def ack_ping(self, data):
+    def ack_ping(self, data, conn=None):
         """
         Send an ACK message in response to a ping
         @param data: data that was received with the ping request
+        @param conn: connection to reply on, the connection of the listener if None
         """
         if "reply_to" in data:
-            heartbeat(self.conn, data["reply_to"], data)
+            try:
+                data["load"] = self.load_info()
+            except:  # noqa: E722
+                logging.error("Could not compute the load: %s", sys.exc_info()[1])
+            heartbeat(conn or self.conn, data["reply_to"], data, metrics=self.metrics)
         else:
             logging.error("Incomplete ping request %s", str(data))
 
+    def control(self, command):
+        """
+        Run a command of the control topic. Changes made to the limits last until the
+        configuration is reloaded.
+        @param dict command: name of the command in "command", and its arguments:
+            - pause / resume: "instrument" and/or "queue" whose messages are deferred
+            - cancel: terminate the jobs of "run_number", of "instrument" if given
+            - set_limits: "max_procs", "jobs_per_instrument", and "instrument_limits" mapping
+              instruments to their own maximum number of jobs (null to remove the limit)
+            - dump: list the jobs running
+        @returns dict: result of the command
+        """
+        name = command.get("command")
+        if name in ("pause", "resume"):
+            targets = []
+            if "instrument" in command:
+                targets.append((self.paused_instruments, str(command["instrument"]).upper()))
+            if "queue" in command:
+                targets.append((self.paused_queues, command["queue"]))
+            if not targets:
+                raise ValueError(f"{name}: expected an instrument or a queue")
+            for paused, target in targets:
+                if name == "pause":
+                    paused.add(target)
+                else:
+                    paused.discard(target)
+            return self.control_state()
+        if name == "cancel":
+            if "run_number" not in command:
+                raise ValueError("cancel: expected a run number")
+            run_number = str(command["run_number"])
+            instrument = str(command.get("instrument", "")).upper()
+            cancelled = []
+            for proc, info in list(self.job_info.items()):
+                run = info[4]
+                if run["run_number"] == run_number and instrument in ("", run["instrument"]) and proc.poll() is None:
+                    logging.warning("Cancelling the job of %s run %s: %s", run["instrument"], run_number, proc.pid)
+                    terminate_or_kill_process_tree(proc.pid)
+                    cancelled.append(proc.pid)
+            return {"cancelled": cancelled}
+        if name == "set_limits":
+            # attributes of the configuration: a message being dispatched sees them immediately
+            if "max_procs" in command:
+                self.config.max_procs = int(command["max_procs"])
+            if "jobs_per_instrument" in command:
+                self.config.jobs_per_instrument = int(command["jobs_per_instrument"])
+            for instrument, limit in command.get("instrument_limits", {}).items():
+                if limit is None:
+                    self.instrument_limits.pop(instrument.upper(), None)
+                else:
+                    self.instrument_limits[instrument.upper()] = int(limit)
+            return self.control_state()
+        if name == "dump":
+            now = time.monotonic()
+            jobs = [
+                {
+                    "pid": proc.pid,
+                    "queue": info[0],
+                    "instrument": info[4]["instrument"],
+                    "run_number": info[4]["run_number"],
+                    "running_sec": round(now - info[2], 1),
+                    "peak_memory_mb": round(info[3] / 1024**2, 1),
+                }
+                for proc, info in list(self.job_info.items())
+                if proc.poll() is None
+            ]
+            return dict(self.control_state(), jobs=jobs)
+        raise ValueError(f"Unknown command: {name}")
+
+    def control_state(self):
+        """
+        @returns dict: limits and paused instruments and queues, as set by the control commands
+        """
+        return {
+            "max_procs": self.config.max_procs,
+            "jobs_per_instrument": self.config.jobs_per_instrument,
+            "instrument_limits": dict(self.instrument_limits),
+            "paused_instruments": sorted(self.paused_instruments),
+            "paused_queues": sorted(self.paused_queues),
+        }
+
 
-def heartbeat(conn, destination, data_dict={}):
+class ControlListener(stomp.ConnectionListener):
+    """
+    Answers the pings, and runs the commands of the control topic, on a connection of its own,
+    so that they are not held up by the dispatch of the jobs on the connection of the Listener
+    """
+
+    def __init__(self, listener, connection):
+        """
+        @param listener: Listener whose load is sent with the replies
+        @param connection: control connection
+        """
+        super().__init__()
+        self.listener = listener
+        self.conn = connection
+
+    def on_message(self, frame):
+        """
+        Reply to a ping request, or run a command
+        @param frame: StompFrame object
+        """
+        try:
+            data_dict = json.loads(frame.body)
+        except:  # noqa: E722
+            logging.error("Invalid control message: %s", sys.exc_info()[1])
+            return
+        control_topic = self.listener.config.control_topic
+        if control_topic and frame.headers.get("destination") == control_topic:
+            self.run_command(data_dict)
+            return
+        self.listener.ack_ping(data_dict, self.conn)
+        self.listener.metrics.inc(
+            "postprocessing_messages_total", queue=frame.headers.get("destination", ""), instrument="", outcome="ping"
+        )
+
+    def run_command(self, command):
+        """
+        Run a command, and acknowledge it on the status topic, or on "reply_to" if given
+        @param dict command: command, see `Listener.control`. Only the node named in "node" runs it, if given.
+        """
+        if command.get("node", socket.gethostname()) != socket.gethostname():
+            return
+        logging.warning("Control command: %s", command)
+        reply = {"command": command.get("command"), "id": command.get("id", "")}
+        try:
+            reply.update(self.listener.control(command))
+            reply["result"] = "OK"
+        except:  # noqa: E722
+            logging.error("Control command %s failed: %s", command.get("command"), sys.exc_info()[1])
+            reply["result"] = "ERROR"
+            reply["error"] = str(sys.exc_info()[1])
+        self.listener.metrics.inc("postprocessing_control_commands_total", command=str(reply["command"]))
+        heartbeat(self.conn, command.get("reply_to", self.listener.config.heart_beat), reply, self.listener.metrics)
+
+
+def feed_input(stream, payload):
+    """
+    Write the payload of a job to its standard input, in the background since a large payload
+    fills the pipe until the job reads it
+    @param stream: stdin of the job
+    @param bytes payload: body of the message
+    """
+    try:
+        with stream:
+            stream.write(payload)
+    except:  # noqa: E722
+        logging.error("Could not send the payload to a job: %s", sys.exc_info()[1])
+
+
+def relay_output(stream):
+    """
+    Log the output of a job with the SUBPROCESS level, line by line, until the job closes it
+    @param stream: stdout of the job
+    """
+    try:
+        with stream:
+            for line in stream:  ### log with custom level
+                logging.subprocess(line.decode(errors="replace").strip())
+    except:  # noqa: E722
+        logging.error("Could not relay the output of a job: %s", sys.exc_info()[1])
+    logging.warning("end")
+
+
+def heartbeat(conn, destination, data_dict={}, metrics=None):
     """
     Send heartbeats at a regular time interval
     @param: destination where to send the heartbeat
     @param data_dict: optional dictionary to pass along
+    @param metrics: optional Metrics recording the time to send the heartbeat
     """
 
     try:
@@ -178,11 +769,122 @@ def heartbeat(conn, destination, data_dict={}):
                 "pid": str(os.getpid()),
             }
         )
+        start = time.monotonic()
         conn.send(destination, json.dumps(data_dict).encode())
+        if metrics is not None:
+            metrics.observe("postprocessing_broker_send_latency_seconds", time.monotonic() - start, queue=destination)
     except:  # noqa: E722
         logging.error("Could not send heartbeat: %s", sys.exc_info()[1])
 
 
+class BrokerLink(stomp.ConnectionListener):
+    """
+    Subscriptions of the consumer on one of the brokers. The links to the brokers share the
+    Listener, that is the jobs and their limits, and reconnect independently with a backoff.
+    """
+
+    def __init__(self, broker, listener):
+        """
+        @param broker: (host, port) of the broker
+        @param listener: Listener starting the jobs
+        """
+        super().__init__()
+        self.broker = tuple(broker)
+        self.listener = listener
+        self.conn = None
+        # queues subscribed to on the connection
+        self.subscriptions = set()
+        # delay before the next attempt to connect, and when it may be made
+        self.delay = 0.0
+        self.retry_time = 0.0
+
+    @property
+    def name(self):
+        return "%s:%s" % self.broker
+
+    def is_connected(self):
+        return self.conn is not None and self.conn.is_connected()
+
+    def connect(self, config):
+        """
+        Connect to the broker and subscribe to the queues, unless waiting before the next attempt
+        @param config: configuration of the consumer
+        @returns bool: whether the link is connected
+        """
+        if self.is_connected():
+            return True
+        if time.monotonic() < self.retry_time:
+            return False
+        conn = None
+        self.subscriptions = set()
+        try:
+            # stomp does not retry: the other links must not wait for this broker
+            conn = stomp.Connection(host_and_ports=[self.broker], keepalive=True, reconnect_attempts_max=1)
+            conn.set_listener("postprocessing", self)
+            conn.connect(config.amq_user, config.amq_pwd, wait=True)
+            for q in self.listener.subscribed_queues(config):
+                self.subscribe(q, conn)
+            # connected once subscribed to all the queues, otherwise the next attempt starts over
+            self.conn = conn
+        except:  # noqa: E722
+            self.subscriptions = set()
+            if conn is not None and conn.is_connected():
+                try:
+                    conn.disconnect()
+                except:  # noqa: E722
+                    pass
+            self.delay = min(max(2 * self.delay, RECONNECT_DELAY), MAX_RECONNECT_DELAY)
+            self.retry_time = time.monotonic() + self.delay
+            logging.error("Could not connect to %s, next attempt in %s s: %s", self.name, self.delay, sys.exc_info()[1])
+            return False
+        self.delay = 0.0
+        logging.info("Connected to %s", self.name)
+        return True
+
+    def subscribe(self, q, conn=None):
+        """
+        Subscribe to a queue
+        @param q: queue name
+        @param conn: connection to subscribe on, the connection of the link by default
+        """
+        conn = conn or self.conn
+        # set prefetchSize to 0 to disable prefetching and force consumer to poll for messages
+        # prefetching may cause issues with load balancing and dropped messages if the performance varies
+        # between consumers
+        # See https://stackoverflow.com/questions/76653908
+        # https://activemq.apache.org/components/classic/documentation/what-is-the-prefetch-limit-for
+        conn.subscribe(destination=q, id=q, ack="client", headers={"activemq.prefetchSize": 0})
+        self.subscriptions.add(q)
+
+    def unsubscribe(self, q):
+        """
+        Unsubscribe from a queue
+        """
+        self.conn.unsubscribe(id=q)
+        self.subscriptions.discard(q)
+
+    def sync(self, config):
+        """
+        Subscribe to the queues of the configuration, except the paused ones, and unsubscribe from the others
+        @param config: configuration of the consumer
+        """
+        queues = self.listener.subscribed_queues(config)
+        for q in sorted(self.subscriptions - set(queues)):
+            self.unsubscribe(q)
+        for q in queues:
+            if q not in self.subscriptions:
+                self.subscribe(q)
+
+    def disconnect(self):
+        if self.is_connected():
+            self.conn.disconnect()
+        self.conn = None
+        self.subscriptions = set()
+
+    def on_message(self, frame):
+        self.listener.on_message(frame, self.conn)
+
+
 class Consumer:
     """
     ActiveMQ consumer
@@ -192,13 +894,23 @@ class Consumer:
         self.config = config
         self.procList = []
         self.instrument_jobs = {}
-        self._connection = None
+        self.metrics = Metrics()
+        describe_metrics(self.metrics)
+        # one link per broker, all starting their jobs through the same listener
+        self._listener = Listener(config, None, self.metrics)
+        self._links = []
+        # connection for the pings and heartbeats
+        self._control_connection = None
         self._exit = False
+        self._reload = False
+        self._config_version = config.config_version
+        self._metrics_servers = []
 
         # Signals registered for systemd
         signal.signal(signal.SIGTERM, self.exit_gracefully)
         signal.signal(signal.SIGINT, self.exit_gracefully)
         signal.signal(signal.SIGQUIT, self.exit_gracefully)
+        signal.signal(signal.SIGHUP, self.request_reload)
 
     def exit_gracefully(self, *args):
         """
@@ -206,48 +918,107 @@ class Consumer:
         """
         self._exit = True
 
-    def get_connection(self, listener=None):
+    def request_reload(self, *args):
+        """
+        Reload the configuration file in the main loop
+        """
+        self._reload = True
+
+    def reload_configuration(self):
         """
-        Establish and return a connection to ActiveMQ
+        Read the configuration file again and apply it without interrupting the running jobs.
+        Limits apply to the next messages, and the queues of the processors added or removed
+        are subscribed to or unsubscribed from.
 
-        :param listener: listener object
+        :return: whether the new configuration was applied
         """
-        conn = stomp.Connection(host_and_ports=self.config.brokers, keepalive=True)
+        self._config_version = get_file_version(self.config.config_file)
+        try:
+            config = Configuration(self.config.config_file)
+        except:  # noqa: E722
+            logging.error("Invalid configuration, keeping the current one: %s", sys.exc_info()[1])
+            self.metrics.inc("postprocessing_config_reloads_total", outcome="error")
+            return False
+        for name in RESTART_SETTINGS:
+            if getattr(config, name) != getattr(self.config, name):
+                logging.warning("Configuration: restart the post-processing agent to change %s", name)
 
-        listener = Listener(self.config, conn)
+        removed = [q for q in self.config.queues if q not in config.queues]
+        added = [q for q in config.queues if q not in self.config.queues]
+        for link in self._links:
+            if link.is_connected():
+                link.sync(config)
+        if config.heartbeat_ping != self.config.heartbeat_ping and self._is_connected(self._control_connection):
+            self._control_connection.unsubscribe(id="ping")
+            self._control_connection.subscribe(destination=config.heartbeat_ping, id="ping", ack="auto")
+        if config.control_topic != self.config.control_topic and self._is_connected(self._control_connection):
+            if self.config.control_topic:
+                self._control_connection.unsubscribe(id="control")
+            if config.control_topic:
+                self._control_connection.subscribe(destination=config.control_topic, id="control", ack="auto")
 
-        conn.set_listener("postprocessing", listener)
-        conn.connect(self.config.amq_user, self.config.amq_pwd, wait=True)
+        # a single assignment: each message sees either the old or the new configuration
+        self.config = config
+        self._listener.config = config
+        logging.root.setLevel(config.log_level)
+        self.metrics.inc("postprocessing_config_reloads_total", outcome="success")
+        logging.info("Configuration reloaded from %s: queues added %s, removed %s", config.config_file, added, removed)
+        config.log_configuration()
+        return True
 
-        time.sleep(0.5)
+    def get_control_connection(self):
+        """
+        Establish and return the connection answering the pings and sending the heartbeats,
+        to one of the brokers the links are connected to
+        """
+        brokers = [link.broker for link in self._links if link.is_connected()] or self.config.brokers
+        # a single attempt: the main loop tries again, without holding up the links
+        conn = stomp.Connection(host_and_ports=brokers, keepalive=True, reconnect_attempts_max=1)
+        conn.set_listener("control", ControlListener(self._listener, conn))
+        conn.connect(self.config.amq_user, self.config.amq_pwd, wait=True)
+        conn.subscribe(destination=self.config.heartbeat_ping, id="ping", ack="auto")
+        if self.config.control_topic:
+            conn.subscribe(destination=self.config.control_topic, id="control", ack="auto")
         return conn
 
+    @staticmethod
+    def _is_connected(conn):
+        return conn is not None and conn.is_connected()
+
+    def _all_connected(self):
+        return (
+            bool(self._links)
+            and all(link.is_connected() for link in self._links)
+            and self._is_connected(self._control_connection)
+        )
+
     def connect(self):
         """
-        Connect to a broker
+        Connect to every broker, and to one of them for the pings. The brokers that cannot
+        be reached are tried again later, without holding up the others.
         """
-        if self._connection is None or not self._connection.is_connected():
-            self._disconnect()
-            self._connection = self.get_connection()
-
-            if self.config.heartbeat_ping not in self.config.queues:
-                self.config.queues.append(self.config.heartbeat_ping)
+        if not self._links:
+            self._links = [BrokerLink(broker, self._listener) for broker in self.config.brokers]
+        connected = False
+        for link in self._links:
+            link_connected = link.connect(self.config)
+            self.metrics.set("postprocessing_broker_connected", int(link_connected), broker=link.name)
+            connected = connected or link_connected
+        if not connected:
+            raise RuntimeError("Could not connect to any of the brokers")
 
-        for q in self.config.queues:
-            # set prefetchSize to 0 to disable prefetching and force consumer to poll for messages
-            # prefetching may cause issues with load balancing and dropped messages if the performance varies
-            # between consumers
-            # See https://stackoverflow.com/questions/76653908
-            # https://activemq.apache.org/components/classic/documentation/what-is-the-prefetch-limit-for
-            self._connection.subscribe(destination=q, id=q, ack="client", headers={"activemq.prefetchSize": 0})
+        if not self._is_connected(self._control_connection):
+            self._control_connection = self.get_control_connection()
 
     def _disconnect(self):
         """
         Clean disconnect
         """
-        if self._connection is not None and self._connection.is_connected():
-            self._connection.disconnect()
-        self._connection = None
+        for link in self._links:
+            link.disconnect()
+        if self._is_connected(self._control_connection):
+            self._control_connection.disconnect()
+        self._control_connection = None
 
     def listen_and_wait(self, waiting_period=1.0):
         """
@@ -258,20 +1029,45 @@ class Consumer:
         :param waiting_period: sleep time between connection to a broker
         """
 
+        if not self._metrics_servers:
+            self._metrics_servers = start_metrics_servers(
+                self.metrics,
+                port=self.config.metrics_port,
+                host=self.config.metrics_host,
+                socket_path=self.config.metrics_socket,
+            )
+
         last_heartbeat = 0
+        last_config_check = time.time()
         while not self._exit:
             try:
-                if self._connection is None or self._connection.is_connected() is False:
+                if not self._all_connected():
                     self.connect()
 
+                # Apply the changes of the configuration file, or reload it on SIGHUP
+                if self._reload or time.time() - last_config_check > CONFIG_CHECK_DELAY:
+                    last_config_check = time.time()
+                    if self._reload or get_file_version(self.config.config_file) != self._config_version:
+                        self._reload = False
+                        self.reload_configuration()
+
                 try:
                     if time.time() - last_heartbeat > HEARTBEAT_DELAY:
                         last_heartbeat = time.time()
-                        heartbeat(self._connection, self.config.heart_beat)
+                        data_dict = {}
+                        data_dict["load"] = self._listener.load_info()
+                        heartbeat(self._control_connection, self.config.heart_beat, data_dict, metrics=self.metrics)
                 except:  # noqa: E722
                     logging.exception("Problem writing heartbeat")
 
+                # unsubscribe from the paused queues, and subscribe to the resumed ones
+                for link in self._links:
+                    if link.is_connected():
+                        link.sync(self.config)
+
+                self._listener.sample()
                 time.sleep(waiting_period)
             except:  # noqa: E722
                 logging.exception("Problem connecting to AMQ broker")
                 time.sleep(5.0)
+        self._disconnect()
@@ -15,14 +15,17 @@ Example input dictionaries:
 @copyright: 2014 Oak Ridge National Laboratory
 """
 
+from concurrent.futures import ThreadPoolExecutor
+import copy
 import logging
 import json
 import socket
 import os
 import sys
-import importlib
 import stomp
 
+from postprocessing.processors import get_dispatch_table, load_processor
+
 
 class PostProcessAdmin:
     def __init__(self, data, conf):
@@ -54,6 +57,39 @@ class PostProcessAdmin:
         conn.send(destination, data.encode())
         conn.disconnect()
 
+    def process(self, queue):
+        """
+        Run the processors handling a queue. When several processors handle the
+        same queue, they run concurrently, each with its own copy of the data.
+        @param queue: AMQ queue the message was received on
+        """
+        processors = get_dispatch_table(tuple(self.conf.processors)).get(queue, ())
+        if len(processors) == 1:
+            self._run_processor(processors[0], self.data)
+        elif len(processors) > 1:
+            with ThreadPoolExecutor(max_workers=len(processors)) as executor:
+                futures = [executor.submit(self._run_processor, p, copy.deepcopy(self.data)) for p in processors]
+            errors = [future.exception() for future in futures if future.exception() is not None]
+            if errors:
+                raise errors[0]
+
+    def _run_processor(self, processor, data):
+        """
+        Instantiate and call a processor
+        @param processor: processor, in the format module.Processor_class
+        @param data: data dictionary given to the processor
+        """
+        try:
+            processor_class = load_processor(processor)
+            proc = processor_class(data, self.conf, send_function=self.send)
+            try:
+                proc()
+            finally:
+                proc.write_trace()
+        except:  # noqa: E722
+            logging.error("PostProcessAdmin: Processor error: %s", sys.exc_info()[1])
+            raise
+
 
 if __name__ == "__main__":
     import argparse
@@ -64,7 +100,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Post-processing agent")
     parser.add_argument("-q", metavar="queue", help="ActiveMQ queue name", dest="queue", required=True)
     parser.add_argument("-c", metavar="config", help="Configuration file", dest="config")
-    parser.add_argument("-d", metavar="data", help="JSON data", dest="data")
+    parser.add_argument("-d", metavar="data", help="JSON data, - to read it from the standard input", dest="data")
     parser.add_argument("-f", metavar="data_file", help="Nexus data file", dest="data_file")
     namespace = parser.parse_args()
 
@@ -94,6 +130,9 @@ if __name__ == "__main__":
                             data["ipts"] = sep_toks[1]
             else:
                 logging.error("PostProcessAdmin: Expected a JSON object or a file path")
+        elif namespace.data == "-":
+            # payload written unchanged by the consumer
+            data = json.loads(sys.stdin.buffer.read())
         else:
             data = json.loads(namespace.data)
 
@@ -101,28 +140,9 @@ if __name__ == "__main__":
         try:
             pp = PostProcessAdmin(data, configuration)
 
-            # Check for registered processors
+            # Run the registered processors of the queue
             if isinstance(configuration.processors, list):
-                for p in configuration.processors:
-                    toks = p.split(".")
-                    if len(toks) == 2:
-                        processor_module = importlib.import_module(f"postprocessing.processors.{toks[0]}")
-                        try:
-                            processor_class = getattr(processor_module, toks[1])
-                            if namespace.queue == processor_class.get_input_queue_name():
-                                # Instantiate and call the processor
-                                proc = processor_class(data, configuration, send_function=pp.send)
-                                proc()
-                        except:  # noqa: E722
-                            logging.error(
-                                "PostProcessAdmin: Processor error: %s",
-                                sys.exc_info()[1],
-                            )
-                            raise
-                    else:
-                        logging.error(
-                            "PostProcessAdmin: Processors can only be specified in the format module.Processor_class"
-                        )
+                pp.process(namespace.queue)
 
         except:  # noqa: E722
             # If we have a proper data dictionary, send it back with an error message
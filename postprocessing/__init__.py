@@ -1,5 +1,8 @@
-# postprocessing version - from package metadata
-from importlib import metadata
+# postprocessing version - from package metadata, read on first use since importlib.metadata is slow
+# to import and every PostProcessAdmin.py invocation imports this package
+def __getattr__(name):
+    if name == "__version__":
+        from importlib import metadata
 
-__version__ = metadata.version("postprocessing")
-del metadata
+        return metadata.version("postprocessing")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,214 @@
+"""
+Non-blocking logging of the post-processing agent.
+
+The threads logging a message only put the record in a bounded queue. A background
+thread takes the records from the queue and writes them to the log file in batches,
+with a single write and flush per batch. When the queue is full, records below ERROR
+are dropped instead of blocking the thread receiving the messages, and the number
+of records dropped is logged once there is room again.
+
+The log file is either in the usual text format, or in JSON with one object per line:
+
+    {"time": "2026-10-19 10:00:00,123", "level": "INFO", "pid": 1234, "logger": "root", "message": "..."}
+
+@copyright: 2026 Oak Ridge National Laboratory
+"""
+
+import atexit
+import json
+import logging
+from logging.handlers import QueueHandler, RotatingFileHandler
+import queue
+import threading
+
+LOG_FORMAT = "%(asctime)s %(levelname)s/%(process)d %(message)s"
+# Maximum number of records written at once
+LOG_BATCH_SIZE = 500
+
+_pipeline = None
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats the records as JSON objects, one per line
+    """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "pid": record.process,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+def get_formatter(log_format="text"):
+    r"""Formatter of the log file
+    @param str log_format: "text" or "json"
+    @returns logging.Formatter: formatter of the records
+    """
+    if log_format == "json":
+        return JSONFormatter()
+    return logging.Formatter(LOG_FORMAT)
+
+
+class BatchRotatingFileHandler(RotatingFileHandler):
+    """
+    Rotating file handler that can write several records at once
+    """
+
+    def emit_batch(self, records):
+        r"""Write records with a single write and flush
+        @param list records: records to write
+        """
+        lines = []
+        for record in records:
+            if record.levelno >= self.level and self.filter(record):
+                try:
+                    lines.append(self.format(record) + self.terminator)
+                except Exception:  # noqa: BLE001
+                    self.handleError(record)
+        if not lines:
+            return
+        chunk = "".join(lines)
+        self.acquire()
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            position = self.stream.tell()
+            if self.maxBytes > 0 and position > 0 and position + len(chunk) >= self.maxBytes:
+                self.doRollover()
+            self.stream.write(chunk)
+            self.stream.flush()
+        except Exception:  # noqa: BLE001
+            self.handleError(records[-1])
+        finally:
+            self.release()
+
+
+class BoundedQueueHandler(QueueHandler):
+    """
+    Queue handler that never blocks the thread logging a record below ``block_level``
+    """
+
+    def __init__(self, log_queue, block_level=logging.ERROR, timeout=1.0):
+        r"""
+        @param queue.Queue log_queue: bounded queue of the records
+        @param int block_level: records at this level or above wait up to ``timeout`` seconds for room in the queue
+        @param float timeout: seconds to wait for room in the queue
+        """
+        super().__init__(log_queue)
+        self.block_level = block_level
+        self.timeout = timeout
+        self.dropped = 0
+
+    def emit(self, record):
+        try:
+            prepared = self.prepare(record)
+            if record.levelno >= self.block_level:
+                self.queue.put(prepared, timeout=self.timeout)
+            else:
+                self.queue.put_nowait(prepared)
+        except queue.Full:
+            # called with the handler lock held
+            self.dropped += 1
+        except Exception:  # noqa: BLE001
+            self.handleError(record)
+
+
+class BatchingQueueListener:
+    """
+    Writes the records of a queue in batches, in a background thread
+    """
+
+    _sentinel = None
+
+    def __init__(self, queue_handler, handler, batch_size=LOG_BATCH_SIZE):
+        r"""
+        @param BoundedQueueHandler queue_handler: handler putting the records in the queue
+        @param logging.Handler handler: handler writing the records
+        @param int batch_size: maximum number of records written at once
+        """
+        self.queue_handler = queue_handler
+        self.queue = queue_handler.queue
+        self.handler = handler
+        self.batch_size = batch_size
+        self._reported = 0
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._monitor, name="logging", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        r"""Write the records left in the queue and stop the thread"""
+        if self._thread is not None:
+            self.queue.put(self._sentinel)
+            self._thread.join()
+            self._thread = None
+
+    def _monitor(self):
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if self._sentinel in batch:
+                stopping = True
+                batch = [record for record in batch if record is not self._sentinel]
+            dropped = self.queue_handler.dropped
+            if dropped > self._reported:
+                record = logging.makeLogRecord(
+                    {
+                        "name": "logging",
+                        "levelno": logging.WARNING,
+                        "levelname": logging.getLevelName(logging.WARNING),
+                        "msg": f"Log queue full: dropped {dropped - self._reported} records",
+                    }
+                )
+                batch.append(record)
+                self._reported = dropped
+            self.write(batch)
+
+    def write(self, records):
+        if hasattr(self.handler, "emit_batch"):
+            self.handler.emit_batch(records)
+        else:
+            for record in records:
+                self.handler.handle(record)
+
+
+def start_log_pipeline(handler, queue_size):
+    r"""Write the records through a bounded queue and a background thread
+    @param logging.Handler handler: handler writing the records
+    @param int queue_size: maximum number of records waiting to be written
+    @returns BoundedQueueHandler: handler to add to the loggers
+    """
+    global _pipeline
+    stop_log_pipeline()
+    queue_handler = BoundedQueueHandler(queue.Queue(queue_size))
+    listener = BatchingQueueListener(queue_handler, handler)
+    listener.start()
+    _pipeline = listener
+    return queue_handler
+
+
+def stop_log_pipeline():
+    r"""Write the records left in the queue, and close the log file"""
+    global _pipeline
+    if _pipeline is not None:
+        _pipeline.stop()
+        _pipeline.handler.close()
+        _pipeline = None
+
+
+atexit.register(stop_log_pipeline)
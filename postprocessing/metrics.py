@@ -0,0 +1,159 @@
+"""
+Runtime metrics of the post-processing agent.
+
+Metrics are kept in memory by the consumer and exposed in the Prometheus text
+format, either over HTTP on a local port or on a Unix socket that writes the
+current metrics to every client that connects:
+
+    curl http://localhost:9100/metrics
+    socat - UNIX-CONNECT:/run/postprocessing/metrics.sock
+
+@copyright: 2026 Oak Ridge National Laboratory
+"""
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import os
+import socketserver
+import threading
+import time
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        escaped.append(f'{key}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+class Metrics:
+    """
+    Thread-safe registry of counters, gauges and summaries
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> (type, help)
+        self._descriptions = {}
+        # (name, labels) -> value, or [count, sum, max] for summaries
+        self._values = {}
+
+    def describe(self, name, metric_type, description):
+        r"""Declare a metric
+        @param str name: name of the metric
+        @param str metric_type: counter, gauge or summary
+        @param str description: help text of the metric
+        """
+        with self._lock:
+            self._descriptions[name] = (metric_type, description)
+
+    def inc(self, name, value=1.0, **labels):
+        r"""Increase a counter"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._descriptions.setdefault(name, ("counter", ""))
+            self._values[key] = self._values.get(key, 0.0) + value
+
+    def set(self, name, value, **labels):
+        r"""Set the value of a gauge"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._descriptions.setdefault(name, ("gauge", ""))
+            self._values[key] = float(value)
+
+    def observe(self, name, value, **labels):
+        r"""Record an observation of a summary, for instance a latency"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._descriptions.setdefault(name, ("summary", ""))
+            summary = self._values.setdefault(key, [0, 0.0, 0.0])
+            summary[0] += 1
+            summary[1] += value
+            summary[2] = max(summary[2], value)
+
+    @contextmanager
+    def time(self, name, **labels):
+        r"""Observe the duration of a block of code, in seconds"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def render(self):
+        r"""Return the metrics in the Prometheus text exposition format"""
+        with self._lock:
+            values = sorted(self._values.items())
+            descriptions = dict(self._descriptions)
+        lines = []
+        described = set()
+        for (name, labels), value in values:
+            metric_type, description = descriptions[name]
+            if name not in described:
+                described.add(name)
+                if description:
+                    lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} {metric_type}")
+            label_text = _format_labels(labels)
+            if metric_type == "summary":
+                count, total, maximum = value
+                lines.append(f"{name}_count{label_text} {count}")
+                lines.append(f"{name}_sum{label_text} {total:.6f}")
+                lines.append(f"{name}_max{label_text} {maximum:.6f}")
+            else:
+                lines.append(f"{name}{label_text} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+class _MetricsHTTPHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("Metrics request: " + format, *args)
+
+
+class _MetricsSocketHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.wfile.write(self.server.metrics.render().encode())
+
+
+class _MetricsUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def start_metrics_servers(metrics, port=0, host="127.0.0.1", socket_path=""):
+    r"""Expose metrics in the background
+    @param Metrics metrics: metrics to expose
+    @param int port: HTTP port, no HTTP endpoint if None or negative, any free port if 0
+    @param str host: address the HTTP endpoint listens on
+    @param str socket_path: path of the Unix socket, no socket if empty
+    @returns list: the servers started, to be shut down by the caller
+    """
+    servers = []
+    if port is not None and port >= 0:
+        http_server = ThreadingHTTPServer((host, port), _MetricsHTTPHandler)
+        http_server.daemon_threads = True
+        servers.append(http_server)
+        logging.info("Serving metrics on http://%s:%s/metrics", *http_server.server_address[:2])
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        servers.append(_MetricsUnixServer(socket_path, _MetricsSocketHandler))
+        logging.info("Serving metrics on %s", socket_path)
+    for server in servers:
+        server.metrics = metrics
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return servers
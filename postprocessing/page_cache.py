@@ -0,0 +1,88 @@
+"""
+Prewarming of the page cache with the input files of the jobs.
+
+While a reduction waits for a free slot, the kernel is asked to read its data file ahead
+(``posix_fadvise(POSIX_FADV_WILLNEED)``), so that the file is already in memory when the
+reduction loads it. The read-ahead is requested block by block, within a bandwidth and a
+number of bytes per file, and is skipped when the file would not fit in the memory
+available on the node. The reduction writes the bytes prewarmed to its log, reported by
+``scripts/ar_report.py`` next to the time spent loading the file.
+
+@copyright: 2026 Oak Ridge National Laboratory
+"""
+
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import psutil
+
+from postprocessing.scratch import Throttle
+
+# Size of the blocks read ahead at once (bytes)
+PREWARM_BLOCK_SIZE = 16 * 1024**2
+# Line of the reduction log with the bytes prewarmed, read by ar_report
+PREWARM_LOG_LINE = "PageCache-[Notice] Prewarmed {mib:.1f} MiB of {name}\n"
+
+
+def prewarm(path, max_bytes, throttle=None, cancel=None):
+    r"""Ask the kernel to read a file ahead into the page cache
+    @param str path: file to read ahead
+    @param int max_bytes: maximum number of bytes, from the start of the file
+    @param Throttle throttle: bandwidth of the read-ahead, none for no limit
+    @param threading.Event cancel: stop the read-ahead when set
+    @returns int: number of bytes read ahead
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return 0
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        length = min(os.fstat(fd).st_size, max_bytes)
+        offset = 0
+        while offset < length:
+            if cancel is not None and cancel.is_set():
+                break
+            size = min(PREWARM_BLOCK_SIZE, length - offset)
+            if throttle is not None:
+                throttle.wait(size)
+            os.posix_fadvise(fd, offset, size, os.POSIX_FADV_WILLNEED)
+            offset += size
+        return offset
+    finally:
+        os.close(fd)
+
+
+class PageCacheWarmer:
+    """
+    Reads the data files of the waiting jobs ahead, one at a time
+    """
+
+    def __init__(self, max_bytes, bandwidth_bytes=0, memory_fraction=0.5):
+        """
+        @param int max_bytes: maximum number of bytes read ahead per file
+        @param int bandwidth_bytes: maximum bytes per second, 0 for no limit
+        @param float memory_fraction: skip the files larger than this fraction of the available memory
+        """
+        self.max_bytes = max_bytes
+        self.memory_fraction = memory_fraction
+        self.throttle = Throttle(bandwidth_bytes)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prewarm")
+
+    def submit(self, path):
+        r"""Start reading a file ahead
+        @param str path: file to read ahead
+        @returns tuple: Future resolved with the number of bytes read ahead, and the event cancelling it
+        """
+        cancel = threading.Event()
+        return self.executor.submit(self._prewarm, path, cancel), cancel
+
+    def _prewarm(self, path, cancel):
+        length = min(os.path.getsize(path), self.max_bytes)
+        available = psutil.virtual_memory().available
+        if length > available * self.memory_fraction:
+            logging.info("Not prewarming %s: %s bytes available", path, available)
+            return 0
+        prewarmed = prewarm(path, length, self.throttle, cancel)
+        logging.info("Prewarmed %s bytes of %s", prewarmed, path)
+        return prewarmed
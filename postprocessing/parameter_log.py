@@ -0,0 +1,161 @@
+"""
+Append-only log of the parameters used to write reduction scripts.
+
+Each entry is one JSON line of the log file:
+
+{"time": 1692193012.5, "instrument": "CNCS", "parameters": {"e_min": "-0.95", ...}}
+
+A sidecar index (the log file name followed by ``.idx``) holds one fixed-size
+record per entry with the time of the entry and its offset in the log, so that
+the parameters in effect at a given time are found by a binary search of the
+index instead of a scan of the whole history.
+
+Several agents may append to the same log at once: appends hold an exclusive
+``flock`` on the log while they write the entry and its index record, and entry
+times never decrease so the index stays sorted even if the clocks of the nodes
+disagree.
+
+@copyright: 2026 Oak Ridge National Laboratory
+"""
+
+import fcntl
+import json
+import os
+import struct
+import time
+
+# Index record: time of the entry (float seconds since the epoch) and offset of the entry in the log
+INDEX_RECORD = struct.Struct("<dQ")
+
+
+class ParameterLog:
+    """
+    Append-only JSON Lines log with a time index
+    """
+
+    def __init__(self, log_file):
+        """
+        @param str log_file: absolute path to the log file
+        """
+        self.log_file = log_file
+        self.index_file = f"{log_file}.idx"
+
+    def append(self, parameters, timestamp=None, **fields):
+        r"""Append an entry to the log
+        @param dict parameters: parameters to record
+        @param float timestamp: time of the entry, defaults to now
+        @param fields: additional fields of the entry, for instance the instrument
+        @returns dict: the entry written
+        """
+        fd = os.open(self.log_file, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            last_time = self._sync_index(fd)
+            entry = dict(fields)
+            entry["time"] = max(time.time() if timestamp is None else timestamp, last_time)
+            entry["parameters"] = parameters
+            line = (json.dumps(entry, sort_keys=True, default=str) + "\n").encode()
+            offset = os.fstat(fd).st_size
+            if offset > 0 and os.pread(fd, 1, offset - 1) != b"\n":
+                # terminate the line left incomplete by a writer that was killed, so that it stays
+                # a single unreadable line instead of swallowing this entry
+                line = b"\n" + line
+                offset += 1
+            written = 0
+            while written < len(line):
+                written += os.write(fd, line[written:])
+            with open(self.index_file, "ab") as index:
+                index.write(INDEX_RECORD.pack(entry["time"], offset))
+        finally:
+            os.close(fd)  # also releases the lock
+        return entry
+
+    def entry_at(self, timestamp):
+        r"""Return the entry in effect at a given time
+        @param float timestamp: time, in seconds since the epoch
+        @returns dict: the last entry written at or before ``timestamp``, or None
+        """
+        if not os.path.isfile(self.log_file):
+            return None
+        if not os.path.isfile(self.index_file):
+            self._rebuild_index()
+        with open(self.index_file, "rb") as index:
+            count = os.fstat(index.fileno()).st_size // INDEX_RECORD.size
+            # find the first record later than the requested time
+            low, high = 0, count
+            while low < high:
+                middle = (low + high) // 2
+                index.seek(middle * INDEX_RECORD.size)
+                record_time, _ = INDEX_RECORD.unpack(index.read(INDEX_RECORD.size))
+                if record_time <= timestamp:
+                    low = middle + 1
+                else:
+                    high = middle
+            if low == 0:
+                return None
+            index.seek((low - 1) * INDEX_RECORD.size)
+            _, offset = INDEX_RECORD.unpack(index.read(INDEX_RECORD.size))
+        with open(self.log_file, "rb") as log:
+            log.seek(offset)
+            return json.loads(log.readline())
+
+    def parameters_at(self, timestamp):
+        r"""Return the parameters in effect at a given time
+        @param float timestamp: time, in seconds since the epoch
+        @returns dict: parameters of the last entry written at or before ``timestamp``, or None
+        """
+        entry = self.entry_at(timestamp)
+        return None if entry is None else entry["parameters"]
+
+    def entries(self):
+        r"""Iterate over all the entries, oldest first"""
+        if not os.path.isfile(self.log_file):
+            return
+        with open(self.log_file, "rb") as log:
+            for line in log:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # entry left incomplete by a writer that was killed
+                    continue
+
+    def _rebuild_index(self):
+        fd = os.open(self.log_file, os.O_RDWR | os.O_APPEND)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            self._sync_index(fd)
+        finally:
+            os.close(fd)
+
+    def _sync_index(self, fd):
+        r"""Index the entries a writer appended without indexing them, for instance
+        because it was killed in between. Must be called with the log locked.
+        @param int fd: file descriptor of the log
+        @returns float: time of the last entry, 0 if the log is empty
+        """
+        last_time, offset = 0.0, 0
+        with open(self.index_file, "a+b") as index:
+            size = os.fstat(index.fileno()).st_size
+            complete = size - size % INDEX_RECORD.size
+            if complete != size:
+                index.truncate(complete)
+            if complete > 0:
+                index.seek(complete - INDEX_RECORD.size)
+                last_time, offset = INDEX_RECORD.unpack(index.read(INDEX_RECORD.size))
+
+            with os.fdopen(os.dup(fd), "rb") as log:
+                log.seek(offset)
+                if complete > 0:
+                    log.readline()  # already indexed
+                while True:
+                    entry_offset = log.tell()
+                    line = log.readline()
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    last_time = max(float(entry.get("time", 0.0)), last_time)
+                    index.write(INDEX_RECORD.pack(last_time, entry_offset))
+        return last_time
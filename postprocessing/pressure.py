@@ -0,0 +1,90 @@
+"""
+Admission of the heavy jobs according to the pressure stall information (PSI) of Linux.
+
+The kernel reports in /proc/pressure/{cpu,memory,io} the share of time the tasks of the node
+were stalled waiting for a resource, averaged over 10, 60 and 300 seconds:
+
+    some avg10=1.23 avg60=0.50 avg300=0.10 total=123456
+    full avg10=0.00 avg60=0.00 avg300=0.00 total=0
+
+The gate closes when the 10 s average of a resource crosses its threshold, and opens again
+once all the averages fell below a fraction of their threshold, so that the admission does
+not flap around the threshold.
+
+@copyright: 2026 Oak Ridge National Laboratory
+"""
+
+import logging
+import os
+import time
+
+PRESSURE_DIR = "/proc/pressure"
+# Time between reads of the pressure files (seconds)
+PRESSURE_CHECK_INTERVAL = 1.0
+
+
+def read_pressure(resource, pressure_dir=PRESSURE_DIR):
+    r"""Read the stall averages of a resource
+    @param str resource: cpu, memory or io
+    @param str pressure_dir: directory of the pressure files
+    @returns dict: for instance {"some": {"avg10": 1.23, "avg60": 0.5, "avg300": 0.1, "total": 123456.0}, "full": {...}}
+    """
+    pressure = {}
+    with open(os.path.join(pressure_dir, resource)) as handle:
+        for line in handle:
+            kind, *values = line.split()
+            pressure[kind] = {key: float(value) for key, value in (item.split("=") for item in values)}
+    return pressure
+
+
+class PressureGate:
+    """
+    Closes when the node stalls on a resource, with hysteresis
+    """
+
+    def __init__(self, pressure_dir=PRESSURE_DIR, check_interval=PRESSURE_CHECK_INTERVAL):
+        """
+        @param str pressure_dir: directory of the pressure files
+        @param float check_interval: seconds between reads of the pressure files
+        """
+        self.pressure_dir = pressure_dir
+        self.check_interval = check_interval
+        self.closed = False
+        # latest 10 s averages, by threshold name
+        self.averages = {}
+        self._checked = None
+        self._unavailable = set()
+
+    def is_closed(self, thresholds, recovery_ratio=0.5):
+        r"""Check the pressure of the node
+        @param dict thresholds: maximum 10 s average by resource, for instance {"memory": 10.0, "io.full": 20.0}.
+                                The "some" line is used unless the resource is followed by ".full".
+        @param float recovery_ratio: the gate opens again when all the averages are below this fraction of
+                                     their threshold
+        @returns bool: whether the heavy jobs should wait
+        """
+        now = time.monotonic()
+        if self._checked is not None and now - self._checked < self.check_interval:
+            return self.closed
+        self._checked = now
+
+        self.averages = {}
+        for name in thresholds:
+            resource, _, kind = name.partition(".")
+            try:
+                self.averages[name] = read_pressure(resource, self.pressure_dir)[kind or "some"]["avg10"]
+            except (OSError, KeyError, ValueError) as e:
+                if name not in self._unavailable:
+                    self._unavailable.add(name)
+                    logging.warning("Pressure stall information not available for %s: %s", name, e)
+
+        exceeded = [name for name, average in self.averages.items() if average > thresholds[name]]
+        if not self.closed and exceeded:
+            self.closed = True
+            logging.warning("Node under pressure (%s): holding the heavy jobs", self.averages)
+        elif self.closed and all(
+            average <= thresholds[name] * recovery_ratio for name, average in self.averages.items()
+        ):
+            self.closed = False
+            logging.warning("Node pressure back to normal (%s): accepting the heavy jobs", self.averages)
+        return self.closed
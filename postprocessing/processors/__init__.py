@@ -0,0 +1,102 @@
+"""
+Processors of the post-processing tasks.
+
+Processors are named "module.Class" in the "processors" configuration parameter, for
+instance "reduction_processor.ReductionProcessor". The input queues of the processors
+shipped here are listed in PROCESSOR_QUEUES, so that the agent can subscribe to the
+queues, and PostProcessAdmin.py can find the processor of a message, without importing
+the processor modules and their dependencies (pyoncat, requests, psutil...). Only the
+processor handling the message is imported.
+
+PROCESSOR_QUEUES must be kept in sync with the ``_message_queue`` of the processors,
+which the unit tests check.
+
+PROCESSOR_RESOURCES gives the resource class of the processors and the number of slots
+of that class their jobs take, so that the agent can limit the heavy jobs (reductions)
+without holding up the light ones (cataloging). Processors that are not listed take one
+light slot.
+
+@copyright: 2026 Oak Ridge National Laboratory
+"""
+
+import functools
+import importlib
+import logging
+import sys
+import types
+
+PROCESSOR_QUEUES = {
+    "calvera_processor.CalveraProcessor": "/queue/CALVERA.RAW.DATA_READY",
+    "calvera_processor.CalveraReducedProcessor": "/queue/CALVERA.REDUCED.DATA_READY",
+    "create_reduction_script_processor.CreateReductionScriptProcessor": "/queue/REDUCTION.CREATE_SCRIPT",
+    "intersect_processor.IntersectProcessor": "/queue/INTERSECT.RAW.DATA_READY",
+    "intersect_processor.IntersectReducedProcessor": "/queue/INTERSECT.REDUCED.DATA_READY",
+    "oncat_processor.ONCatProcessor": "/queue/CATALOG.ONCAT.DATA_READY",
+    "oncat_reduced_processor.ONCatProcessor": "/queue/REDUCTION_CATALOG.DATA_READY",
+    "reduction_processor.ReductionProcessor": "/queue/REDUCTION.DATA_READY",
+    "reduction_processor.ReductionProcessorHighMemory": "/queue/REDUCTION.HIMEM.DATA_READY",
+    "test_processor.TestProcessor": "/queue/REDUCTION.TESTPROCESSOR.DATA_READY",
+}
+
+# (resource class, slot weight) of the processors
+PROCESSOR_RESOURCES = {
+    "reduction_processor.ReductionProcessor": ("heavy", 1.0),
+    "reduction_processor.ReductionProcessorHighMemory": ("heavy", 2.0),
+}
+DEFAULT_RESOURCE = ("light", 1.0)
+
+
+def load_processor(processor):
+    r"""Import a processor class
+    @param str processor: processor, in the format module.Processor_class
+    @returns type: the processor class
+    """
+    toks = processor.split(".")
+    if len(toks) != 2:
+        raise ValueError("Processors can only be specified in the format module.Processor_class")
+    processor_module = importlib.import_module(f"postprocessing.processors.{toks[0]}")
+    return getattr(processor_module, toks[1])
+
+
+def get_input_queue_name(processor):
+    r"""Return the input queue of a processor, importing it only if it is not in PROCESSOR_QUEUES
+    @param str processor: processor, in the format module.Processor_class
+    @returns str: name of the queue starting the processor
+    """
+    if processor in PROCESSOR_QUEUES:
+        return PROCESSOR_QUEUES[processor]
+    logging.debug("Processor %s is not in the manifest: importing it", processor)
+    return load_processor(processor).get_input_queue_name()
+
+
+def get_queue_resources(processors, overrides=None):
+    r"""Resource class and slot weight of the jobs of each input queue
+    @param list processors: processors, in the format module.Processor_class
+    @param dict overrides: queue -> {"class": resource class, "weight": slot weight}, replacing the processors'
+    @returns dict: input queue -> (resource class, slot weight), the heaviest of the processors of the queue
+    """
+    resources = {}
+    for queue, queue_processors in get_dispatch_table(tuple(processors)).items():
+        queue_resources = [PROCESSOR_RESOURCES.get(processor, DEFAULT_RESOURCE) for processor in queue_processors]
+        resources[queue] = max(queue_resources, key=lambda resource: resource[1])
+    for queue, resource in (overrides or {}).items():
+        resources[queue] = (resource.get("class", DEFAULT_RESOURCE[0]), float(resource.get("weight", 1.0)))
+    return resources
+
+
+@functools.lru_cache(maxsize=None)
+def get_dispatch_table(processors):
+    r"""Map each input queue to the processors handling it, once per process
+    @param tuple processors: processors, in the format module.Processor_class
+    @returns mappingproxy: input queue -> tuple of processors, in the order of the configuration
+    """
+    table = {}
+    for processor in processors:
+        try:
+            queue = get_input_queue_name(processor)
+        except:  # noqa: E722
+            logging.error("Error loading processor %s: %s", processor, sys.exc_info()[1])
+            continue
+        if processor not in table.get(queue, ()):
+            table[queue] = table.get(queue, ()) + (processor,)
+    return types.MappingProxyType(table)
@@ -10,6 +10,11 @@ import os
 import logging
 import json
 from . import job_handling
+from postprocessing.run_metadata import read_run_metadata
+from postprocessing.tracing import Tracer
+
+# Messages that end a task, to which the timing of the task is attached
+FINAL_STATUSES = ("COMPLETE", "ERROR", "REROUTED")
 
 
 class BaseProcessor:
@@ -39,9 +44,35 @@ class BaseProcessor:
         """
         self.data = data
         self.configuration = conf
+        self.tracer = Tracer(enabled=getattr(conf, "tracing_enabled", False) is True)
         self._process_data(data)
         self._send_function = send_function
 
+    def span(self, name, **attributes):
+        """
+        Time a phase of the task
+
+        @param name: name of the phase
+        @param attributes: details of the phase, written to the trace file
+        """
+        return self.tracer.span(name, **attributes)
+
+    def write_trace(self):
+        """
+        Write the timing spans of the task to the trace directory, if any
+        """
+        trace_dir = getattr(self.configuration, "trace_dir", "")
+        if not self.tracer.enabled or not isinstance(trace_dir, str) or not trace_dir:
+            return
+        trace_file = os.path.join(
+            trace_dir, f"{self.instrument}_{self.run_number}_{type(self).__name__}_{os.getpid()}.trace.json"
+        )
+        try:
+            os.makedirs(trace_dir, exist_ok=True)
+            self.tracer.write(trace_file)
+        except OSError as e:
+            logging.warning("Could not write the trace file %s: %s", trace_file, e)
+
     @classmethod
     def get_input_queue_name(cls):
         """
@@ -73,14 +104,16 @@ class BaseProcessor:
         if os.path.isfile(out_log):
             os.remove(out_log)
 
-        job_handling.local_submission(
-            self.configuration,
-            script,
-            self.data_file,
-            self.output_dir,
-            out_log,
-            out_err,
-        )
+        with self.span(job_name):
+            job_handling.local_submission(
+                self.configuration,
+                script,
+                self.data_file,
+                self.output_dir,
+                out_log,
+                out_err,
+                tracer=self.tracer,
+            )
 
         return out_log, out_err
 
@@ -95,7 +128,7 @@ class BaseProcessor:
             try:
                 # Verify the file exists and is readable. Use open() instead of os.access()
                 # so ACLs and other filesystem permission checks are respected.
-                with open(self.data_file):
+                with self.span("open_data_file"), open(self.data_file):
                     pass
             except PermissionError as e:
                 raise ValueError(f"Data file permission denied: {self.data_file}") from e
@@ -132,6 +165,19 @@ class BaseProcessor:
         self.output_dir = self.proposal_shared_dir
         self.log_dir = self.output_dir
 
+    def run_metadata(self):
+        """
+        Return the start time, end time and duration of the run, read from the header
+        of the data file and shared through the run metadata cache.
+
+        @return RunMetadata: run metadata, or None if it could not be read
+        """
+        try:
+            return read_run_metadata(self.data_file, self.configuration.run_metadata_cache_dir)
+        except Exception as e:
+            logging.warning("Could not read the run metadata of %s: %s", self.data_file, e)
+            return None
+
     def process_error(self, destination, message):
         """
         Log and send error message
@@ -156,7 +202,26 @@ class BaseProcessor:
         @param destination: queue to send the error to
         @param message: error message
         """
-        if self._send_function is not None:
-            self._send_function(destination, message)
-        else:
-            print("NOT SEND TO AMQ", destination, message)
+        if self.tracer.enabled and destination.rsplit(".", 1)[-1] in FINAL_STATUSES:
+            message = self._add_timing(message)
+        with self.span("send", destination=destination):
+            if self._send_function is not None:
+                self._send_function(destination, message)
+            else:
+                print("NOT SEND TO AMQ", destination, message)
+
+    def _add_timing(self, message):
+        """
+        Attach the summary of the timing spans to a JSON message
+
+        @param message: JSON message, as str or bytes
+        """
+        try:
+            data = json.loads(message)
+        except ValueError:
+            return message
+        if not isinstance(data, dict):
+            return message
+        data["timing"] = self.tracer.summary()
+        timed_message = json.dumps(data)
+        return timed_message.encode() if isinstance(message, bytes) else timed_message
@@ -0,0 +1,188 @@
+"""
+Sharing of the CPUs of the node between the jobs running at the same time.
+
+Each job started by ``local_submission`` leases a share of the CPUs the agent may use,
+recorded in a file of the lease directory so that the jobs started by the other
+post-processing processes see it. The job, and the processes it starts, are pinned to the
+CPUs of the lease, and the thread pools (OpenMP, BLAS, numexpr) are sized to match.
+The least used CPUs are leased first, preferring the NUMA node with the most free CPUs so
+that a job stays on one node when possible. The leases are computed again when the number
+of jobs changes: the CPUs of the running jobs are then moved, but the number of threads of
+their pools, read when they start, does not change.
+
+@copyright: 2026 Oak Ridge National Laboratory
+"""
+
+import fcntl
+import glob
+import json
+import logging
+import os
+import uuid
+
+import psutil
+
+# Environment variables sizing the thread pools of the jobs
+THREAD_VARIABLES = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "NUMEXPR_NUM_THREADS"]
+# Time between checks of the number of jobs sharing the CPUs (seconds)
+CPU_REBALANCE_INTERVAL = 5.0
+NUMA_NODES = "/sys/devices/system/node/node*/cpulist"
+
+
+def parse_cpu_list(cpu_list):
+    r"""Parse a list of CPUs in the format of the kernel
+    @param str cpu_list: for instance "0-3,8-11"
+    @returns list: CPU numbers
+    """
+    cpus = []
+    for item in cpu_list.strip().split(","):
+        if "-" in item:
+            first, last = item.split("-")
+            cpus.extend(range(int(first), int(last) + 1))
+        elif item:
+            cpus.append(int(item))
+    return cpus
+
+
+def get_numa_nodes(cpus):
+    r"""Group CPUs by NUMA node
+    @param list cpus: CPUs to group
+    @returns list: list of CPUs of each node, a single group if the topology is unknown
+    """
+    nodes = []
+    for path in sorted(glob.glob(NUMA_NODES)):
+        try:
+            with open(path) as handle:
+                node = [cpu for cpu in parse_cpu_list(handle.read()) if cpu in cpus]
+        except (OSError, ValueError):
+            return [list(cpus)]
+        if node:
+            nodes.append(node)
+    grouped = {cpu for node in nodes for cpu in node}
+    if not nodes or grouped != set(cpus):
+        return [list(cpus)]
+    return nodes
+
+
+def pin_threads(process, cpus):
+    r"""Pin all the threads of a process to CPUs, like ``taskset -a``: the affinity of a process
+    only applies to its main thread, and its thread pools would keep running on their former CPUs
+    @param psutil.Process process: process to pin
+    @param list cpus: CPUs to run on
+    """
+    for thread in process.threads():
+        try:
+            os.sched_setaffinity(thread.id, cpus)
+        except OSError:
+            # the thread ended meanwhile
+            pass
+
+
+def set_affinity(pid, cpus):
+    r"""Pin a process and its children, with all their threads, to CPUs
+    @param int pid: process ID
+    @param list cpus: CPUs to run on
+    """
+    try:
+        parent = psutil.Process(pid)
+        # the parent first: the children and the threads it starts from now on inherit its CPUs
+        pin_threads(parent, cpus)
+        for child in parent.children(recursive=True):
+            try:
+                pin_threads(child, cpus)
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                pass
+    except (psutil.NoSuchProcess, psutil.AccessDenied) as e:
+        logging.warning("Could not set the CPU affinity of %s: %s", pid, e)
+
+
+class CPULease:
+    """
+    CPUs leased to a job
+    """
+
+    def __init__(self, lease_dir):
+        """
+        @param str lease_dir: directory of the lease files, shared by the jobs of the node
+        """
+        self.lease_dir = lease_dir
+        self.path = None
+        self.cpus = []
+        self.jobs = 0
+
+    def acquire(self):
+        r"""Lease a share of the CPUs
+        @returns list: CPUs leased
+        """
+        os.makedirs(self.lease_dir, exist_ok=True)
+        # written with the CPUs, the process ID first to find the leases of the processes that are gone
+        self.path = os.path.join(self.lease_dir, f"{os.getpid()}-{uuid.uuid4().hex[:8]}.json")
+        self._allocate()
+        return self.cpus
+
+    def rebalance(self):
+        r"""Lease a new share of the CPUs if the number of jobs changed
+        @returns list: CPUs leased, None if they did not change
+        """
+        if self.path is None:
+            return None
+        previous = self.cpus
+        if not self._allocate(only_if_jobs_changed=True) or self.cpus == previous:
+            return None
+        return self.cpus
+
+    def release(self):
+        r"""Give the CPUs back"""
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.path = None
+
+    def thread_env(self):
+        r"""Environment variables sizing the thread pools to the CPUs of the lease
+        @returns dict: variable -> number of threads
+        """
+        return {name: str(len(self.cpus)) for name in THREAD_VARIABLES}
+
+    def _read_leases(self):
+        r"""CPUs leased to the other jobs, removing the leases of the processes that are gone"""
+        leases = []
+        for path in glob.glob(os.path.join(self.lease_dir, "*.json")):
+            if path == self.path:
+                continue
+            try:
+                pid = int(os.path.basename(path).split("-", 1)[0])
+                if not psutil.pid_exists(pid):
+                    os.remove(path)
+                    continue
+                with open(path) as handle:
+                    leases.append(json.load(handle))
+            except (OSError, ValueError):
+                # a lease being written, or a file that is not a lease
+                continue
+        return leases
+
+    def _allocate(self, only_if_jobs_changed=False):
+        with open(os.path.join(self.lease_dir, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            leases = self._read_leases()
+            if only_if_jobs_changed and len(leases) + 1 == self.jobs:
+                return False
+            self.jobs = len(leases) + 1
+            available = sorted(os.sched_getaffinity(0))
+            usage = {cpu: 0 for cpu in available}
+            for cpus in leases:
+                for cpu in cpus:
+                    if cpu in usage:
+                        usage[cpu] += 1
+            # the node with the most free CPUs first, then the least used CPUs
+            nodes = sorted(get_numa_nodes(available), key=lambda node: -sum(1 for cpu in node if usage[cpu] == 0))
+            ordered = sorted((cpu for node in nodes for cpu in node), key=lambda cpu: usage[cpu])
+            share = max(1, len(available) // self.jobs)
+            self.cpus = sorted(ordered[:share])
+            with open(self.path, "w") as handle:
+                json.dump(self.cpus, handle)
+        logging.info("CPUs leased to the job: %s (%s jobs)", self.cpus, self.jobs)
+        return True
@@ -47,7 +47,8 @@ class IntersectProcessor(BaseProcessor):
         """
         Execute the job
         """
-        success, status_data = self.send_to_intersect()
+        with self.span("ingest"):
+            success, status_data = self.send_to_intersect()
         self.data.update(status_data)
         if success:
             self.send(self.COMPLETE_QUEUE, json.dumps(self.data))
@@ -87,7 +88,8 @@ class IntersectReducedProcessor(IntersectProcessor):
         raw_file_name = os.path.basename(self.data["data_file"])
         reduction_file_name = raw_file_name.replace(".nxs.h5", ".json")
         reduction_file_path = os.path.join(self.output_dir, reduction_file_name)
-        reduced_data_info = self._read_reduced_data(reduction_file_path)
+        with self.span("read_reduction_file"):
+            reduced_data_info = self._read_reduced_data(reduction_file_path)
         if not reduced_data_info:
             raise Exception("Cannot read reduced data info")
         to_send["reduced_data_info"] = reduced_data_info
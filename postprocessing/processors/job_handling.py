@@ -4,17 +4,31 @@ Handling of job execution.
 @copyright: 2014 Oak Ridge National Laboratory
 """
 
+import json
 import logging
 import subprocess
 import os
 import re
+import socket
 import time
 import psutil
 
+from postprocessing.processors.cpu_allocation import CPU_REBALANCE_INTERVAL, CPULease, set_affinity
+from postprocessing.tracing import NULL_TRACER
+
 CONVERSION_FACTOR_BYTES_TO_MB = 1.0 / (1024 * 1024)
 
+# Name of the script serving pre-warmed interpreters, installed next to mantidpython.py
+ZYGOTE_SCRIPT = "reduction_zygote.py"
+# Time between checks of a job whose zygote went away (seconds)
+ZYGOTE_LOST_POLL_INTERVAL = 0.1
+
+# Reasons for which local_submission terminates a job
+TERMINATED_MEMORY_LIMIT = "memory_limit"
+TERMINATED_TIME_LIMIT = "time_limit"
+
 
-def local_submission(configuration, script, input_file, output_dir, out_log, out_err):
+def local_submission(configuration, script, input_file, output_dir, out_log, out_err, tracer=NULL_TRACER):
     """
     Run a script locally
     @param configuration: configuration object
@@ -23,7 +37,10 @@ def local_submission(configuration, script, input_file, output_dir, out_log, out
     @param output_dir: reduction output directory
     @param out_log: reduction log file
     @param out_err: reduction error file
+    @param tracer: Tracer timing the start and the supervision of the job
+    @returns str: TERMINATED_MEMORY_LIMIT or TERMINATED_TIME_LIMIT if the job was terminated, None otherwise
     """
+    termination = None
     cmd = "%s %s %s %s/" % (
         configuration.python_executable,
         script,
@@ -36,56 +53,297 @@ def local_submission(configuration, script, input_file, output_dir, out_log, out
     time_limit_sec = get_time_limit_sec(configuration)
     with open(out_log, "w") as logFile, open(out_err, "w") as errFile:
         if configuration.comm_only is False:
-            proc = subprocess.Popen(
-                cmd,
-                shell=True,
-                stdin=subprocess.PIPE,
-                stdout=logFile,
-                stderr=errFile,
-                universal_newlines=True,
-                cwd=output_dir,
-            )
+            proc = None
+            # share of the CPUs of the node, and thread pools of the matching size
+            lease = None
+            thread_env = {}
+            if getattr(configuration, "cpu_pinning", False):
+                lease = CPULease(configuration.cpu_lease_dir)
+                try:
+                    lease.acquire()
+                    thread_env = lease.thread_env()
+                except OSError as e:
+                    logging.warning(f"Could not lease CPUs, the job is not pinned: {e}")
+                    lease = None
+            with tracer.span("spawn"):
+                if getattr(configuration, "zygote_enabled", False):
+                    proc = zygote_submission(
+                        configuration, script, [input_file, f"{output_dir}/"], output_dir, logFile, errFile, thread_env
+                    )
+                if proc is None:
+                    proc = subprocess.Popen(
+                        cmd,
+                        shell=True,
+                        stdin=subprocess.PIPE,
+                        stdout=logFile,
+                        stderr=errFile,
+                        universal_newlines=True,
+                        cwd=output_dir,
+                        env=dict(os.environ, **thread_env) if thread_env else None,
+                    )
+                if lease is not None:
+                    set_affinity(proc.pid, lease.cpus)
             start_time = time.time()
-            proc_psutil = psutil.Process(proc.pid)
+            last_rebalance = start_time
 
             # Monitor the elapsed time and the total memory usage of the subprocess and its children
-            try:
-                terminate = False
-                while proc.poll() is None:  # process is still running
-                    total_mem_usage_mb = get_total_memory_usage(proc_psutil) * CONVERSION_FACTOR_BYTES_TO_MB
-                    elapsed_time = time.time() - start_time
-                    logging.debug(f"Subprocess memory usage: {total_mem_usage_mb} MiB. Max limit: {mem_limit_mb} MiB.")
-                    logging.debug(f"Elapsed time: {elapsed_time} s. Max time limit: {time_limit_sec} s.")
-
-                    if total_mem_usage_mb > mem_limit_mb:
-                        err_message = f"Total memory usage exceeded limit ({total_mem_usage_mb / 1024:2f} GiB > {mem_limit_mb / 1024:2f} GiB). Terminating job."
-                        terminate = True
-                    elif elapsed_time > time_limit_sec:
-                        err_message = (
-                            f"Time limit exceeded ({elapsed_time:2f} s > {time_limit_sec:2f} s). Terminating job."
+            with tracer.span("supervise"):
+                try:
+                    proc_psutil = psutil.Process(proc.pid)
+                    while proc.poll() is None:  # process is still running
+                        total_mem_usage_mb = get_total_memory_usage(proc_psutil) * CONVERSION_FACTOR_BYTES_TO_MB
+                        elapsed_time = time.time() - start_time
+                        logging.debug(
+                            f"Subprocess memory usage: {total_mem_usage_mb} MiB. Max limit: {mem_limit_mb} MiB."
                         )
-                        terminate = True
+                        logging.debug(f"Elapsed time: {elapsed_time} s. Max time limit: {time_limit_sec} s.")
+
+                        if total_mem_usage_mb > mem_limit_mb:
+                            err_message = f"Total memory usage exceeded limit ({total_mem_usage_mb / 1024:2f} GiB > {mem_limit_mb / 1024:2f} GiB). Terminating job."
+                            termination = TERMINATED_MEMORY_LIMIT
+                        elif elapsed_time > time_limit_sec:
+                            err_message = (
+                                f"Time limit exceeded ({elapsed_time:2f} s > {time_limit_sec:2f} s). Terminating job."
+                            )
+                            termination = TERMINATED_TIME_LIMIT
+
+                        if termination is not None:
+                            logging.warning(err_message)
+                            # Terminate process and its child processes
+                            terminate_or_kill_process_tree(proc.pid)
+                            # Add message in the run reduction error log file
+                            errFile.write(err_message)
+                            break
+
+                        if lease is not None and time.time() - last_rebalance > CPU_REBALANCE_INTERVAL:
+                            last_rebalance = time.time()
+                            cpus = lease.rebalance()
+                            if cpus is not None:
+                                set_affinity(proc.pid, cpus)
+
+                        time.sleep(configuration.mem_check_interval_sec)
+
+                    proc.wait()
+                    if getattr(proc, "lost", False) and termination is None:
+                        # the exit code of the job went with the zygote
+                        errFile.write(
+                            f"Lost the zygote running the reduction (process {proc.pid}): exit status unknown."
+                        )
+
+                except psutil.NoSuchProcess:
+                    logging.warning("The process has already terminated.")
 
-                    if terminate:
-                        logging.warning(err_message)
-                        # Terminate process and its child processes
-                        terminate_or_kill_process_tree(proc.pid)
-                        # Add message in the run reduction error log file
-                        errFile.write(err_message)
-                        break
+                except Exception as e:
+                    logging.error(f"An error occurred: {e}")
 
-                    time.sleep(configuration.mem_check_interval_sec)
+                finally:
+                    proc.communicate()
+                    if lease is not None:
+                        lease.release()
+    return termination
 
-                proc.wait()
 
+class ZygoteJob:
+    """
+    Reduction forked by a zygote, with the subset of the ``subprocess.Popen``
+    interface used to supervise jobs
+    """
+
+    def __init__(self, connection, pid, buffer=b""):
+        """
+        @param socket connection: connection to the zygote that forked the job
+        @param int pid: process ID of the job
+        @param bytes buffer: data already received from the zygote
+        """
+        self._connection = connection
+        self._buffer = buffer
+        self.pid = pid
+        self.returncode = None
+        # whether the zygote went away before reporting the exit code, the job being supervised directly then
+        self.lost = False
+        self._process = None
+        self._parse()
+
+    def poll(self):
+        """
+        Check whether the job finished without blocking
+        @return int: exit code, or None if the job is still running
+        """
+        if self.returncode is None and self.lost:
+            self._check_process()
+        elif self.returncode is None:
+            self._connection.setblocking(False)
+            try:
+                self._receive()
+            except BlockingIOError:
+                pass
+        return self.returncode
+
+    def wait(self):
+        """
+        Wait for the job to finish
+        @return int: exit code
+        """
+        if self.returncode is None:
+            self._connection.setblocking(True)
+            while self.returncode is None and not self.lost:
+                self._receive()
+        while self.poll() is None:
+            time.sleep(ZYGOTE_LOST_POLL_INTERVAL)
+        return self.returncode
+
+    def communicate(self):
+        """
+        Wait for the job and release the connection to the zygote
+        """
+        self.wait()
+        self._connection.close()
+        return None, None
+
+    def _receive(self):
+        chunk = self._connection.recv(4096)
+        if not chunk:
+            # the zygote went away before reporting the exit code: the job keeps running in its own
+            # process group, and is supervised until it exits
+            logging.error("Lost connection to the zygote running process %s", self.pid)
+            self.lost = True
+            try:
+                self._process = psutil.Process(self.pid)
             except psutil.NoSuchProcess:
-                logging.warning("The process has already terminated.")
+                self.returncode = -1
+            return
+        self._buffer += chunk
+        self._parse()
+
+    def _check_process(self):
+        try:
+            running = self._process.is_running() and self._process.status() != psutil.STATUS_ZOMBIE
+        except psutil.NoSuchProcess:
+            running = False
+        if not running:
+            # exit code unknown
+            self.returncode = -1
+
+    def _parse(self):
+        while b"\n" in self._buffer:
+            line, self._buffer = self._buffer.split(b"\n", 1)
+            message = json.loads(line)
+            if "returncode" in message:
+                self.returncode = message["returncode"]
+
+
+def get_zygote_socket_path(configuration, conda_env):
+    """
+    Get the path of the socket of the zygote serving a conda environment
+    @param Configuration configuration: configuration
+    @param str conda_env: name of the conda environment
+    @return str: path of the Unix socket
+    """
+    return os.path.join(configuration.zygote_socket_dir, f"reduction_zygote_{conda_env}.sock")
+
+
+def start_zygote(configuration, conda_env, socket_path):
+    """
+    Start a zygote for a conda environment in the background. The zygote outlives the
+    job that started it and exits by itself after being idle for a while.
+    @param Configuration configuration: configuration
+    @param str conda_env: name of the conda environment
+    @param str socket_path: path of the Unix socket the zygote will listen on
+    """
+    from scripts import mantidpython
+
+    zygote_script = os.path.join(os.path.dirname(mantidpython.__file__), ZYGOTE_SCRIPT)
+    cmd = [
+        mantidpython.NSD_CONDA_WRAP,
+        conda_env,
+        "--classic",
+        zygote_script,
+        "--idle-timeout",
+        str(configuration.zygote_idle_timeout_sec),
+        socket_path,
+    ]
+    cmd.extend(configuration.zygote_preload)
+    logging.info("Starting zygote for conda environment %s: %s", conda_env, " ".join(cmd))
+    try:
+        subprocess.Popen(
+            cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+    except OSError as e:
+        logging.error("Could not start zygote for conda environment %s: %s", conda_env, e)
+
+
+def zygote_submission(configuration, script, args, output_dir, logFile, errFile, env=None):
+    """
+    Fork the reduction from the pre-warmed interpreter of its conda environment.
+    When no zygote is running for that environment, one is started for the next jobs
+    and this job falls back to a regular subprocess.
+    @param configuration: configuration object
+    @param script: full path to the reduction script to run
+    @param list args: arguments passed to the script
+    @param output_dir: reduction output directory
+    @param logFile: open reduction log file
+    @param errFile: open reduction error file
+    @param dict env: variables added to the environment of the job
+    @return ZygoteJob: forked job, or None if the job could not be forked
+    """
+    from scripts.mantidpython import get_conda_env
+
+    try:
+        with open(script, "r") as script_file:
+            conda_envs = {get_conda_env(line) for line in script_file} - {None}
+    except OSError:
+        return None
+    if len(conda_envs) != 1:
+        # let mantidpython.py report the error
+        return None
+    conda_env = conda_envs.pop()
+
+    socket_path = get_zygote_socket_path(configuration, conda_env)
+    try:
+        # never hand the job files over to a socket owned by somebody else
+        if os.stat(socket_path).st_uid != os.getuid():
+            logging.error("Zygote socket %s is not owned by the current user", socket_path)
+            return None
+    except FileNotFoundError:
+        start_zygote(configuration, conda_env, socket_path)
+        return None
 
-            except Exception as e:
-                logging.error(f"An error occurred: {e}")
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+        request = {
+            "script": str(script),
+            "args": [str(arg) for arg in args],
+            "cwd": str(output_dir),
+            "env": dict(env or {}),
+        }
+        socket.send_fds(connection, [json.dumps(request).encode()], [logFile.fileno(), errFile.fileno()])
+        connection.settimeout(30.0)
+        reply = b""
+        while not reply.endswith(b"\n"):
+            chunk = connection.recv(4096)
+            if not chunk:
+                raise ConnectionError("zygote closed the connection")
+            reply += chunk
+        message = json.loads(reply.split(b"\n", 1)[0])
+        if "pid" not in message:
+            raise RuntimeError(message.get("error", "unexpected reply"))
+    except (OSError, ValueError, RuntimeError) as e:
+        logging.warning("Zygote for %s unavailable, running job in a new process: %s", conda_env, e)
+        connection.close()
+        if isinstance(e, ConnectionRefusedError):
+            # stale socket
+            start_zygote(configuration, conda_env, socket_path)
+        return None
 
-            finally:
-                proc.communicate()
+    connection.settimeout(None)
+    logging.info("Reduction forked by the %s zygote as process %s", conda_env, message["pid"])
+    # the reply may already hold the exit code of a very short job
+    return ZygoteJob(connection, message["pid"], reply.split(b"\n", 1)[1])
 
 
 def determine_success_local(configuration, out_err):
@@ -39,7 +39,8 @@ class ONCatProcessor(BaseProcessor):
         self.send(self.STARTED_QUEUE, json.dumps(self.data))
 
         try:
-            self.ingest(self.data["data_file"])
+            with self.span("ingest"):
+                self.ingest(self.data["data_file"])
         except Exception as e:
             logging.error("Error ingesting data file: %s", e)
             self.data["error"] = f"ONCAT: {e}"
@@ -61,16 +62,19 @@ class ONCatProcessor(BaseProcessor):
         location = location.replace("//", "/")
 
         logging.info("Calling ONCat for %s", location)
-        datafile = oncat.Datafile.ingest(location)
+        with self.span("ingest_datafile"):
+            datafile = oncat.Datafile.ingest(location)
 
-        for related_file in related_files(datafile):
-            # With PyONCat 1.4.0 in Python 2, we need to convert from
-            # unicode to str.  See: #210.
-            logging.info("Calling ONCat for %s", related_file)
-            oncat.Datafile.ingest(related_file)
+        with self.span("ingest_related_files"):
+            for related_file in related_files(datafile):
+                # With PyONCat 1.4.0 in Python 2, we need to convert from
+                # unicode to str.  See: #210.
+                logging.info("Calling ONCat for %s", related_file)
+                oncat.Datafile.ingest(related_file)
 
         # Catalog image files (a VENUS-specific substep), if enabled for this instrument
-        self.catalog_images(oncat, datafile)
+        with self.span("catalog_images"):
+            self.catalog_images(oncat, datafile)
 
     def catalog_images(self, oncat, datafile):
         """Catalog image files using the batch API, if enabled for this instrument.
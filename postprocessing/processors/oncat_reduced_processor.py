@@ -33,7 +33,8 @@ class ONCatProcessor(BaseProcessor):
         reduction_file_path = os.path.join(self.output_dir, reduction_file_name)
 
         try:
-            self.ingest(reduction_file_path)
+            with self.span("ingest"):
+                self.ingest(reduction_file_path)
         except Exception as e:
             logging.error("Error ingesting data file: %s", e)
             self.data["error"] = f"ONCAT: {e}"
@@ -54,14 +55,14 @@ class ONCatProcessor(BaseProcessor):
             logging.info("Could not find %s so will not call ONCat", location)
             return
 
-        with open(location) as f:
+        with self.span("read_reduction_file"), open(location) as f:
             contents = json.load(f)
-            if "input_files" not in contents or "output_files" not in contents:
-                logging.info(
-                    "%s does not appear to be a JSON reduction file so will not call ONCat",
-                    location,
-                )
-                return
+        if "input_files" not in contents or "output_files" not in contents:
+            logging.info(
+                "%s does not appear to be a JSON reduction file so will not call ONCat",
+                location,
+            )
+            return
 
         oncat = pyoncat.ONCat(
             self.configuration.oncat_url,
@@ -69,4 +70,5 @@ class ONCatProcessor(BaseProcessor):
         )
 
         logging.info("Calling ONCat for %s", location)
-        oncat.Reduction.ingest(location)
+        with self.span("ingest_reduction"):
+            oncat.Reduction.ingest(location)
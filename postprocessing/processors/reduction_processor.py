@@ -1,5 +1,6 @@
 from .base_processor import BaseProcessor
 from . import job_handling
+from postprocessing.page_cache import PREWARM_LOG_LINE
 
 import json
 import logging
@@ -15,6 +16,10 @@ class ReductionProcessor(BaseProcessor):
     COMPLETED_QUEUE = "/queue/REDUCTION.COMPLETE"
     ERROR_QUEUE = "/queue/REDUCTION.ERROR"
     DISABLED_QUEUE = "/queue/REDUCTION.DISABLED"
+    # a topic: nothing consumes the rerouted reports yet, and a queue would accumulate them
+    REROUTED_QUEUE = "/topic/REDUCTION.REROUTED"
+    # queue of the reductions terminated for exceeding the memory limit, none to report them as errors
+    REROUTE_QUEUE = "/queue/REDUCTION.HIMEM.DATA_READY"
 
     def __init__(self, data, conf, send_function):
         """
@@ -24,6 +29,10 @@ class ReductionProcessor(BaseProcessor):
         @param send_function: function to call to send AMQ messages
         """
         super().__init__(data, conf, send_function)
+        # copy of the data file on the local scratch of this node, and bytes of the data file read ahead
+        # into its page cache, not reported in the messages
+        self.staged_data_file = self.data.pop("staged_data_file", None)
+        self.prewarmed_bytes = self.data.pop("prewarmed_bytes", None)
 
     def __call__(self):
         """
@@ -32,6 +41,14 @@ class ReductionProcessor(BaseProcessor):
 
         try:
             self.send(ReductionProcessor.STARTED_QUEUE, json.dumps(self.data))
+            if self.configuration.run_metadata_cache_dir:
+                # fill the cache shared with ar_report, which then does not open the data file again
+                with self.span("run_metadata"):
+                    metadata = self.run_metadata()
+                if metadata is not None:
+                    logging.info(
+                        "Run from %s to %s (%.1f s)", metadata.start_time, metadata.end_time, metadata.duration
+                    )
             # get instrument shared directory
             instrument_shared_dir = os.path.join("/", self.facility, self.instrument, "shared", "autoreduce")
             if len(self.configuration.dev_instrument_shared) > 0:
@@ -53,8 +70,15 @@ class ReductionProcessor(BaseProcessor):
 
             # Set logging directory
             log_dir = os.path.join(proposal_shared_dir, "reduction_log")
-            if not os.path.exists(log_dir):
-                os.makedirs(log_dir)
+            with self.span("make_directories"):
+                if not os.path.exists(log_dir):
+                    os.makedirs(log_dir)
+
+            # Read the copy on scratch, unless it was removed meanwhile
+            input_file = self.data_file
+            if self.staged_data_file is not None and os.path.isfile(self.staged_data_file):
+                input_file = self.staged_data_file
+                logging.info("Reading the copy of %s on scratch: %s", self.data_file, input_file)
 
             # Look for run summary script
             summary_script = os.path.join(instrument_shared_dir, f"sumRun_{self.instrument}.py")
@@ -63,9 +87,10 @@ class ReductionProcessor(BaseProcessor):
                     proposal_shared_dir,
                     f"{self.instrument}_{self.proposal}_runsummary.csv",
                 )
-                cmd = "python " + summary_script + " " + self.instrument + " " + self.data_file + " " + summary_output
+                cmd = "python " + summary_script + " " + self.instrument + " " + input_file + " " + summary_output
                 logging.debug(f"Run summary subprocess started: {cmd}")
-                subprocess.call(cmd, shell=True)
+                with self.span("summary_script"):
+                    subprocess.call(cmd, shell=True)
                 logging.debug(f"Run summary subprocess completed, see {summary_output}")
 
             # Look for auto-reduction script
@@ -77,23 +102,36 @@ class ReductionProcessor(BaseProcessor):
             # Run the reduction
             out_log = os.path.join(log_dir, f"{os.path.basename(self.data_file)}.log")
             out_err = os.path.join(log_dir, f"{os.path.basename(self.data_file)}.err")
-            job_handling.local_submission(
-                self.configuration,
-                reduce_script_path,
-                self.data_file,
-                proposal_shared_dir,
-                out_log,
-                out_err,
-            )
+            with self.span("reduction", script=reduce_script_path):
+                termination = job_handling.local_submission(
+                    self.configuration,
+                    reduce_script_path,
+                    input_file,
+                    proposal_shared_dir,
+                    out_log,
+                    out_err,
+                    tracer=self.tracer,
+                )
+            if self.prewarmed_bytes is not None:
+                # reported by ar_report next to the time spent loading the data file
+                with open(out_log, "a") as log_file:
+                    log_file.write(
+                        PREWARM_LOG_LINE.format(
+                            mib=self.prewarmed_bytes / 1024**2, name=os.path.basename(self.data_file)
+                        )
+                    )
 
             # Determine error condition
-            success, status_data = job_handling.determine_success_local(self.configuration, out_err)
+            with self.span("parse_errors"):
+                success, status_data = job_handling.determine_success_local(self.configuration, out_err)
 
             self.data.update(status_data)
             if success:
                 if os.path.isfile(out_err):
                     os.remove(out_err)
                 self.send(ReductionProcessor.COMPLETED_QUEUE, json.dumps(self.data))
+            elif termination == job_handling.TERMINATED_MEMORY_LIMIT and self.reroute(status_data):
+                return
             else:
                 self.send(ReductionProcessor.ERROR_QUEUE, json.dumps(self.data))
         except:  # noqa: E722
@@ -101,6 +139,27 @@ class ReductionProcessor(BaseProcessor):
             self.data["error"] = f"Reduction: {sys.exc_info()[1]} "
             self.send(ReductionProcessor.ERROR_QUEUE, json.dumps(self.data))
 
+    def reroute(self, status_data):
+        """
+        Send a reduction terminated for exceeding the memory limit to the high-memory queue,
+        at most himem_max_reroutes times, and report it as rerouted instead of failed
+        @param status_data: error of the reduction
+        @returns bool: whether the reduction was rerouted
+        """
+        reroutes = int(self.data.get("himem_reroutes", 0))
+        if self.REROUTE_QUEUE is None or reroutes >= self.configuration.himem_max_reroutes:
+            return False
+        # the incoming message, without the error of this attempt
+        message = {key: value for key, value in self.data.items() if key not in status_data}
+        message["himem_reroutes"] = reroutes + 1
+        self.send(self.REROUTE_QUEUE, json.dumps(message))
+        logging.warning("Memory limit exceeded: reduction sent to %s (%s)", self.REROUTE_QUEUE, reroutes + 1)
+
+        self.data.update({"status": "rerouted", "rerouted_to": self.REROUTE_QUEUE, "himem_reroutes": reroutes + 1})
+        self.send(ReductionProcessor.REROUTED_QUEUE, json.dumps(self.data))
+        return True
+
 
 class ReductionProcessorHighMemory(ReductionProcessor):
     _message_queue = "/queue/REDUCTION.HIMEM.DATA_READY"
+    REROUTE_QUEUE = None
@@ -35,13 +35,71 @@ The service sends updates and errors to ActiveMQ
 import json
 import logging
 import os
-import re
 import sys
-import shutil
 import string
-import time
+import tempfile
 import urllib.parse
 
+from postprocessing.parameter_log import ParameterLog
+
+# Compiled templates, keyed by template path: ((mtime, size), string.Template, identifiers)
+_template_cache = {}
+
+
+def get_template_identifiers(template):
+    r"""Names of the placeholders of a template, as ``string.Template.get_identifiers`` returns them
+    @param string.Template template: compiled template
+    @returns frozenset: placeholder names
+    """
+    if hasattr(template, "get_identifiers"):  # python >= 3.11
+        return frozenset(template.get_identifiers())
+    identifiers = set()
+    for match in template.pattern.finditer(template.template):
+        name = match.group("named") or match.group("braced")
+        if name is not None:
+            identifiers.add(name)
+    return frozenset(identifiers)
+
+
+def load_template(template_path):
+    r"""Return the compiled template and its placeholder names, reading the file only when it changed
+    @param str template_path: absolute path to the template file
+    @returns tuple: (string.Template, frozenset of placeholder names)
+    """
+    stat = os.stat(template_path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    cached = _template_cache.get(template_path)
+    if cached is not None and cached[0] == version:
+        return cached[1], cached[2]
+    with open(template_path) as template_file:
+        template = string.Template(template_file.read())
+    identifiers = get_template_identifiers(template)
+    _template_cache[template_path] = (version, template, identifiers)
+    return template, identifiers
+
+
+def write_atomically(file_path, content):
+    r"""Write a file through a temporary file and a rename, so readers never see it half-written
+    @param str file_path: absolute path to the file to write
+    @param str content: contents of the file
+    """
+    directory = os.path.dirname(file_path)
+    try:
+        mode = os.stat(file_path).st_mode & 0o777
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(file_path)}.")
+    try:
+        with os.fdopen(fd, "w") as tmp_file:
+            tmp_file.write(content)
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
 
 class ScriptWriter:
     """
@@ -57,7 +115,7 @@ class ScriptWriter:
     # Path of the autoreduction directory
     _autoreduction_dir = "/SNS/%s/shared/autoreduce"
     # Log file
-    _log_file = "reduction_parameters.txt"
+    _log_file = "reduction_parameters.jsonl"
 
     def __init__(self, instrument):
         """
@@ -72,8 +130,6 @@ class ScriptWriter:
         self.template_name = self._template_name % instrument.upper()
         # Default reduction script name
         self.default_script_name = self._default_script_name % instrument.upper()
-        # Content of the template
-        self._template_content = None
         # Shared autoredudction directory
         self.autoreduction_dir = self._autoreduction_dir % instrument.upper()
 
@@ -91,13 +147,8 @@ class ScriptWriter:
         """
         Return a list of template arguments
         """
-        if self._template_content is None:
-            with open(self._template_path) as template_file:
-                self._template_content = template_file.read()
-
-        tag_list = re.findall(r"\$(\w+)", self._template_content)
-        tag_list.extend(re.findall(r"\${(\w+)}", self._template_content))
-        return set(tag_list)
+        _, identifiers = load_template(self._template_path)
+        return set(identifiers)
 
     def check_arguments(self, **template_args):
         """
@@ -106,10 +157,8 @@ class ScriptWriter:
 
         @param template_args: dictionary of arguments to fill the template
         """
-        missing_args = []
-        for item in self.get_arguments():
-            if item not in template_args:
-                missing_args.append(item)
+        _, identifiers = load_template(self._template_path)
+        missing_args = sorted(identifiers.difference(template_args))
         if len(missing_args) > 0:
             raise KeyError(f"Template arguments missing: {missing_args}")
 
@@ -119,39 +168,22 @@ class ScriptWriter:
         @raises KeyError: if missing template arguments
         """
         self.check_arguments(**template_args)
-        # If we use a template, make sure we load it first
-        if self._template_content is None:
-            with open(self._template_path) as template_file:
-                self._template_content = template_file.read()
         # Replace the dictionary entries
-        template = string.Template(self._template_content)
+        template, _ = load_template(self._template_path)
         script = template.substitute(**template_args)
         # Write the script
         if os.path.isdir(self.autoreduction_dir):
-            with open(os.path.join(self.autoreduction_dir, self.script_name), "w") as script_file:
-                script_file.write(script)
+            write_atomically(os.path.join(self.autoreduction_dir, self.script_name), script)
         else:
             raise RuntimeError(f"Script directory does not exist: {self.autoreduction_dir}")
 
     def log_entry(self, **template_args):
         r"""Log the template parameters in the reduction directory.
-        @details The log file is tab delimited.
+        @details The log file is an append-only JSON Lines file, see ParameterLog.
         @param dic template_args: arguments to fill the template
         """
         try:
-            template_keys = sorted(template_args.keys())
-            template_values = [str(template_args[k]).replace("\n", "; ") for k in template_keys]
-            template_keys.insert(0, "Time")
-            template_values.insert(0, str(time.ctime()))
-            log_entry = ""
-            # If the file doesn't exist, create it with a header line
-            if not os.path.isfile(self.log_file):
-                log_entry = "\t ".join(template_keys)
-                log_entry += "\n"
-            log_entry += "\t ".join(template_values)
-            log_entry += "\n"
-            with open(self.log_file, "a") as log_file:
-                log_file.write(log_entry)
+            ParameterLog(self.log_file).append(template_args, instrument=self.instrument.upper())
         except Exception:
             logging.error(
                 "ScriptWriter: Could not write log entry for %s: %s",
@@ -159,6 +191,13 @@ class ScriptWriter:
                 sys.exc_info()[1],
             )
 
+    def parameters_at(self, timestamp):
+        r"""Return the template parameters in effect at a given time
+        @param float timestamp: time, in seconds since the epoch
+        @returns dict: template parameters, or None if no script was written before that time
+        """
+        return ParameterLog(self.log_file).parameters_at(timestamp)
+
     def process_request(self, request_data, configuration, send_function):
         r"""Process a request to write a new reduction script from an existing template
         @param dict request_data: request dictionary with template arguments
@@ -193,17 +232,18 @@ class ScriptWriter:
                         raise RuntimeError(
                             f"ScriptWriter: Could not find script {self.default_script_name}",
                         )
-                    shutil.copy(
-                        default_script_path,
-                        os.path.join(self.autoreduction_dir, self.script_name),
-                    )
+                    with open(default_script_path) as default_script:
+                        write_atomically(
+                            os.path.join(self.autoreduction_dir, self.script_name),
+                            default_script.read(),
+                        )
                     amq_data["status"] = "Installed default %s script" % request_data["instrument"]
                 else:
                     # Verify that the template file exists
                     if not os.path.isfile(self._template_path):
                         raise RuntimeError(f"ScriptWriter: Could not find template {self.template_name}")
 
-                    self.check_arguments(**template_data)
+                    # write_script verifies that the template arguments are complete
                     self.write_script(**template_data)
                     amq_data["status"] = "Created %s reduction script" % request_data["instrument"]
                 self.log_entry(**template_data)
@@ -0,0 +1,123 @@
+"""
+Run metadata read from the header of NeXus event files.
+
+Only three small scalars of ``/entry`` are needed (start time, end time and
+duration), so the file is opened for metadata only: the raw data chunk cache is
+disabled and each dataset is read with a single call. Event files are large and
+live on a busy shared filesystem, so the results are cached, in memory and
+optionally in a directory shared by the post-processing agent and ``ar_report``,
+keyed by file path, size and modification time.
+
+@copyright: 2026 Oak Ridge National Laboratory
+"""
+
+from collections import namedtuple
+import hashlib
+import json
+import logging
+import os
+
+RunMetadata = namedtuple("RunMetadata", ["start_time", "end_time", "duration"])
+
+
+def _scalar(dataset):
+    """First element of a small dataset, read in one call"""
+    value = dataset[()]
+    if getattr(value, "ndim", 0) > 0:
+        value = value[0]
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+    return value
+
+
+def read_header(filename):
+    r"""Read the run metadata from the header of a NeXus event file
+    @param str filename: path to the event file
+    @returns RunMetadata: start time, end time and duration (seconds) of the run
+    """
+    # imported here: h5py is slow to import and most tasks never read the header of the event file
+    try:
+        import h5py
+    except ImportError as e:
+        raise RuntimeError("h5py is required to read NeXus files") from e
+    # no raw data chunk cache: only the metadata of /entry is read
+    with h5py.File(filename, "r", rdcc_nbytes=0, rdcc_nslots=1, rdcc_w0=0) as handle:
+        entry = handle["entry"]
+        return RunMetadata(
+            start_time=str(_scalar(entry["start_time"])),
+            end_time=str(_scalar(entry["end_time"])),
+            duration=float(_scalar(entry["duration"])),
+        )
+
+
+class RunMetadataCache:
+    """
+    Run metadata by event file, read again only when the file changes
+    """
+
+    def __init__(self, cache_dir=""):
+        """
+        @param str cache_dir: directory where to share the metadata between processes, none if empty
+        """
+        self.cache_dir = cache_dir
+        self._memory = {}
+
+    def _cache_file(self, filename):
+        digest = hashlib.sha1(filename.encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}.json")
+
+    def get(self, filename):
+        r"""Return the metadata of a run
+        @param str filename: path to the event file
+        @returns RunMetadata: start time, end time and duration of the run
+        """
+        filename = os.path.abspath(str(filename))
+        stat = os.stat(filename)
+        version = [stat.st_size, stat.st_mtime_ns]
+
+        cached = self._memory.get(filename)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        if self.cache_dir:
+            try:
+                with open(self._cache_file(filename), "r") as cache_file:
+                    contents = json.load(cache_file)
+                if contents["path"] == filename and contents["version"] == version:
+                    metadata = RunMetadata(**contents["metadata"])
+                    self._memory[filename] = (version, metadata)
+                    return metadata
+            except (OSError, ValueError, KeyError, TypeError):
+                pass  # not cached yet, or cached by an older version
+
+        metadata = read_header(filename)
+        self._memory[filename] = (version, metadata)
+        if self.cache_dir:
+            self._store(filename, version, metadata)
+        return metadata
+
+    def _store(self, filename, version, metadata):
+        cache_file = self._cache_file(filename)
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(tmp_file, "w") as handle:
+                json.dump({"path": filename, "version": version, "metadata": metadata._asdict()}, handle)
+            os.replace(tmp_file, cache_file)
+        except OSError as e:
+            logging.warning("Could not cache the run metadata of %s: %s", filename, e)
+
+
+# One cache per directory, shared by everything in the process
+_caches = {}
+
+
+def read_run_metadata(filename, cache_dir=""):
+    r"""Return the start time, end time and duration of a run, from the cache when possible
+    @param str filename: path to the event file
+    @param str cache_dir: directory where to share the metadata between processes, none if empty
+    @returns RunMetadata: start time, end time and duration of the run
+    """
+    if cache_dir not in _caches:
+        _caches[cache_dir] = RunMetadataCache(cache_dir)
+    return _caches[cache_dir].get(filename)
@@ -0,0 +1,227 @@
+"""
+Staging of the input files of the jobs on local scratch.
+
+While a reduction waits for a free slot, its data file is copied from the shared filesystem
+to a local scratch directory by a small pool of copier threads, throttled to a bandwidth
+shared by all the copies. If the copy is complete when the job starts, the job reads the
+local copy; otherwise the copy is abandoned and the job reads the shared file.
+The copies are kept for the next jobs of the same run, as long as the size and the
+modification time of the shared file do not change, and the least recently used ones
+are removed to keep the scratch directory within its budget. The copies in use by a job
+are never removed.
+
+@copyright: 2026 Oak Ridge National Laboratory
+"""
+
+import collections
+import hashlib
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Size of the blocks copied at once (bytes)
+COPY_BLOCK_SIZE = 8 * 1024**2
+# Suffix of the copies in progress
+PARTIAL_SUFFIX = ".part"
+
+
+class StagingCancelled(Exception):
+    """
+    The copy was abandoned before it completed
+    """
+
+
+class Throttle:
+    """
+    Bandwidth shared by several threads
+    """
+
+    def __init__(self, bandwidth_bytes=0):
+        """
+        @param int bandwidth_bytes: maximum bytes per second, 0 for no limit
+        """
+        self.bandwidth_bytes = bandwidth_bytes
+        self.lock = threading.Lock()
+        self._next_transfer = 0.0
+
+    def wait(self, size):
+        r"""Wait so that all the transfers stay within the bandwidth
+        @param int size: bytes about to be transferred
+        """
+        if self.bandwidth_bytes <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(self._next_transfer, now)
+            self._next_transfer = start + size / self.bandwidth_bytes
+        if start > now:
+            time.sleep(start - now)
+
+
+class ScratchStager:
+    """
+    Copies input files to local scratch, within a disk-space budget
+    """
+
+    def __init__(self, scratch_dir, budget_bytes, workers=2, bandwidth_bytes=0):
+        """
+        @param str scratch_dir: local directory of the copies
+        @param int budget_bytes: maximum total size of the copies
+        @param int workers: number of files copied at the same time
+        @param int bandwidth_bytes: maximum bytes per second for all the copies, 0 for no limit
+        """
+        self.scratch_dir = scratch_dir
+        self.budget_bytes = budget_bytes
+        self.throttle = Throttle(bandwidth_bytes)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="scratch")
+        self.lock = threading.Lock()
+        # number of jobs using each copy
+        self.in_use = collections.Counter()
+        # copies in progress, by local path
+        self.copies = {}
+
+    def local_path(self, source):
+        r"""Path of the copy of a file, keeping its name for the scripts reading it
+        @param str source: file on the shared filesystem
+        @returns str: path of the copy on scratch
+        """
+        directory = hashlib.sha1(os.path.dirname(os.path.abspath(source)).encode()).hexdigest()[:16]
+        return os.path.join(self.scratch_dir, directory, os.path.basename(source))
+
+    def stage(self, source):
+        r"""Start copying a file to scratch, unless a complete copy is already there
+        @param str source: file on the shared filesystem
+        @returns Future: resolved with the path of the copy
+        """
+        local = self.local_path(source)
+        with self.lock:
+            if local in self.copies:
+                return self.copies[local][0]
+            if self._is_complete(source, local):
+                future = Future()
+                future.set_result(local)
+                return future
+            cancel = threading.Event()
+            future = self.executor.submit(self._copy, source, local, cancel)
+            self.copies[local] = (future, cancel)
+        future.add_done_callback(lambda _: self._forget(local))
+        return future
+
+    def acquire(self, future):
+        r"""Take the copy for a job, abandoning it if it is not complete
+        @param Future future: returned by stage()
+        @returns str: path of the copy, None to read the shared file
+        """
+        if not future.done():
+            with self.lock:
+                for local, (copy, cancel) in self.copies.items():
+                    if copy is future:
+                        cancel.set()
+            return None
+        if future.cancelled() or future.exception() is not None:
+            return None
+        local = future.result()
+        with self.lock:
+            if not os.path.isfile(local):
+                return None
+            self.in_use[local] += 1
+            # most recently used, for the eviction, keeping the modification time of the source
+            os.utime(local, ns=(time.time_ns(), os.stat(local).st_mtime_ns))
+        return local
+
+    def release(self, local):
+        r"""The job using a copy finished
+        @param str local: path returned by acquire()
+        """
+        with self.lock:
+            self.in_use[local] -= 1
+            if self.in_use[local] <= 0:
+                del self.in_use[local]
+
+    def usage(self):
+        r"""Copies on scratch
+        @returns list: (last use, size, path) of the copies, least recently used first
+        """
+        files = []
+        for root, _, names in os.walk(self.scratch_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_atime, stat.st_size, path))
+        return sorted(files)
+
+    def _forget(self, local):
+        with self.lock:
+            self.copies.pop(local, None)
+
+    @staticmethod
+    def _is_complete(source, local):
+        r"""Whether the copy matches the shared file, which may have been written again since
+        @param str source: file on the shared filesystem
+        @param str local: copy on scratch, with the modification time of the source
+        """
+        try:
+            source_stat = os.stat(source)
+            local_stat = os.stat(local)
+        except OSError:
+            return False
+        return local_stat.st_size == source_stat.st_size and local_stat.st_mtime_ns == source_stat.st_mtime_ns
+
+    def _reserve(self, size):
+        r"""Remove the least recently used copies to make room for a new one
+        @param int size: size of the new copy
+        """
+        with self.lock:
+            if size > self.budget_bytes:
+                raise OSError(f"File of {size} bytes larger than the scratch budget")
+            files = self.usage()
+            used = sum(file_size for _, file_size, _ in files)
+            for _, file_size, path in files:
+                if used + size <= self.budget_bytes:
+                    break
+                # the copies in progress, but not those left behind by a previous agent
+                if path in self.in_use or (
+                    path.endswith(PARTIAL_SUFFIX) and path[: -len(PARTIAL_SUFFIX)] in self.copies
+                ):
+                    continue
+                try:
+                    os.remove(path)
+                    used -= file_size
+                    logging.info("Scratch copy removed: %s", path)
+                except OSError as e:
+                    logging.warning("Could not remove the scratch copy %s: %s", path, e)
+            if used + size > self.budget_bytes:
+                raise OSError("Scratch budget used by the copies in use")
+
+    def _copy(self, source, local, cancel):
+        started = time.monotonic()
+        source_stat = os.stat(source)
+        self._reserve(source_stat.st_size)
+        os.makedirs(os.path.dirname(local), exist_ok=True)
+        partial = local + PARTIAL_SUFFIX
+        try:
+            with open(source, "rb") as reader, open(partial, "wb") as writer:
+                while True:
+                    if cancel.is_set():
+                        raise StagingCancelled(source)
+                    block = reader.read(COPY_BLOCK_SIZE)
+                    if not block:
+                        break
+                    self.throttle.wait(len(block))
+                    writer.write(block)
+            # a source written again during the copy is copied again by the next job
+            os.utime(partial, ns=(time.time_ns(), source_stat.st_mtime_ns))
+            os.replace(partial, local)
+        except BaseException:
+            try:
+                os.remove(partial)
+            except OSError:
+                pass
+            raise
+        logging.info("Staged %s to %s in %.1f s", source, local, time.monotonic() - started)
+        return local
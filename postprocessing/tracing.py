@@ -0,0 +1,104 @@
+"""
+Timing spans of the post-processing tasks.
+
+A task opens a span around each of its phases (checking the data file, running the
+reduction, parsing its errors, sending messages...):
+
+    with tracer.span("reduction"):
+        ...
+
+Spans nest, and their durations are summarized by path ("reduction/supervise") to be
+attached to the messages sent when the task completes. They can also be written as a
+trace file in the Chrome trace event format, which chrome://tracing and
+https://ui.perfetto.dev display as a timeline. When tracing is disabled, ``span``
+returns a shared no-op context manager.
+
+@copyright: 2026 Oak Ridge National Laboratory
+"""
+
+from contextlib import contextmanager
+import json
+import os
+import time
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Tracer:
+    """
+    Records the duration of nested spans
+    """
+
+    def __init__(self, enabled=False):
+        """
+        @param bool enabled: whether to record the spans
+        """
+        self.enabled = enabled
+        # (path, start time in seconds since the epoch, duration in seconds, attributes)
+        self.spans = []
+        self._stack = []
+
+    def span(self, name, **attributes):
+        r"""Time a block of code
+        @param str name: name of the phase
+        @param attributes: details of the phase, written to the trace file
+        @returns: context manager
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return self._span(name, attributes)
+
+    @contextmanager
+    def _span(self, name, attributes):
+        self._stack.append(name)
+        path = "/".join(self._stack)
+        start_time = time.time()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans.append((path, start_time, time.perf_counter() - start, attributes))
+            self._stack.pop()
+
+    def summary(self):
+        r"""Total duration of the spans, by path
+        @returns dict: seconds spent in each phase, for instance {"reduction": 12.3, "reduction/supervise": 12.1}
+        """
+        totals = {}
+        for path, _, duration, _ in self.spans:
+            totals[path] = totals.get(path, 0.0) + duration
+        return {path: round(duration, 6) for path, duration in totals.items()}
+
+    def write(self, trace_file):
+        r"""Write the spans in the Chrome trace event format
+        @param str trace_file: path of the trace file
+        """
+        pid = os.getpid()
+        events = [
+            {
+                "name": path.rsplit("/", 1)[-1],
+                "cat": "postprocessing",
+                "ph": "X",
+                "ts": int(start * 1e6),
+                "dur": int(duration * 1e6),
+                "pid": pid,
+                "tid": 0,
+                "args": dict(attributes, path=path),
+            }
+            for path, start, duration, attributes in self.spans
+        ]
+        with open(trace_file, "w") as handle:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, handle, default=str)
+
+
+# Tracer of the code that is not given one
+NULL_TRACER = Tracer(enabled=False)
@@ -1,16 +1,23 @@
 #!/usr/bin/env python3
 from __future__ import absolute_import, division, print_function, unicode_literals
-import h5py
+import bisect
+import concurrent.futures
+import json
 import os
 from datetime import datetime, timedelta
 
+from postprocessing.run_metadata import read_run_metadata
+
 __version__ = "0.0.1"
 
 REDUCTION_LOG = "reduction_log"
 THE_FUTURE = "2300-01-01T00:00"
 
-shareddirlist = []
-reduceloglist = []
+# directory listings of the proposal being reported, shared by all the runs
+shareddirlist = None
+reduceloglist = None
+# directory of the run metadata cache shared with the post-processing agent, none if empty
+metadatacachedir = ""
 
 
 class GenericFile:
@@ -73,6 +80,7 @@ class ReductionLogFile(GenericFile):
         self.longestAlgorithm = "UNKNOWN"
         self.loadDurationTotal = 0.0
         self.loadEventNexusDuration = 0.0
+        self.prewarmedMiB = 0.0
         self.firstAlgName = "UNKNOWN"
         self.firstAlgStart = "UNKNOWN"
         self.lastAlgName = "UNKNOWN"
@@ -83,11 +91,7 @@ class ReductionLogFile(GenericFile):
         if not bool(self):  # something wrong with the log
             return
 
-        self.__findMantidVersion()
-        self.__findLongestDuration()
-        self.__findLoadNexusTotal(eventfilename)
-        self.__findLoadTotal()
-        self.__estimateReductionTime()
+        self.__parse(eventfilename)
 
     def durationToHuman(duration):
         (hours, minutes, seconds) = (0.0, 0.0, duration)
@@ -99,44 +103,56 @@ class ReductionLogFile(GenericFile):
                 minutes = minutes % 60
         return f"{hours}h{minutes:02}m{int(seconds):02}s"
 
-    def __findLoadNexusTotal(self, eventfilename):
+    def __parse(self, eventfilename):
+        """Collect everything reported about the log in a single pass over the file"""
+        eventnexus = f"{eventfilename}.nxs.h5"
+        lookForDuration = False  # the last Load was of the event nexus file
+        algName = ""
+        algStart = None
         with open(self.filename, "r") as handle:
-            lookForDuration = False
             for line in handle:
-                if line.startswith("Load") and (f"{eventfilename}.nxs.h5" or f"{eventfilename}_event.nxs") in line:
+                stripped = line.strip()
+                if not stripped:
+                    continue  # skip empty lines
+
+                # mantid version and where the reduction ran
+                if "This is Mantid version" in stripped:
+                    self.mantidVersion = stripped.split("This is Mantid version")[-1]
+                    self.mantidVersion = self.mantidVersion.strip().split()[0]
+                if "running on" in stripped and "starting" in stripped:
+                    words = stripped.split()
+                    self.host = words[-3]
+                    self.started = words[-1]
+
+                hasDuration = self.hasLogDuration(line)
+                if hasDuration:
+                    (algorithm, duration) = self.logDurationToNameAndSeconds(stripped)
+                    # longest running algorithm
+                    if duration > self.longestDuration:
+                        self.longestDuration = duration
+                        self.longestAlgorithm = algorithm
+                    # time spent loading
+                    if line.startswith("Load"):
+                        self.loadDurationTotal += duration
+
+                # time spent loading the event nexus file
+                if line.startswith("Load") and eventnexus in line:
                     lookForDuration = True
-                elif lookForDuration and self.hasLogDuration(line):
-                    (_, duration) = self.logDurationToNameAndSeconds(line)
+                elif lookForDuration and hasDuration:
                     if duration > 0.0:
                         self.loadEventNexusDuration += duration
                     lookForDuration = False
 
-    def __findLoadTotal(self):
-        self.loadDurationTotal = 0.0
+                # event nexus file read ahead into the page cache by the post-processing agent
+                if stripped.startswith("PageCache-") and "Prewarmed" in stripped:
+                    self.prewarmedMiB += float(stripped.split("Prewarmed")[-1].split()[0])
 
-        with open(self.filename, "r") as handle:
-            for line in handle:
-                if not self.hasLogDuration(line):
-                    continue
-                if not line.startswith("Load"):
-                    continue
-                line = line.strip()
-                (_, duration) = self.logDurationToNameAndSeconds(line)
-                self.loadDurationTotal += duration
-
-    def __estimateReductionTime(self):
-        with open(self.filename, "r") as handle:
-            algName = ""
-            algStart = None
-            for line in handle:
-                line = line.strip()
-                if not line:
-                    continue
-                if "Execution Date:" in line:
-                    algName = line.split("-")[0]
+                # first and last algorithms, to estimate the reduction time
+                if "Execution Date:" in stripped:
+                    algName = stripped.split("-")[0]
 
                     # very convoluted way to get datetime in python 3.6
-                    algStart = line.split("Execution Date:")[-1].strip()
+                    algStart = stripped.split("Execution Date:")[-1].strip()
                     algStart, fraction = algStart.split(".")  # strptime doesn't like decimals in seconds
                     # datetime.fromisoformat isn't available in python3.6
                     algStart = datetime.strptime(algStart, r"%Y-%m-%d %H:%M:%S")
@@ -144,10 +160,9 @@ class ReductionLogFile(GenericFile):
                     if self.firstAlgName == "UNKNOWN":
                         self.firstAlgName = algName
                         self.firstAlgStart = algStart
-                elif self.hasLogDuration(line):
-                    if algName and line.startswith(algName):
+                elif hasDuration:
+                    if algName and stripped.startswith(algName):
                         self.lastAlgName = algName
-                        (_, duration) = self.logDurationToNameAndSeconds(line)
                         self.lastAlgFinish = algStart + timedelta(seconds=duration)
                         algName = ""  # clear it out for the next round
 
@@ -181,46 +196,24 @@ class ReductionLogFile(GenericFile):
 
         return (algorithm, duration)
 
-    def __findLongestDuration(self):
-        with open(self.filename, "r") as handle:
-            for line in handle:
-                if self.hasLogDuration(line):
-                    line = line.strip()
-                    (algorithm, duration) = self.logDurationToNameAndSeconds(line)
-
-                    if duration > self.longestDuration:
-                        self.longestDuration = duration
-                        self.longestAlgorithm = algorithm
-
-    def __findMantidVersion(self):
-        with open(self.filename, "r") as handle:
-            for line in handle:
-                line = line.strip()
-                if not line:
-                    continue  # skip empty lines
-                if "This is Mantid version" in line:
-                    self.mantidVersion = line.split("This is Mantid version")[-1]
-                    self.mantidVersion = self.mantidVersion.strip().split()[0]
-                if "running on" in line and "starting" in line:
-                    line = line.split()
-
-                    self.host = line[-3]
-                    self.started = line[-1]
-
 
 class ARstatus:
-    def __init__(self, direc, eventfile):
+    def __init__(self, direc, eventfile, shareddirlist=None, reduceloglist=None):
+        """
+        The directory listings can be passed in, so that they are read only once for a whole proposal
+        instead of once per run. The reduction log listing must be sorted.
+        """
         self.eventfile = eventfile
-        shareddirlist = os.listdir(direc)
+        if shareddirlist is None:
+            shareddirlist = os.listdir(direc)
         self.reduxfiles = [os.path.join(direc, name) for name in shareddirlist if eventfile.isThisRun(name)]
 
         logdir = os.path.join(direc, REDUCTION_LOG)
-        os.path.join(logdir, eventfile.shortname)
+        if reduceloglist is None:
+            reduceloglist = listdir(logdir)
 
         self.logfiles = [
-            os.path.join(logdir, filename)
-            for filename in os.listdir(logdir)
-            if filename.startswith(eventfile.shortname)
+            os.path.join(logdir, filename) for filename in startingWith(reduceloglist, eventfile.shortname)
         ]
         self.logfiles = [ReductionLogFile(filename, eventfile.shortname) for filename in self.logfiles]
 
@@ -291,6 +284,13 @@ class ARstatus:
             total += float(logfile.loadEventNexusDuration)
         return total
 
+    @property
+    def prewarmedMiB(self):
+        total = 0.0
+        for logfile in self.logfiles:
+            total += float(logfile.prewarmedMiB)
+        return total
+
     @property
     def reduxTime(self):
         """This estimates the time for autoreduction to be the time between when mantid was first imported and
@@ -329,6 +329,7 @@ class ARstatus:
             "loadNexusSecTotal",
             "reduxEstTime",
             "meas-redux",
+            "prewarmMiB",
         )
 
     def report(self):
@@ -351,23 +352,26 @@ class ARstatus:
             f"{self.loadEventNexusDuration:.1f}",
             f"{reduxTime:.1f}",
             f"{self.eventfile.duration - reduxTime:.1f}",
+            f"{self.prewarmedMiB:.1f}",
         )
 
 
+def runPrefix(filename):
+    """Prefix shared by the event file of a run and its reduced files, normally <instr>_<runnum>"""
+    return filename.replace(".nxs.h5", "").replace("_event.nxs", "")
+
+
 class EventFile(GenericFile):
     def __init__(self, direc, filename):
         super().__init__(os.path.join(direc, filename))
         self.shortname = filename
-        self.prefix = filename.replace(".nxs.h5", "").replace("_event.nxs", "")
+        self.prefix = runPrefix(filename)
 
-        with h5py.File(self.filename, "r") as handle:
-            entry = handle.get("entry")
-            self.timeStart = entry.get("start_time")[0].decode("utf-8")[:19]
-            self.timeStop = entry.get("end_time")[0].decode("utf-8")[:19]
-            try:
-                self.duration = float(entry.get("duration").value[0])
-            except AttributeError:
-                self.duration = float(entry.get("duration")[0])
+        # metadata-only read of the header, shared with the post-processing agent
+        metadata = read_run_metadata(self.filename, metadatacachedir)
+        self.timeStart = metadata.start_time[:19]
+        self.timeStop = metadata.end_time[:19]
+        self.duration = metadata.duration
 
     def __str__(self):
         return self.prefix
@@ -379,6 +383,24 @@ class EventFile(GenericFile):
         return filename.startswith(self.prefix)
 
 
+def listdir(direc):
+    """Sorted names of the files in a directory, empty if the directory does not exist"""
+    try:
+        return sorted(os.listdir(direc))
+    except FileNotFoundError:
+        return []
+
+
+def startingWith(names, prefix):
+    """Names starting with a prefix, from a sorted list of names, without scanning the whole list"""
+    matches = []
+    for i in range(bisect.bisect_left(names, prefix), len(names)):
+        if not names[i].startswith(prefix):
+            break
+        matches.append(names[i])
+    return matches
+
+
 def getPropDir(descr):
     # if this points to a runfile, guess the proposal directory
     if os.path.isfile(descr):
@@ -397,7 +419,7 @@ def getPropDir(descr):
     return fullpath
 
 
-def getRuns(propdir):
+def getRunNames(propdir):
     # find the data directory
     datadirs = [os.path.join(propdir, subdir) for subdir in ["data", "nexus"]]
     datadirs = [direc for direc in datadirs if os.path.isdir(direc)]
@@ -405,10 +427,33 @@ def getRuns(propdir):
         raise RuntimeError("Expected only one data directory, found " + ",".join(datadirs))
 
     # get a list of event files in that directory
-    files = os.listdir(datadirs[0])
-    files = [EventFile(datadirs[0], name) for name in files if not name.endswith("_histo.nxs")]
+    files = sorted(name for name in os.listdir(datadirs[0]) if not name.endswith("_histo.nxs"))
+
+    return datadirs[0], files
+
+
+def getRuns(propdir):
+    datadir, names = getRunNames(propdir)
+    return [EventFile(datadir, name) for name in names]
 
-    return files
+
+def initWorker(shared, reducelog, cachedir=None):
+    """Keep the directory listings of the proposal in the worker processes"""
+    global shareddirlist, reduceloglist, metadatacachedir
+    shareddirlist = shared
+    reduceloglist = reducelog
+    if cachedir is not None:
+        metadatacachedir = cachedir
+
+
+def reportRun(reducedir, direc, filename):
+    """Report on one run, using the directory listings of the proposal
+
+    Returns the report and whether the run was reduced
+    """
+    eventfile = EventFile(direc, filename)
+    ar = ARstatus(reducedir, eventfile, shareddirlist, reduceloglist)
+    return [str(item) for item in ar.report()], len(ar.reduxfiles) > 0
 
 
 def getOutFilename(propdir):
@@ -417,10 +462,149 @@ def getOutFilename(propdir):
     return f"{inst}-{prop}.csv"
 
 
-def main(runfile, outputdir):
+def reportRuns(reducedir, datadir, names, jobs=None):
+    """Report on runs, in a process pool when there are several of them
+
+    The directory listings must have been set with initWorker. Yields the report
+    and whether the run was reduced for every run, in the order of the names.
+    """
+    total_runs = len(names)
+    if total_runs <= 1 or jobs == 1:
+        for name in names:
+            yield reportRun(reducedir, datadir, name)
+        return
+
+    chunksize = max(1, total_runs // (4 * (jobs or os.cpu_count() or 1)))
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs, initializer=initWorker, initargs=(shareddirlist, reduceloglist, metadatacachedir)
+    ) as executor:
+        yield from executor.map(reportRun, [reducedir] * total_runs, [datadir] * total_runs, names, chunksize=chunksize)
+
+
+def listdirStat(direc):
+    """Size and modification time of the files in a directory, by name, empty if the directory does not exist"""
+    try:
+        with os.scandir(direc) as entries:
+            return {entry.name: (entry.stat().st_size, entry.stat().st_mtime_ns) for entry in entries}
+    except FileNotFoundError:
+        return {}
+
+
+class ReportCache:
+    """Reports of the runs of a proposal, kept between invocations of the report
+
+    A run is reported again only when its event file, its reduced files or its
+    reduction logs changed size or modification time.
+    """
+
+    VERSION = 2
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.runs = {}
+        try:
+            with open(filename, "r") as handle:
+                contents = json.load(handle)
+            if contents.get("version") == self.VERSION:
+                self.runs = contents["runs"]
+        except (OSError, ValueError, KeyError):
+            pass  # start over
+
+    @staticmethod
+    def signature(eventstat, sharedstat, shareddirlist, logstat, reduceloglist, filename):
+        """Everything the report of a run depends on"""
+        prefix = runPrefix(filename)
+        return [
+            list(eventstat),
+            [[name, *sharedstat[name]] for name in startingWith(shareddirlist, prefix)],
+            [[name, *logstat[name]] for name in startingWith(reduceloglist, filename)],
+        ]
+
+    def get(self, path, signature):
+        run = self.runs.get(path)
+        if run is None or run["signature"] != signature:
+            return None
+        return run["report"], run["reduced"]
+
+    def put(self, path, signature, report, reduced):
+        self.runs[path] = {"signature": signature, "report": report, "reduced": reduced}
+
+    def prune(self, paths):
+        """Forget the runs that are not in the proposal anymore"""
+        paths = set(paths)
+        self.runs = {path: run for path, run in self.runs.items() if path in paths}
+
+    def save(self):
+        writeAtomically(self.filename, json.dumps({"version": self.VERSION, "runs": self.runs}))
+
+
+def writeAtomically(filename, contents):
+    tmpname = f"{filename}.{os.getpid()}.tmp"
+    with open(tmpname, "w") as handle:
+        handle.write(contents)
+    os.replace(tmpname, filename)
+
+
+def getCacheFilename(outfile):
+    return os.path.splitext(outfile)[0] + ".cache.json"
+
+
+def mainIncremental(propdir, outfile, jobs=None):
+    """Report on the new or changed runs of a proposal and rebuild the whole csv from the cache"""
+    datadir, names = getRunNames(propdir)
+    eventstat = listdirStat(datadir)
+    reducedir = os.path.join(propdir, "shared", "autoreduce")
+    sharedstat = listdirStat(reducedir)
+    logstat = listdirStat(os.path.join(reducedir, REDUCTION_LOG))
+    initWorker(sorted(sharedstat), sorted(logstat))
+
+    cache = ReportCache(getCacheFilename(outfile))
+    signatures = {
+        name: ReportCache.signature(eventstat[name], sharedstat, shareddirlist, logstat, reduceloglist, name)
+        for name in names
+        if name in eventstat
+    }
+    names = list(signatures)
+    stale = [name for name in names if cache.get(os.path.join(datadir, name), signatures[name]) is None]
+    print(f"Processing {len(stale)} new or changed of {len(names)} nexus files")
+    for name, (report, reduced) in zip(stale, reportRuns(reducedir, datadir, stale, jobs)):
+        print("Processed", report[0])
+        cache.put(os.path.join(datadir, name), signatures[name], report, reduced)
+    cache.prune(os.path.join(datadir, name) for name in names)
+    cache.save()
+
+    print(f"Writing results to '{outfile}'")
+    lines = [",".join(ARstatus.header())]
+    total_reduced = 0
+    for name in names:
+        report, reduced = cache.get(os.path.join(datadir, name), signatures[name])
+        if reduced:
+            total_reduced += 1
+        lines.append(",".join(report))
+    writeAtomically(outfile, "\n".join(lines) + "\n")
+    print(f"{total_reduced} of {len(names)} files reduced")
+
+
+def main(runfile, outputdir, jobs=None, incremental=False, metadatacache=""):
+    """
+    @param jobs: number of processes reading the event files, defaults to the number of cores
+    @param incremental: only process the runs that changed since the last report, and rewrite the
+    csv of the whole proposal from the cache of the reports
+    @param metadatacache: directory of the run metadata cache shared with the post-processing agent
+    """
+    global metadatacachedir
+    metadatacachedir = metadatacache
     runfile = os.path.abspath(runfile)
     propdir = getPropDir(runfile)
 
+    outfile = getOutFilename(propdir)
+    outfile = os.path.join(outputdir, outfile)
+
+    if incremental:
+        print(f"Finding event nexus files in '{propdir}'")
+        mainIncremental(propdir, outfile, jobs)
+        return
+
     # one mode is to append a single run,
     # the other is to parse an entire proposal
     if runfile == propdir:
@@ -428,18 +612,18 @@ def main(runfile, outputdir):
 
     print(f"Finding event nexus files in '{propdir}'")
     if runfile is not None:
-        runs = [EventFile(*(os.path.split(runfile)))]
+        datadir, names = os.path.split(runfile)
+        names = [names]
     else:
-        runs = getRuns(propdir)
+        datadir, names = getRunNames(propdir)
 
-    print(f"Processing {len(runs)} nexus files")
-
-    outfile = getOutFilename(propdir)
-    outfile = os.path.join(outputdir, outfile)
+    print(f"Processing {len(names)} nexus files")
 
     reducedir = os.path.join(propdir, "shared", "autoreduce")
+    # list the reduction directories once for all the runs
+    initWorker(listdir(reducedir), listdir(os.path.join(reducedir, REDUCTION_LOG)))
 
-    total_runs = len(runs)
+    total_runs = len(names)
     total_reduced = 0
     if runfile is None or (not os.path.exists(outfile)):
         print(f"Writing results to '{outfile}'")
@@ -450,27 +634,15 @@ def main(runfile, outputdir):
     with open(outfile, mode) as handle:
         if mode == "w":
             handle.write(",".join(ARstatus.header()) + "\n")
-        for i, eventfile in enumerate(runs):
-            print("Processing", eventfile, i + 1, "of", total_runs)
-            ar = ARstatus(reducedir, eventfile)
-            report = [str(item) for item in ar.report()]
-            if len(ar.reduxfiles) > 0:
+        for i, (report, reduced) in enumerate(reportRuns(reducedir, datadir, names, jobs)):
+            print("Processed", report[0], i + 1, "of", total_runs)
+            if reduced:
                 total_reduced += 1
             handle.write(",".join(report) + "\n")
     print(f"{total_reduced} of {total_runs} files reduced")
 
 
 if __name__ == "__main__":
-    """
-    During testing, it was discovered code must be reworked to be functional.
-
-    Global variables 'shareddirlist' and 'reduceloglist' are empty lists and intended to be initialized in main()
-    After initializing in main(), they are not used except for in the ARstatus class
-    But pre-commit doesn't allow unused variables, causing a development contradiction
-
-    This code is also no longer in use and so it was decided to divert attention to other tasks.
-    """
-
     import argparse
 
     parser = argparse.ArgumentParser(description="Report information on auto-reduction in a proposal")
@@ -483,6 +655,23 @@ if __name__ == "__main__":
         "outputdir",
         help="directory to write csv to, " + "defaults to instrument shared",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="number of processes reading event files, defaults to the number of cores",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only process new or changed runs of the proposal, using the cache next to the csv",
+    )
+    parser.add_argument(
+        "--metadata-cache",
+        default="",
+        help="directory of the run metadata cache shared with the post-processing agent",
+    )
     args = parser.parse_args()
 
-    main(args.runfile, args.outputdir)
+    main(args.runfile, args.outputdir, args.jobs, args.incremental, args.metadata_cache)
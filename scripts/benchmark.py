@@ -0,0 +1,725 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the post-processing agent
+
+Runs the agent against an in-process fake STOMP broker and a fake ONCat/Calvera/Intersect
+HTTP server, replays a mix of messages across the processor queues and reports the
+throughput, the latency percentiles (from publishing a message to its COMPLETE, ERROR or
+DISABLED reply) and the CPU time and memory of the agent. Reduction scripts are dummies
+of tunable duration and memory, so neither ActiveMQ, ONCat, Mantid nor docker are needed:
+
+    python scripts/benchmark.py --messages 200 --reduction-duration 0.5 --reduction-memory-mb 100 \\
+        --mix REDUCTION.DATA_READY=3,CATALOG.ONCAT.DATA_READY=1 --output benchmark.json
+
+The exit code is non-zero if some messages were not answered before the timeout.
+"""
+
+import argparse
+import collections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
+import os
+import random
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import psutil
+
+# Processor of each input queue, in the format of the "processors" configuration parameter
+PROCESSORS = {
+    "REDUCTION.DATA_READY": "reduction_processor.ReductionProcessor",
+    "REDUCTION.HIMEM.DATA_READY": "reduction_processor.ReductionProcessorHighMemory",
+    "CATALOG.ONCAT.DATA_READY": "oncat_processor.ONCatProcessor",
+    "REDUCTION_CATALOG.DATA_READY": "oncat_reduced_processor.ONCatProcessor",
+    "CALVERA.RAW.DATA_READY": "calvera_processor.CalveraProcessor",
+    "CALVERA.REDUCED.DATA_READY": "calvera_processor.CalveraReducedProcessor",
+    "INTERSECT.RAW.DATA_READY": "intersect_processor.IntersectProcessor",
+    "INTERSECT.REDUCED.DATA_READY": "intersect_processor.IntersectReducedProcessor",
+}
+DEFAULT_MIX = (
+    "REDUCTION.DATA_READY=4,CATALOG.ONCAT.DATA_READY=2,REDUCTION_CATALOG.DATA_READY=1,CALVERA.RAW.DATA_READY=1"
+)
+# Replies that end the processing of a message
+FINAL_STATUSES = ("COMPLETE", "ERROR", "DISABLED")
+
+REDUCTION_SCRIPT = """import time
+ballast = b"x" * ({memory_mb} * 1024 * 1024)
+time.sleep({duration})
+"""
+
+_HEADER_END = re.compile(rb"\r?\n\r?\n")
+_ESCAPES = {"\\": "\\\\", "\r": "\\r", "\n": "\\n", ":": "\\c"}
+_UNESCAPES = {"\\\\": "\\", "\\r": "\r", "\\n": "\n", "\\c": ":"}
+
+
+def encode_frame(command, headers, body=b""):
+    """Encode a STOMP 1.2 frame
+
+    Parameters
+    ----------
+    command: str
+        frame command, e.g. ``MESSAGE``
+    headers: dict
+        frame headers
+    body: bytes
+        frame body
+
+    Returns
+    -------
+    bytes
+    """
+    lines = [command]
+    for key, value in headers.items():
+        if command != "CONNECTED":
+            key = "".join(_ESCAPES.get(c, c) for c in str(key))
+            value = "".join(_ESCAPES.get(c, c) for c in str(value))
+        lines.append(f"{key}:{value}")
+    if body:
+        lines.append(f"content-length:{len(body)}")
+    return ("\n".join(lines) + "\n\n").encode() + body + b"\0"
+
+
+def parse_frames(buffer):
+    """Decode the complete STOMP frames at the start of a buffer
+
+    Parameters
+    ----------
+    buffer: bytes
+        data received so far
+
+    Returns
+    -------
+    tuple
+        list of ``(command, headers, body)`` and the bytes left over
+    """
+    frames = []
+    while True:
+        # heart-beats are bare end of lines between frames
+        buffer = buffer.lstrip(b"\r\n")
+        match = _HEADER_END.search(buffer)
+        if match is None:
+            return frames, buffer
+        lines = buffer[: match.start()].decode().split("\n")
+        command = lines[0].rstrip("\r")
+        headers = {}
+        for line in lines[1:]:
+            key, _, value = line.rstrip("\r").partition(":")
+            if command not in ("CONNECT", "STOMP"):
+                key = re.sub(r"\\.", lambda m: _UNESCAPES.get(m.group(0), m.group(0)), key)
+                value = re.sub(r"\\.", lambda m: _UNESCAPES.get(m.group(0), m.group(0)), value)
+            headers.setdefault(key, value)  # the first occurrence of a header wins
+        start = match.end()
+        if "content-length" in headers:
+            end = start + int(headers["content-length"])
+            if len(buffer) <= end:
+                return frames, buffer
+        else:
+            end = buffer.find(b"\0", start)
+            if end < 0:
+                return frames, buffer
+        frames.append((command, headers, buffer[start:end]))
+        buffer = buffer[end + 1 :]
+
+
+def normalize_destination(destination):
+    """Destinations without a ``/queue/`` or ``/topic/`` prefix are queues, as in ActiveMQ"""
+    if destination.startswith(("/queue/", "/topic/")):
+        return destination
+    return f"/queue/{destination}"
+
+
+class _Subscription:
+    def __init__(self, client, subscription_id, destination, ack):
+        self.client = client
+        self.id = subscription_id
+        self.destination = normalize_destination(destination)
+        self.ack = ack
+        # message delivered and not acknowledged yet (client acknowledgement only)
+        self.pending = None
+
+
+class _Client:
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = threading.Lock()
+
+    def send(self, command, headers, body=b""):
+        with self.lock:
+            try:
+                self.connection.sendall(encode_frame(command, headers, body))
+            except OSError:
+                pass
+
+
+class FakeBroker:
+    """
+    Minimal STOMP 1.2 broker for the benchmark
+
+    Queues deliver each message to one subscriber and topics to all subscribers. As with
+    ``activemq.prefetchSize: 0``, a subscription with client acknowledgement receives its
+    next message only once the previous one is acknowledged. Rejected (NACK) messages are
+    delivered again after ``redelivery_delay`` seconds.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, redelivery_delay=1.0):
+        self.redelivery_delay = redelivery_delay
+        self._server = socket.create_server((host, port))
+        self.address = self._server.getsockname()[:2]
+        self._lock = threading.RLock()
+        self._queues = collections.defaultdict(collections.deque)
+        self._subscriptions = []
+        self._unacked = {}
+        self._listeners = []
+        self._message_ids = itertools.count(1)
+        self._clients = []
+        self._running = False
+
+    def start(self):
+        """Accept connections in the background"""
+        self._running = True
+        threading.Thread(target=self._accept, name="broker", daemon=True).start()
+
+    def stop(self):
+        """Stop accepting connections and close the current ones"""
+        self._running = False
+        self._server.close()
+        with self._lock:
+            for client in self._clients:
+                try:
+                    client.connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def add_listener(self, callback):
+        """Call ``callback(destination, body)`` for every message sent to the broker"""
+        self._listeners.append(callback)
+
+    def subscribers(self, destination):
+        """Number of subscriptions to a destination"""
+        destination = normalize_destination(destination)
+        with self._lock:
+            return sum(1 for subscription in self._subscriptions if subscription.destination == destination)
+
+    def publish(self, destination, body):
+        """Send a message, as a client of the broker would
+
+        Parameters
+        ----------
+        destination: str
+            queue or topic
+        body: bytes
+            message body
+        """
+        destination = normalize_destination(destination)
+        with self._lock:
+            if destination.startswith("/topic/"):
+                for subscription in list(self._subscriptions):
+                    if subscription.destination == destination:
+                        self._deliver(subscription, destination, body)
+            else:
+                self._queues[destination].append(body)
+                self._dispatch()
+        for callback in self._listeners:
+            callback(destination, body)
+
+    def _accept(self):
+        while self._running:
+            try:
+                connection, _ = self._server.accept()
+            except OSError:
+                return
+            client = _Client(connection)
+            with self._lock:
+                self._clients.append(client)
+            threading.Thread(target=self._serve, args=(client,), name="broker-client", daemon=True).start()
+
+    def _serve(self, client):
+        buffer = b""
+        try:
+            while True:
+                data = client.connection.recv(65536)
+                if not data:
+                    break
+                frames, buffer = parse_frames(buffer + data)
+                for command, headers, body in frames:
+                    if not self._handle(client, command, headers, body):
+                        return
+        except OSError:
+            pass
+        finally:
+            self._disconnect(client)
+
+    def _handle(self, client, command, headers, body):
+        if command in ("CONNECT", "STOMP"):
+            client.send("CONNECTED", {"version": "1.2", "heart-beat": "0,0", "server": "benchmark"})
+            return True
+        if command == "SEND":
+            self.publish(headers["destination"], body)
+        elif command == "SUBSCRIBE":
+            subscription = _Subscription(client, headers["id"], headers["destination"], headers.get("ack", "auto"))
+            with self._lock:
+                self._subscriptions.append(subscription)
+                self._dispatch()
+        elif command == "UNSUBSCRIBE":
+            with self._lock:
+                for subscription in list(self._subscriptions):
+                    if subscription.client is client and subscription.id == headers.get("id"):
+                        self._remove(subscription)
+        elif command in ("ACK", "NACK"):
+            message_id = headers.get("id", headers.get("message-id"))
+            with self._lock:
+                unacked = self._unacked.pop(message_id, None)
+                if unacked is not None:
+                    subscription, destination, message = unacked
+                    subscription.pending = None
+                    if command == "NACK":
+                        timer = threading.Timer(self.redelivery_delay, self._redeliver, args=(destination, message))
+                        timer.daemon = True
+                        timer.start()
+                    self._dispatch()
+        if "receipt" in headers:
+            client.send("RECEIPT", {"receipt-id": headers["receipt"]})
+        return command != "DISCONNECT"
+
+    def _redeliver(self, destination, body):
+        with self._lock:
+            self._queues[destination].appendleft(body)
+            self._dispatch()
+
+    def _remove(self, subscription):
+        self._subscriptions.remove(subscription)
+        if subscription.pending is not None:
+            _, destination, body = self._unacked.pop(subscription.pending)
+            self._queues[destination].appendleft(body)
+
+    def _disconnect(self, client):
+        with self._lock:
+            for subscription in list(self._subscriptions):
+                if subscription.client is client:
+                    self._remove(subscription)
+            if client in self._clients:
+                self._clients.remove(client)
+            self._dispatch()
+        client.connection.close()
+
+    def _deliver(self, subscription, destination, body):
+        message_id = str(next(self._message_ids))
+        if subscription.ack != "auto" and not destination.startswith("/topic/"):
+            subscription.pending = message_id
+            self._unacked[message_id] = (subscription, destination, body)
+        headers = {
+            "destination": destination,
+            "message-id": message_id,
+            "subscription": subscription.id,
+            "ack": message_id,
+        }
+        subscription.client.send("MESSAGE", headers, body)
+
+    def _dispatch(self):
+        """Deliver the queued messages to the subscriptions ready for them. Must hold the lock."""
+        for destination, messages in self._queues.items():
+            while messages:
+                ready = [s for s in self._subscriptions if s.destination == destination and s.pending is None]
+                if not ready:
+                    break
+                # rotate the subscriptions so that several consumers share the load
+                subscription = ready[0]
+                self._subscriptions.remove(subscription)
+                self._subscriptions.append(subscription)
+                self._deliver(subscription, destination, messages.popleft())
+
+
+class _CatalogHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.record_request()
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        response = {}
+        if self.path.startswith("/api/datafiles/") and self.path.endswith("/ingest"):
+            # ONCat datafile: /facility/instrument/experiment/nexus/instrument_run.nxs.h5
+            location = self.path[len("/api/datafiles") : -len("/ingest")]
+            tokens = location.split("/")
+            response = {"location": location, "indexed": {}}
+            if len(tokens) > 3:
+                response.update({"facility": tokens[1], "instrument": tokens[2], "experiment": tokens[3]})
+            match = re.search(r"_(\d+)[._]", os.path.basename(location))
+            if match:
+                response["indexed"]["run_number"] = int(match.group(1))
+        body = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeCatalogServer(ThreadingHTTPServer):
+    """
+    HTTP server answering the ONCat, Calvera and Intersect ingestion requests
+    after ``latency`` seconds
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0):
+        super().__init__((host, port), _CatalogHandler)
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://%s:%s" % self.server_address[:2]
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="catalog", daemon=True).start()
+
+
+def parse_mix(mix):
+    """Parse a message mix such as ``REDUCTION.DATA_READY=3,CATALOG.ONCAT.DATA_READY=1``
+
+    Returns
+    -------
+    dict
+        weight of each input queue
+    """
+    weights = {}
+    for item in mix.split(","):
+        queue, _, weight = item.strip().partition("=")
+        queue = queue.replace("/queue/", "")
+        if queue not in PROCESSORS:
+            raise ValueError(f"Unknown queue {queue}, expected one of {', '.join(PROCESSORS)}")
+        weights[queue] = float(weight or 1)
+    return weights
+
+
+def percentiles(values):
+    """Summary of a list of latencies, nearest-rank percentiles"""
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def rank(p):
+        return values[min(len(values) - 1, max(0, int(round(p / 100.0 * len(values))) - 1))]
+
+    return {
+        "mean": sum(values) / len(values),
+        "p50": rank(50),
+        "p90": rank(90),
+        "p99": rank(99),
+        "max": values[-1],
+    }
+
+
+def create_workspace(root, instruments, queues, broker_address, catalog_url, options):
+    """Write the configuration and the dummy reduction scripts of the agent
+
+    Returns
+    -------
+    str
+        path of the configuration file
+    """
+    shared_dir = os.path.join(root, "shared")
+    output_dir = os.path.join(root, "output")
+    for directory in (shared_dir, output_dir):
+        os.makedirs(directory, exist_ok=True)
+
+    for instrument in instruments:
+        with open(os.path.join(shared_dir, f"reduce_{instrument}.py"), "w") as script:
+            script.write(
+                REDUCTION_SCRIPT.format(duration=options.reduction_duration, memory_mb=options.reduction_memory_mb)
+            )
+
+    config_file = os.path.join(root, "post_processing.conf")
+    import postprocessing
+
+    config = {
+        "failover_uri": "",
+        "brokers": [list(broker_address)],
+        "amq_user": "benchmark",
+        "amq_pwd": "benchmark",
+        "sw_dir": root,
+        # the jobs are handed the configuration of the agent, see Configuration.snapshot
+        "python_dir": os.path.dirname(os.path.abspath(postprocessing.__file__)),
+        "start_script": sys.executable,
+        "task_script": "PostProcessAdmin.py",
+        "task_script_queue_arg": "-q",
+        "task_script_data_arg": "-d",
+        "log_file": os.path.join(root, "post_processing.log"),
+        "postprocess_error": "POSTPROCESS.ERROR",
+        "reduction_started": "REDUCTION.STARTED",
+        "reduction_complete": "REDUCTION.COMPLETE",
+        "reduction_error": "REDUCTION.ERROR",
+        "reduction_disabled": "REDUCTION.DISABLED",
+        "heart_beat": "/topic/SNS.COMMON.STATUS.AUTOREDUCE.0",
+        "dev_instrument_shared": shared_dir,
+        "dev_output_dir": output_dir,
+        "python_exec": sys.executable,
+        "max_procs": options.max_procs,
+        "jobs_per_instrument": options.jobs_per_instrument,
+        "processors": [PROCESSORS[queue] for queue in queues],
+        "calvera_ingest_url": catalog_url,
+        "intersect_ingest_url": catalog_url,
+        "oncat_url": catalog_url,
+        "oncat_api_token": "benchmark",
+    }
+    with open(config_file, "w") as handle:
+        json.dump(config, handle, indent=4)
+    return config_file
+
+
+def run_agent(config_file):
+    """Run the post-processing agent until it receives SIGTERM"""
+    from postprocessing.Configuration import read_configuration
+    from postprocessing.Consumer import Consumer
+
+    consumer = Consumer(read_configuration(config_file))
+    consumer.listen_and_wait(0.01)
+    consumer._disconnect()
+
+
+class _ProcessSampler:
+    """Peak memory of the agent and of its jobs, sampled in the background"""
+
+    def __init__(self, pid, interval=0.1):
+        self.process = psutil.Process(pid)
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_jobs_rss = 0
+        self.cpu_times = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.sample()
+            self._stop.wait(self.interval)
+
+    def sample(self):
+        try:
+            self.peak_rss = max(self.peak_rss, self.process.memory_info().rss)
+            jobs_rss = 0
+            for child in self.process.children(recursive=True):
+                try:
+                    jobs_rss += child.memory_info().rss
+                except psutil.Error:
+                    pass
+            self.peak_jobs_rss = max(self.peak_jobs_rss, jobs_rss)
+            self.cpu_times = self.process.cpu_times()
+        except psutil.Error:
+            pass
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_benchmark(options):
+    """Run the agent, replay the messages and collect the results
+
+    Parameters
+    ----------
+    options: argparse.Namespace
+        options of the command line
+
+    Returns
+    -------
+    dict
+        benchmark report
+    """
+    weights = parse_mix(options.mix)
+    queues = list(weights)
+    instruments = [f"BENCH{i}" for i in range(options.instruments)]
+    rng = random.Random(options.seed)
+
+    broker = FakeBroker(redelivery_delay=options.redelivery_delay)
+    broker.start()
+    catalog = FakeCatalogServer(latency=options.http_latency)
+    catalog.start()
+    workdir = options.workdir or tempfile.mkdtemp(prefix="postprocessing_benchmark_")
+    config_file = create_workspace(workdir, instruments, queues, broker.address, catalog.url, options)
+
+    published = {}
+    finished = {}
+    condition = threading.Condition()
+
+    def on_send(destination, body):
+        status = destination.rsplit(".", 1)[-1]
+        if status not in FINAL_STATUSES:
+            return
+        try:
+            benchmark_id = json.loads(body).get("benchmark_id")
+        except (ValueError, AttributeError):
+            return
+        with condition:
+            if benchmark_id in published and benchmark_id not in finished:
+                finished[benchmark_id] = (time.monotonic(), status)
+                condition.notify_all()
+
+    broker.add_listener(on_send)
+
+    env = dict(os.environ)
+    repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [repository, env.get("PYTHONPATH")]))
+    with open(os.path.join(workdir, "agent.out"), "w") as agent_output:
+        agent = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--agent", config_file],
+            stdout=agent_output,
+            stderr=subprocess.STDOUT,
+            env=env,
+        )
+    sampler = _ProcessSampler(agent.pid)
+    try:
+        deadline = time.monotonic() + 30
+        while not all(broker.subscribers(f"/queue/{queue}") for queue in queues):
+            if agent.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError(f"The agent did not subscribe to {queues}, see {workdir}/agent.out")
+            time.sleep(0.05)
+
+        start = time.monotonic()
+        for i in range(options.messages):
+            queue = rng.choices(queues, [weights[q] for q in queues])[0]
+            instrument = instruments[i % len(instruments)]
+            run_number = i + 1
+            data_dir = os.path.join(workdir, "SNS", instrument, "IPTS-1", "nexus")
+            os.makedirs(data_dir, exist_ok=True)
+            data_file = os.path.join(data_dir, f"{instrument}_{run_number}.nxs.h5")
+            with open(data_file, "wb") as handle:
+                handle.write(b"\0")
+            data = {
+                "facility": "SNS",
+                "instrument": instrument,
+                "ipts": "IPTS-1",
+                "run_number": str(run_number),
+                "data_file": data_file,
+                "benchmark_id": i,
+            }
+            if options.rate > 0:
+                # open loop: publish at a fixed rate whatever the agent is doing
+                time.sleep(max(0.0, start + i / options.rate - time.monotonic()))
+            with condition:
+                published[i] = (time.monotonic(), queue)
+            broker.publish(f"/queue/{queue}", json.dumps(data).encode())
+
+        with condition:
+            condition.wait_for(lambda: len(finished) == len(published), timeout=options.timeout)
+        sampler.sample()
+    finally:
+        sampler.stop()
+        agent.send_signal(signal.SIGTERM)
+        try:
+            agent.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            agent.kill()
+            agent.wait()
+        broker.stop()
+        catalog.shutdown()
+        catalog.server_close()
+
+    with condition:
+        results = [(published[i][1], end - published[i][0], status) for i, (end, status) in finished.items()]
+        last = max((end for end, _ in finished.values()), default=start)
+    elapsed = last - start
+    report = {
+        "messages": options.messages,
+        "answered": len(results),
+        "missing": options.messages - len(results),
+        "elapsed_sec": elapsed,
+        "throughput_per_sec": len(results) / elapsed if elapsed > 0 else 0.0,
+        "outcomes": dict(collections.Counter(status for _, _, status in results)),
+        "latency_sec": percentiles([latency for _, latency, _ in results]),
+        "queues": {},
+        "agent": {
+            "cpu_sec": sum(sampler.cpu_times[:2]) if sampler.cpu_times else None,
+            "jobs_cpu_sec": sum(sampler.cpu_times[2:4]) if sampler.cpu_times else None,
+            "peak_rss_mb": sampler.peak_rss / 1024**2,
+            "jobs_peak_rss_mb": sampler.peak_jobs_rss / 1024**2,
+        },
+        "http_requests": catalog.requests,
+        "workdir": workdir,
+    }
+    for queue in queues:
+        queue_results = [(latency, status) for q, latency, status in results if q == queue]
+        report["queues"][queue] = {
+            "messages": sum(1 for _, q in published.values() if q == queue),
+            "outcomes": dict(collections.Counter(status for _, status in queue_results)),
+            "latency_sec": percentiles([latency for latency, _ in queue_results]),
+        }
+    return report
+
+
+def format_report(report):
+    """Human-readable summary of a benchmark report"""
+
+    def latency(summary):
+        if not summary:
+            return "-"
+        return " ".join(f"{key}={summary[key]:.3f}" for key in ("p50", "p90", "p99", "max"))
+
+    agent = report["agent"]
+    lines = [
+        f"Messages: {report['messages']} answered: {report['answered']} missing: {report['missing']}"
+        f" outcomes: {report['outcomes']}",
+        f"Throughput: {report['throughput_per_sec']:.2f} messages/s over {report['elapsed_sec']:.2f} s",
+        f"Latency (s): {latency(report['latency_sec'])}",
+        f"Agent: cpu {agent['cpu_sec'] or 0:.2f} s, peak RSS {agent['peak_rss_mb']:.1f} MiB;"
+        f" jobs: cpu {agent['jobs_cpu_sec'] or 0:.2f} s, peak RSS {agent['jobs_peak_rss_mb']:.1f} MiB",
+    ]
+    for queue, summary in report["queues"].items():
+        lines.append(
+            f"  {queue}: {summary['messages']} messages {summary['outcomes']} {latency(summary['latency_sec'])}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of the post-processing agent")
+    parser.add_argument("--messages", type=int, default=100, help="number of messages to replay")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="relative weights of the input queues")
+    parser.add_argument("--instruments", type=int, default=4, help="number of instruments the messages are spread over")
+    parser.add_argument("--rate", type=float, default=0.0, help="messages per second (default: all at once)")
+    parser.add_argument("--reduction-duration", type=float, default=0.1, help="duration of the reductions (s)")
+    parser.add_argument("--reduction-memory-mb", type=int, default=10, help="memory used by the reductions (MiB)")
+    parser.add_argument("--http-latency", type=float, default=0.0, help="response time of the catalogs (s)")
+    parser.add_argument("--max-procs", type=int, default=5, help="max_procs of the agent")
+    parser.add_argument("--jobs-per-instrument", type=int, default=2, help="jobs_per_instrument of the agent")
+    parser.add_argument(
+        "--redelivery-delay", type=float, default=1.0, help="delay before redelivering rejected messages"
+    )
+    parser.add_argument("--timeout", type=float, default=600.0, help="maximum time to wait for the answers (s)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the message mix")
+    parser.add_argument("--workdir", default="", help="directory for the data, logs and configuration")
+    parser.add_argument("--output", default="", help="write the report to this JSON file")
+    parser.add_argument("--agent", metavar="CONFIG", help=argparse.SUPPRESS)
+    options = parser.parse_args(argv)
+
+    if options.agent:
+        run_agent(options.agent)
+        return 0
+
+    report = run_benchmark(options)
+    print(format_report(report))
+    if options.output:
+        with open(options.output, "w") as handle:
+            json.dump(report, handle, indent=2)
+    return 1 if report["missing"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
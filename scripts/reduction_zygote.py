@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+Pre-warmed interpreter ("zygote") for reduction scripts
+
+The zygote runs inside the conda environment of a reduction script, imports the
+expensive modules (Mantid) once and then waits on a Unix socket. For every request
+it forks a child that runs the reduction script as ``python <script> <args>`` would,
+so the child starts with the framework already imported and initialized.
+
+A request is a single JSON line
+
+    {"script": "/SNS/REF_L/shared/autoreduce/reduce_REF_L.py",
+     "args": ["/SNS/REF_L/IPTS-1234/nexus/REF_L_1234.nxs.h5", "/SNS/REF_L/IPTS-1234/shared/autoreduce/"],
+     "cwd": "/SNS/REF_L/IPTS-1234/shared/autoreduce",
+     "env": {"OMP_NUM_THREADS": "4"}}
+
+with "env" the variables added to the environment of the child, sent along with two file
+descriptors (standard output and standard error of the job).
+The zygote replies with ``{"pid": <pid>}`` once the child is forked and with
+``{"returncode": <code>}`` when it exits. The client keeps the connection open while the
+job runs: when it closes the connection (for instance because it was terminated), the
+process group of the job is killed.
+
+This script only depends on the standard library because it runs in the reduction
+conda environment, not in the environment of the post-processing agent.
+
+Usage: reduction_zygote.py [--idle-timeout SECONDS] <socket_path> [module ...]
+"""
+
+import argparse
+import importlib
+import json
+import os
+import runpy
+import selectors
+import signal
+import socket
+import sys
+import time
+import traceback
+
+# maximum size of a request
+MAX_REQUEST_BYTES = 65536
+# time given to a client to send its request after connecting (seconds)
+HANDSHAKE_TIMEOUT = 5.0
+
+
+def preload(modules):
+    """Import the modules that every forked child will inherit
+
+    Parameters
+    ----------
+    modules: ~list
+        names of the modules to import, e.g. ``mantid.simpleapi``
+    """
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except Exception:  # noqa: BLE001
+            print(f"Could not preload {module}", file=sys.stderr)
+            traceback.print_exc()
+
+
+def bind(socket_path):
+    """Create the listening socket, unless a live zygote already serves this path
+
+    Parameters
+    ----------
+    socket_path: str
+        path of the Unix socket
+
+    Returns
+    -------
+    socket.socket or None
+        listening socket (None if another zygote is already listening)
+    """
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+            return None
+        except OSError:
+            # stale socket left behind by a zygote that died
+            os.unlink(socket_path)
+        finally:
+            probe.close()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # only the user running the agent may submit jobs
+    old_umask = os.umask(0o077)
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(old_umask)
+    server.listen(16)
+    return server
+
+
+def run_child(request, fds, server, connections):
+    """Run the reduction script in the forked child. Never returns.
+
+    Parameters
+    ----------
+    request: dict
+        decoded request
+    fds: ~list
+        standard output and standard error file descriptors
+    server: socket.socket
+        listening socket, closed in the child
+    connections: ~list
+        client connections, closed in the child
+    """
+    code = 1
+    try:
+        server.close()
+        for conn in connections:
+            conn.close()
+        # a process group of its own, killed with the processes it starts if the client goes away
+        os.setpgid(0, 0)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.dup2(fds[0], 1)
+        os.dup2(fds[1], 2)
+        for fd in [devnull] + list(fds):
+            os.close(fd)
+
+        script = request["script"]
+        os.chdir(request.get("cwd") or os.path.dirname(script))
+        # the thread pools of the CPU lease, read by the modules the script imports
+        os.environ.update({str(name): str(value) for name, value in request.get("env", {}).items()})
+        sys.argv = [script] + [str(arg) for arg in request.get("args", [])]
+        # same module search path as `python <script>`
+        sys.path[0] = os.path.dirname(os.path.abspath(script))
+        try:
+            runpy.run_path(script, run_name="__main__")
+            code = 0
+        except SystemExit as e:
+            if e.code is None:
+                code = 0
+            elif isinstance(e.code, int):
+                code = e.code
+            else:
+                print(e.code, file=sys.stderr)
+                code = 1
+        except BaseException:  # noqa: BLE001
+            traceback.print_exc()
+            code = 1
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+
+
+def reply(conn, message):
+    """Send a JSON line to a client, ignoring clients that went away"""
+    try:
+        conn.sendall((json.dumps(message) + "\n").encode())
+    except OSError:
+        pass
+
+
+def read_request(conn):
+    """Receive the request of a client and its file descriptors
+
+    Parameters
+    ----------
+    conn: socket.socket
+        client connection, readable
+
+    Returns
+    -------
+    tuple
+        decoded request and file descriptors
+    """
+    payload, fds, _flags, _addr = socket.recv_fds(conn, MAX_REQUEST_BYTES, 2)
+    try:
+        request = json.loads(payload.decode())
+        if len(fds) != 2 or "script" not in request:
+            raise ValueError("expected a script and two file descriptors")
+    except Exception:
+        for fd in fds:
+            os.close(fd)
+        raise
+    return request, fds
+
+
+def kill_job(pid):
+    """Kill the process group of a job whose client went away"""
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+def serve(socket_path, idle_timeout):
+    """Fork a child for each request until idle for ``idle_timeout`` seconds
+
+    The listening socket, the clients sending their request and the clients waiting for
+    their job are all watched by the same selector, so a slow client holds up nobody.
+
+    Parameters
+    ----------
+    socket_path: str
+        path of the Unix socket
+    idle_timeout: float
+        exit after this many seconds without running jobs
+    """
+    server = bind(socket_path)
+    if server is None:
+        print(f"A zygote is already listening on {socket_path}", file=sys.stderr)
+        return
+    server_inode = os.stat(socket_path).st_ino
+
+    selector = selectors.DefaultSelector()
+    selector.register(server, selectors.EVENT_READ)
+    # connections waiting for their request, with the time they were accepted
+    pending = {}
+    # pid -> connection of the client, None once the client went away
+    jobs = {}
+    last_activity = time.time()
+    try:
+        while True:
+            for key, _events in selector.select(timeout=0.1):
+                conn = key.fileobj
+                if conn is server:
+                    conn, _ = server.accept()
+                    conn.setblocking(False)
+                    pending[conn] = time.time()
+                    selector.register(conn, selectors.EVENT_READ, None)
+                    continue
+
+                if key.data is not None:
+                    # a client waiting for its job: it only sends anything by closing the connection
+                    try:
+                        closed = not conn.recv(4096)
+                    except BlockingIOError:
+                        closed = False
+                    except OSError:
+                        closed = True
+                    if closed:
+                        print(f"Client of process {key.data} went away: killing it", file=sys.stderr)
+                        selector.unregister(conn)
+                        conn.close()
+                        jobs[key.data] = None
+                        kill_job(key.data)
+                    continue
+
+                try:
+                    request, fds = read_request(conn)
+                except BlockingIOError:
+                    continue
+                except Exception as e:  # noqa: BLE001
+                    del pending[conn]
+                    selector.unregister(conn)
+                    reply(conn, {"error": str(e)})
+                    conn.close()
+                    continue
+                del pending[conn]
+                selector.unregister(conn)
+
+                # flush before forking so the child does not inherit buffered output
+                sys.stdout.flush()
+                sys.stderr.flush()
+                pid = os.fork()
+                if pid == 0:
+                    run_child(request, fds, server, [conn] + list(pending) + [c for c in jobs.values() if c])
+                try:
+                    # also done by the child, whichever runs first
+                    os.setpgid(pid, pid)
+                except OSError:
+                    pass
+                for fd in fds:
+                    os.close(fd)
+                jobs[pid] = conn
+                conn.setblocking(True)
+                reply(conn, {"pid": pid})
+                conn.setblocking(False)
+                selector.register(conn, selectors.EVENT_READ, pid)
+
+            # drop the clients that did not send their request in time
+            for conn, accepted in list(pending.items()):
+                if time.time() - accepted > HANDSHAKE_TIMEOUT:
+                    del pending[conn]
+                    selector.unregister(conn)
+                    conn.close()
+
+            # reap the children that finished
+            while jobs:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+                if pid == 0:
+                    break
+                conn = jobs.pop(pid, None)
+                if conn is not None:
+                    selector.unregister(conn)
+                    conn.setblocking(True)
+                    reply(conn, {"returncode": os.waitstatus_to_exitcode(status)})
+                    conn.close()
+
+            if jobs or pending:
+                last_activity = time.time()
+            elif time.time() - last_activity > idle_timeout:
+                break
+            # stop if our socket was removed or replaced
+            try:
+                if os.stat(socket_path).st_ino != server_inode:
+                    break
+            except FileNotFoundError:
+                break
+    finally:
+        server.close()
+        try:
+            if os.stat(socket_path).st_ino == server_inode:
+                os.unlink(socket_path)
+        except FileNotFoundError:
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-warmed interpreter for reduction scripts")
+    parser.add_argument("--idle-timeout", type=float, default=3600.0, help="exit after being idle (seconds)")
+    parser.add_argument("socket_path", help="Unix socket to listen on")
+    parser.add_argument("modules", nargs="*", help="modules to import before forking")
+    args = parser.parse_args()
+
+    preload(args.modules)
+    serve(args.socket_path, args.idle_timeout)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import glob
+import os
+import subprocess
+import sys
+from unittest.mock import patch
+
+import pytest
+
+from postprocessing.Configuration import Configuration
+from postprocessing.processors import cpu_allocation
+from postprocessing.processors.cpu_allocation import CPULease, get_numa_nodes, parse_cpu_list, set_affinity
+from postprocessing.processors.job_handling import local_submission
+
+
+def test_parse_cpu_list():
+    assert parse_cpu_list("0-3,8-9,12\n") == [0, 1, 2, 3, 8, 9, 12]
+
+
+@pytest.fixture
+def numa(tmp_path, monkeypatch):
+    """Node with 8 CPUs on 2 NUMA nodes"""
+    for node, cpus in enumerate(["0-3", "4-7"]):
+        (tmp_path / f"node{node}").mkdir()
+        (tmp_path / f"node{node}" / "cpulist").write_text(cpus)
+    monkeypatch.setattr(cpu_allocation, "NUMA_NODES", str(tmp_path / "node*" / "cpulist"))
+    monkeypatch.setattr(cpu_allocation.os, "sched_getaffinity", lambda pid: set(range(8)), raising=False)
+
+
+def test_get_numa_nodes(numa):
+    assert get_numa_nodes(list(range(8))) == [[0, 1, 2, 3], [4, 5, 6, 7]]
+    # CPUs the topology does not describe
+    assert get_numa_nodes(list(range(10))) == [list(range(10))]
+
+
+def test_leases(numa, tmp_path):
+    lease_dir = (tmp_path / "leases").as_posix()
+    first = CPULease(lease_dir)
+    assert first.acquire() == list(range(8))
+    assert first.thread_env()["OMP_NUM_THREADS"] == "8"
+
+    # a second job shares the CPUs, on a NUMA node of its own once the first job rebalances
+    second = CPULease(lease_dir)
+    assert second.acquire() == [0, 1, 2, 3]
+    assert first.rebalance() == [4, 5, 6, 7]
+    assert first.rebalance() is None  # same number of jobs
+
+    # the lease of a process that is gone is ignored
+    with open(os.path.join(lease_dir, "999999999-dead.json"), "w") as handle:
+        handle.write("[0, 1, 2, 3, 4, 5, 6, 7]")
+    second.release()
+    assert first.rebalance() == list(range(8))
+    assert sorted(os.listdir(lease_dir)) == sorted([".lock", os.path.basename(first.path)])
+    first.release()
+
+
+def test_set_affinity_threads():
+    cpus = sorted(os.sched_getaffinity(0))
+    # the worker threads run before the process is pinned, like the thread pools of a job being rebalanced
+    proc = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            "import threading, time\n"
+            "for _ in range(3):\n"
+            "    threading.Thread(target=time.sleep, args=(30,), daemon=True).start()\n"
+            "print('ready', flush=True)\n"
+            "time.sleep(30)\n",
+        ],
+        stdout=subprocess.PIPE,
+    )
+    try:
+        assert proc.stdout.readline() == b"ready\n"
+        tasks = sorted(int(os.path.basename(task)) for task in glob.glob(f"/proc/{proc.pid}/task/*"))
+        assert len(tasks) == 4
+        with patch.object(cpu_allocation.os, "sched_setaffinity") as mock_setaffinity:
+            set_affinity(proc.pid, [cpus[-1]])
+        assert sorted(call_args[0][0] for call_args in mock_setaffinity.call_args_list) == tasks
+
+        if len(cpus) < 2:
+            pytest.skip("needs two CPUs to check the affinity of the threads")
+        set_affinity(proc.pid, [cpus[-1]])
+        allowed = []
+        for status in glob.glob(f"/proc/{proc.pid}/task/*/status"):
+            with open(status) as handle:
+                allowed.extend(line.split()[1] for line in handle if line.startswith("Cpus_allowed_list:"))
+        assert allowed == [str(cpus[-1])] * 4
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+def test_local_submission_pinned(mocker, tmp_path):
+    mock_configuration = mocker.Mock(spec=Configuration)
+    mock_configuration.python_executable = sys.executable
+    mock_configuration.comm_only = False
+    mock_configuration.system_mem_limit_perc = 60.0
+    mock_configuration.mem_check_interval_sec = 0.05
+    mock_configuration.task_time_limit_minutes = 60.0
+    mock_configuration.cpu_pinning = True
+    mock_configuration.cpu_lease_dir = (tmp_path / "leases").as_posix()
+
+    script = tmp_path / "script.py"
+    script.write_text("import os\nprint(os.environ['OMP_NUM_THREADS'], sorted(os.sched_getaffinity(0)))\n")
+    out_log = tmp_path / "out"
+    local_submission(mock_configuration, script, "input", tmp_path, out_log, tmp_path / "err")
+
+    cpus = sorted(os.sched_getaffinity(0))
+    assert out_log.read_text().strip() == f"{len(cpus)} {cpus}"
+    # the lease is given back
+    assert os.listdir(mock_configuration.cpu_lease_dir) == [".lock"]
@@ -1,7 +1,10 @@
 from postprocessing.processors.job_handling import (
     local_submission,
     determine_success_local,
+    get_zygote_socket_path,
     terminate_or_kill_process_tree,
+    TERMINATED_MEMORY_LIMIT,
+    TERMINATED_TIME_LIMIT,
 )
 from postprocessing.Configuration import Configuration
 
@@ -10,9 +13,12 @@ import logging
 import os
 import psutil
 import pytest
+import json
+import socket
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 
 
@@ -43,7 +49,7 @@ def test_local_submission(mocker, script, output_expected, error_expected):
     tempFile_output.seek(0)
     tempFile_error.seek(0)
 
-    local_submission(
+    termination = local_submission(
         mock_configuration,
         tempFile_script.name,
         tempFile_input.name,
@@ -52,6 +58,7 @@ def test_local_submission(mocker, script, output_expected, error_expected):
         tempFile_error.name,
     )
 
+    assert termination is None
     assert output_expected == tempFile_output.read()
     assert error_expected in tempFile_error.read()
 
@@ -125,7 +132,7 @@ while True:
     tmp_file_output = tmp_path / "out"
     tmp_file_error = tmp_path / "err"
 
-    local_submission(
+    termination = local_submission(
         mock_configuration,
         tmp_file_script,
         tmp_file_input,
@@ -135,6 +142,7 @@ while True:
     )
     assert "Subprocess memory usage" in caplog.text
     assert "Total memory usage exceeded limit" in caplog.text
+    assert termination == TERMINATED_MEMORY_LIMIT
 
     # Verify that a message was added in the reduction error log
     success, status_data = determine_success_local(mock_configuration, tmp_file_error)
@@ -200,7 +208,7 @@ time.sleep(1)
     tmp_file_output = tmp_path / "out"
     tmp_file_error = tmp_path / "err"
 
-    local_submission(
+    termination = local_submission(
         mock_configuration,
         tmp_file_script,
         tmp_file_input,
@@ -210,6 +218,7 @@ time.sleep(1)
     )
     assert "Elapsed time" in caplog.text
     assert "Time limit exceeded" in caplog.text
+    assert termination == TERMINATED_TIME_LIMIT
 
     # Verify that a message was added in the reduction error log
     success, status_data = determine_success_local(mock_configuration, tmp_file_error)
@@ -255,3 +264,213 @@ print("Would fail in new version")
     assert "error" in status_data
     assert "does not specify a CONDA_ENV" in status_data["error"]
     assert "conda environment must be specified" in status_data["error"]
+
+
+@pytest.fixture
+def zygote(tmp_path):
+    """Zygote serving the conda environment "zygote-test" from the test interpreter"""
+    socket_dir = tmp_path / "sockets"
+    socket_dir.mkdir()
+    configuration = type("ZygoteConfiguration", (), {"zygote_socket_dir": str(socket_dir)})()
+    socket_path = get_zygote_socket_path(configuration, "zygote-test")
+    zygote_script = os.path.join(os.path.dirname(__file__), "../../../../scripts/reduction_zygote.py")
+    proc = subprocess.Popen([sys.executable, zygote_script, socket_path, "json"])
+    for _ in range(100):
+        if os.path.exists(socket_path):
+            break
+        time.sleep(0.05)
+    yield socket_dir, proc
+    proc.terminate()
+    proc.wait()
+
+
+def test_local_submission_zygote(mocker, tmp_path, zygote):
+    """Test running a reduction script forked by a zygote"""
+    socket_dir, zygote_proc = zygote
+    mock_configuration = mocker.Mock(spec=Configuration)
+    mock_configuration.python_executable = sys.executable
+    mock_configuration.comm_only = False
+    mock_configuration.system_mem_limit_perc = 60.0
+    mock_configuration.mem_check_interval_sec = 0.01
+    mock_configuration.task_time_limit_minutes = 60.0
+    mock_configuration.zygote_enabled = True
+    mock_configuration.zygote_socket_dir = str(socket_dir)
+
+    script = """CONDA_ENV = "zygote-test"
+import os
+import sys
+print(os.getppid(), sys.argv[1], sys.argv[2], os.getcwd())
+raise Exception("forceError")
+"""
+    tmp_file_script = tmp_path / "reduce_TEST.py"
+    tmp_file_script.write_text(script)
+    tmp_file_input = tmp_path / "in"
+    tmp_file_output = tmp_path / "out"
+    tmp_file_error = tmp_path / "err"
+
+    local_submission(
+        mock_configuration,
+        tmp_file_script,
+        tmp_file_input,
+        tmp_path,
+        tmp_file_output,
+        tmp_file_error,
+    )
+
+    # the job was forked by the zygote, with the usual arguments and working directory
+    assert tmp_file_output.read_text().split() == [
+        str(zygote_proc.pid),
+        str(tmp_file_input),
+        f"{tmp_path}/",
+        str(tmp_path),
+    ]
+    assert "Exception: forceError" in tmp_file_error.read_text()
+
+
+def test_zygote_pinned(mocker, tmp_path, zygote):
+    """Test that the jobs forked by a zygote get the thread pools of their CPU lease"""
+    socket_dir, zygote_proc = zygote
+    mock_configuration = mocker.Mock(spec=Configuration)
+    mock_configuration.python_executable = sys.executable
+    mock_configuration.comm_only = False
+    mock_configuration.system_mem_limit_perc = 60.0
+    mock_configuration.mem_check_interval_sec = 0.01
+    mock_configuration.task_time_limit_minutes = 60.0
+    mock_configuration.zygote_enabled = True
+    mock_configuration.zygote_socket_dir = str(socket_dir)
+    mock_configuration.cpu_pinning = True
+    mock_configuration.cpu_lease_dir = (tmp_path / "leases").as_posix()
+
+    tmp_file_script = tmp_path / "reduce_TEST.py"
+    tmp_file_script.write_text(
+        'CONDA_ENV = "zygote-test"\nimport os\nprint(os.getppid(), os.environ["OMP_NUM_THREADS"])\n'
+    )
+    tmp_file_output = tmp_path / "out"
+
+    local_submission(mock_configuration, tmp_file_script, "input", tmp_path, tmp_file_output, tmp_path / "err")
+
+    assert tmp_file_output.read_text().split() == [str(zygote_proc.pid), str(len(os.sched_getaffinity(0)))]
+
+
+def test_zygote_time_limit(mocker, tmp_path, zygote, caplog):
+    """Test that jobs forked by a zygote are supervised like any other job"""
+    socket_dir, _ = zygote
+    mock_configuration = mocker.Mock(spec=Configuration)
+    mock_configuration.python_executable = sys.executable
+    mock_configuration.comm_only = False
+    mock_configuration.exceptions = []
+    mock_configuration.mem_check_interval_sec = 0.01
+    mock_configuration.system_mem_limit_perc = 50.0
+    mock_configuration.task_time_limit_minutes = 0.2 / 60.0
+    mock_configuration.zygote_enabled = True
+    mock_configuration.zygote_socket_dir = str(socket_dir)
+    caplog.set_level(logging.INFO)
+
+    tmp_file_script = tmp_path / "reduce_TEST.py"
+    tmp_file_script.write_text('CONDA_ENV = "zygote-test"\nimport time\ntime.sleep(30)\n')
+    tmp_file_error = tmp_path / "err"
+
+    start = time.time()
+    local_submission(
+        mock_configuration,
+        tmp_file_script,
+        tmp_path / "in",
+        tmp_path,
+        tmp_path / "out",
+        tmp_file_error,
+    )
+    assert time.time() - start < 10.0
+    assert "Reduction forked by the zygote-test zygote" in caplog.text
+    success, status_data = determine_success_local(mock_configuration, tmp_file_error)
+    assert not success
+    assert "Time limit exceeded" in status_data["error"]
+
+
+@pytest.mark.parametrize("time_limit_sec", [2.0, 60.0])
+def test_zygote_lost(mocker, tmp_path, zygote, time_limit_sec):
+    """Test that a job whose zygote dies is still supervised until it exits, and reported as failed"""
+    socket_dir, zygote_proc = zygote
+    mock_configuration = mocker.Mock(spec=Configuration)
+    mock_configuration.python_executable = sys.executable
+    mock_configuration.comm_only = False
+    mock_configuration.exceptions = []
+    mock_configuration.mem_check_interval_sec = 0.01
+    mock_configuration.system_mem_limit_perc = 50.0
+    mock_configuration.task_time_limit_minutes = time_limit_sec / 60.0
+    mock_configuration.zygote_enabled = True
+    mock_configuration.zygote_socket_dir = str(socket_dir)
+
+    tmp_file_script = tmp_path / "reduce_TEST.py"
+    sleep = 30 if time_limit_sec < 10 else 3
+    tmp_file_script.write_text(
+        'CONDA_ENV = "zygote-test"\n'
+        "import os, time\n"
+        "print(os.getpid(), flush=True)\n"
+        f"time.sleep({sleep})\n"
+        'print("done")\n'
+    )
+    tmp_file_output = tmp_path / "out"
+    tmp_file_error = tmp_path / "err"
+
+    killer = threading.Timer(0.7, zygote_proc.kill)
+    killer.start()
+    start = time.time()
+    termination = local_submission(
+        mock_configuration, tmp_file_script, tmp_path / "in", tmp_path, tmp_file_output, tmp_file_error
+    )
+    elapsed = time.time() - start
+    killer.join()
+
+    pid = int(tmp_file_output.read_text().split()[0])
+    assert not psutil.pid_exists(pid) or psutil.Process(pid).status() == psutil.STATUS_ZOMBIE
+    success, status_data = determine_success_local(mock_configuration, tmp_file_error)
+    assert not success
+    if time_limit_sec < 10:
+        # the time limit still applies
+        assert termination == TERMINATED_TIME_LIMIT
+        assert 2.0 <= elapsed < 10.0
+        assert "Time limit exceeded" in status_data["error"]
+    else:
+        # the job ran to its end, but its exit status is unknown
+        assert termination is None
+        assert elapsed >= 3.0
+        assert tmp_file_output.read_text().split()[1] == "done"
+        assert "Lost the zygote" in status_data["error"]
+
+
+def test_zygote_client_gone(tmp_path, zygote):
+    """Test that a job is killed when its client goes away"""
+    socket_dir, _ = zygote
+    configuration = type("ZygoteConfiguration", (), {"zygote_socket_dir": str(socket_dir)})()
+    script = tmp_path / "reduce_TEST.py"
+    script.write_text(
+        "import subprocess, sys, time\n"
+        "subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'])\n"
+        "time.sleep(30)\n"
+    )
+
+    # a client that connects without sending its request does not hold up the others
+    idle = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    idle.connect(get_zygote_socket_path(configuration, "zygote-test"))
+
+    start = time.time()
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(get_zygote_socket_path(configuration, "zygote-test"))
+    with open(tmp_path / "out", "w") as out, open(tmp_path / "err", "w") as err:
+        request = {"script": str(script), "args": [], "cwd": str(tmp_path)}
+        socket.send_fds(connection, [json.dumps(request).encode()], [out.fileno(), err.fileno()])
+    connection.settimeout(10.0)
+    pid = json.loads(connection.recv(4096).split(b"\n")[0])["pid"]
+    assert time.time() - start < 2.0
+    job = psutil.Process(pid)
+    for _ in range(100):
+        if job.children():
+            break
+        time.sleep(0.05)
+    child = job.children()[0]
+
+    # the job, and the processes it started, are killed when the client goes away
+    connection.close()
+    gone, alive = psutil.wait_procs([job, child], timeout=5.0)
+    assert not alive
+    idle.close()
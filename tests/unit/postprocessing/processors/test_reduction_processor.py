@@ -0,0 +1,125 @@
+import json
+import os
+from unittest.mock import Mock, patch
+
+import h5py
+import pytest
+
+from postprocessing.processors import job_handling
+from postprocessing.processors.reduction_processor import ReductionProcessor, ReductionProcessorHighMemory
+
+
+@pytest.fixture
+def reduction(tmp_path):
+    """Message and configuration of a reduction, with its script and data file"""
+    data_file = tmp_path / "EQSANS_30892.nxs.h5"
+    data_file.write_text("")
+    shared = tmp_path / "shared"
+    shared.mkdir()
+    (shared / "reduce_EQSANS.py").write_text("")
+    data = {
+        "run_number": "30892",
+        "instrument": "EQSANS",
+        "ipts": "IPTS-10674",
+        "facility": "SNS",
+        "data_file": data_file.as_posix(),
+    }
+    conf = Mock()
+    conf.dev_instrument_shared = shared.as_posix()
+    conf.dev_output_dir = (tmp_path / "output").as_posix()
+    conf.tracing_enabled = False
+    conf.himem_max_reroutes = 1
+    conf.run_metadata_cache_dir = ""
+    return data, conf
+
+
+@pytest.mark.parametrize(
+    "processor_class, reroutes, termination, rerouted",
+    [
+        (ReductionProcessor, 0, job_handling.TERMINATED_MEMORY_LIMIT, True),
+        (ReductionProcessor, 1, job_handling.TERMINATED_MEMORY_LIMIT, False),
+        (ReductionProcessor, 0, job_handling.TERMINATED_TIME_LIMIT, False),
+        (ReductionProcessorHighMemory, 0, job_handling.TERMINATED_MEMORY_LIMIT, False),
+    ],
+)
+def test_reroute(reduction, processor_class, reroutes, termination, rerouted):
+    data, conf = reduction
+    if reroutes:
+        data["himem_reroutes"] = reroutes
+    send = Mock()
+    error = {"error": "REDUCTION: Total memory usage exceeded limit"}
+    submission = {
+        "local_submission": Mock(return_value=termination),
+        "determine_success_local": Mock(return_value=(False, error)),
+    }
+    with patch.multiple(job_handling, **submission):
+        processor_class(dict(data), conf, send)()
+
+    sent = [(call[0][0], json.loads(call[0][1])) for call in send.call_args_list]
+    destinations = [destination for destination, _ in sent]
+    if rerouted:
+        assert destinations == [
+            "/queue/REDUCTION.STARTED",
+            "/queue/REDUCTION.HIMEM.DATA_READY",
+            "/topic/REDUCTION.REROUTED",
+        ]
+        # the original message, with the number of times it was rerouted
+        assert sent[1][1] == dict(data, himem_reroutes=1)
+        assert sent[2][1]["status"] == "rerouted"
+    else:
+        assert destinations == ["/queue/REDUCTION.STARTED", "/queue/REDUCTION.ERROR"]
+        assert sent[1][1]["error"] == error["error"]
+
+
+def test_staged_data_file(reduction, tmp_path):
+    data, conf = reduction
+    staged = tmp_path / "scratch" / "EQSANS_30892.nxs.h5"
+    staged.parent.mkdir()
+    staged.write_text("")
+    send = Mock()
+    submission = {
+        "local_submission": Mock(return_value=0),
+        "determine_success_local": Mock(return_value=(True, {})),
+    }
+    with patch.multiple(job_handling, **submission):
+        ReductionProcessor(dict(data, staged_data_file=staged.as_posix()), conf, send)()
+
+    # the reduction reads the copy, the messages name the shared file
+    assert submission["local_submission"].call_args[0][2] == staged.as_posix()
+    for call in send.call_args_list:
+        assert json.loads(call[0][1]) == data
+
+
+def test_prewarmed_bytes(reduction, tmp_path):
+    data, conf = reduction
+    submission = {
+        "local_submission": Mock(return_value=0),
+        "determine_success_local": Mock(return_value=(True, {})),
+    }
+    send = Mock()
+    with patch.multiple(job_handling, **submission):
+        ReductionProcessor(dict(data, prewarmed_bytes=3 * 1024**2), conf, send)()
+
+    # written to the reduction log for ar_report
+    out_log = submission["local_submission"].call_args[0][4]
+    assert open(out_log).read() == "PageCache-[Notice] Prewarmed 3.0 MiB of EQSANS_30892.nxs.h5\n"
+    assert "prewarmed_bytes" not in json.loads(send.call_args[0][1])
+
+
+def test_run_metadata_cache(reduction, tmp_path):
+    data, conf = reduction
+    with h5py.File(data["data_file"], "w") as handle:
+        entry = handle.create_group("entry")
+        entry.create_dataset("start_time", data=["2023-08-16T13:30:00"])
+        entry.create_dataset("end_time", data=["2023-08-16T13:31:00"])
+        entry.create_dataset("duration", (1,), data=[60.0])
+    conf.run_metadata_cache_dir = (tmp_path / "metadata").as_posix()
+    submission = {
+        "local_submission": Mock(return_value=0),
+        "determine_success_local": Mock(return_value=(True, {})),
+    }
+    with patch.multiple(job_handling, **submission):
+        ReductionProcessor(dict(data), conf, Mock())()
+
+    # ar_report finds the metadata of the run without opening the data file
+    assert len(os.listdir(conf.run_metadata_cache_dir)) == 1
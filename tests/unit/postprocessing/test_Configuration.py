@@ -3,9 +3,12 @@ from postprocessing.Configuration import (
     Configuration,
     initialize_logging,
     read_configuration,
+    SNAPSHOT_ENV,
     StreamToLogger,
 )
 
+from postprocessing.processors.job_handling import local_submission
+
 # third-party imports
 import pytest
 
@@ -115,6 +118,57 @@ def test_log_level(log_level_str, config, tmp_path):
     assert logging.root.level == expected_log_level
 
 
+def test_snapshot(data_server, tmp_path):
+    config_file = tmp_path / "post_processing.conf"
+    config_file.write_text(open(data_server.path_to("post_processing.conf")).read())
+    conf = Configuration(config_file.as_posix())
+    snapshot = conf.snapshot()
+    assert conf.snapshot() is snapshot  # unchanged file: not read again
+
+    copy = Configuration.from_snapshot(snapshot)
+    assert copy.config_file == conf.config_file
+    assert copy.queues == conf.queues
+    assert copy.log_file == conf.log_file
+
+    # a change on disk is picked up by the next snapshot
+    contents = json.loads(config_file.read_text())
+    contents["max_procs"] = 42
+    config_file.write_text(json.dumps(contents))
+    os.utime(config_file, ns=(0, 1))
+    assert Configuration.from_snapshot(conf.snapshot()).max_procs == 42
+    assert conf.max_procs != 42
+
+    # an invalid file is not handed to the jobs
+    config_file.write_text("{")
+    assert Configuration.from_snapshot(conf.snapshot()).max_procs == 42
+
+
+def test_read_configuration_snapshot(data_server, tmp_path, monkeypatch):
+    conf = Configuration(data_server.path_to("post_processing.conf"))
+    contents = json.loads(conf.snapshot())
+    contents["config"]["log_file"] = (tmp_path / "job.log").as_posix()
+    # the jobs do not look for the file
+    contents["config_file"] = "/does/not/exist.conf"
+    monkeypatch.setenv(SNAPSHOT_ENV, json.dumps(contents))
+    backup = sys.stderr
+    try:
+        job_conf = read_configuration(defaults=[])
+    finally:
+        sys.stderr = backup
+    assert job_conf.config_file == "/does/not/exist.conf"
+    assert job_conf.log_file == (tmp_path / "job.log").as_posix()
+
+    # the reductions started by the job do not inherit the snapshot, and its secrets
+    assert SNAPSHOT_ENV not in os.environ
+    job_conf.comm_only = False
+    job_conf.python_executable = sys.executable
+    script = tmp_path / "reduce_TEST.py"
+    script.write_text(f"import os\nprint(os.environ.get('{SNAPSHOT_ENV}'))\n")
+    out_log = tmp_path / "out"
+    local_submission(job_conf, script, "input", tmp_path, out_log, tmp_path / "err")
+    assert out_log.read_text().strip() == "None"
+
+
 class TestStreamToLogger:
     def test_write(self, test_logger):
         sl = StreamToLogger(test_logger.logger)
@@ -0,0 +1,461 @@
+import io
+import json
+import os
+import threading
+import time
+from unittest.mock import Mock, patch
+
+import pytest
+
+from postprocessing.Configuration import Configuration
+from postprocessing.Consumer import BrokerLink, Consumer, ControlListener, Listener
+from postprocessing.processors import get_queue_resources
+
+
+@pytest.fixture
+def config_file(data_server, tmp_path):
+    config_file = tmp_path / "post_processing.conf"
+    config_file.write_text(open(data_server.path_to("post_processing.conf")).read())
+    return config_file
+
+
+@patch("postprocessing.Consumer.signal.signal")
+def test_reload_configuration(mock_signal, config_file):
+    consumer = Consumer(Configuration(config_file.as_posix()))
+    link = BrokerLink(("activemq", 61613), consumer._listener)
+    link.conn = Mock()
+    link.subscriptions = set(consumer.config.queues)
+    consumer._links = [link]
+    listener_config = consumer.config
+
+    contents = json.loads(config_file.read_text())
+    contents["max_procs"] = 3
+    contents["processors"].remove("oncat_processor.ONCatProcessor")
+    contents["processors"].append("test_processor.TestProcessor")
+    config_file.write_text(json.dumps(contents))
+    os.utime(config_file, ns=(0, 1))
+
+    assert consumer.reload_configuration()
+    link.conn.unsubscribe.assert_called_once_with(id="/queue/CATALOG.ONCAT.DATA_READY")
+    link.conn.subscribe.assert_called_once_with(
+        destination="/queue/REDUCTION.TESTPROCESSOR.DATA_READY",
+        id="/queue/REDUCTION.TESTPROCESSOR.DATA_READY",
+        ack="client",
+        headers={"activemq.prefetchSize": 0},
+    )
+    assert consumer.config.max_procs == 3
+    assert consumer._listener.config is consumer.config
+    assert consumer.config.heartbeat_ping not in consumer.config.queues  # on the control connection
+    assert listener_config.max_procs == 10  # running messages keep their configuration
+
+    # an invalid file is ignored until it changes again
+    config_file.write_text("{")
+    assert not consumer.reload_configuration()
+    assert consumer.config.max_procs == 3
+    assert 'postprocessing_config_reloads_total{outcome="error"} 1' in consumer.metrics.render()
+
+
+@pytest.mark.parametrize("payload_stdin", [True, False])
+@patch("postprocessing.Consumer.subprocess.Popen")
+def test_payload(mock_popen, payload_stdin, data_server):
+    config = Configuration(data_server.path_to("post_processing.conf"))
+    config.task_payload_stdin = payload_stdin
+    proc = mock_popen.return_value
+    proc.stdin = io.BytesIO()
+    proc.stdin.close = Mock()  # keep the contents readable
+    proc.stdout = io.BytesIO(b"")
+    proc.poll.return_value = 0
+
+    body = json.dumps({"instrument": "EQSANS", "template_data": {"title": "a title with spaces"}})
+    frame = Mock()
+    frame.headers = {"destination": "/queue/REDUCTION.CREATE_SCRIPT", "message-id": "1", "subscription": "1"}
+    frame.body = body
+    Listener(config, Mock()).on_message(frame)
+
+    args = mock_popen.call_args[0][0]
+    assert args[-4:-1] == ["-q", "/queue/REDUCTION.CREATE_SCRIPT", "-d"]
+    if payload_stdin:
+        assert args[-1] == "-"
+        for _ in range(50):
+            if proc.stdin.getvalue():
+                break
+            time.sleep(0.01)
+        assert proc.stdin.getvalue() == body.encode()
+    else:
+        assert args[-1] == body.replace(" ", "")
+        assert mock_popen.call_args[1]["stdin"] is None
+
+
+def test_control_listener(data_server):
+    config = Configuration(data_server.path_to("post_processing.conf"))
+    listener = Listener(config, Mock())
+    control = Mock()
+    frame = Mock()
+    frame.headers = {"destination": config.heartbeat_ping}
+    frame.body = json.dumps({"reply_to": "/topic/REPLY"})
+    ControlListener(listener, control).on_message(frame)
+
+    # the reply is sent on the control connection, not on the one of the jobs
+    listener.conn.send.assert_not_called()
+    destination, body = control.send.call_args[0]
+    assert destination == "/topic/REPLY"
+    assert json.loads(body)["load"]["jobs_running"] == 0
+
+
+@patch("postprocessing.Consumer.signal.signal")
+@patch("postprocessing.Consumer.stomp.Connection")
+def test_broker_links(mock_connection, mock_signal, data_server):
+    config = Configuration(data_server.path_to("post_processing.conf"))
+    config.brokers = [("broker1", 61613), ("broker2", 61613)]
+    connections = {}
+
+    def make_connection(host_and_ports, **kwargs):
+        conn = Mock()
+        conn.is_connected.return_value = True
+        if host_and_ports == [("broker2", 61613)]:
+            conn.connect.side_effect = ConnectionError("broker2 is down")
+        connections[tuple(host_and_ports)] = conn
+        return conn
+
+    mock_connection.side_effect = make_connection
+    consumer = Consumer(config)
+    consumer.connect()
+    link1, link2 = consumer._links
+    assert link1.is_connected() and not link2.is_connected()
+    assert link2.delay == 1.0
+    # the control connection uses the brokers that can be reached
+    assert (("broker1", 61613),) in connections
+    assert len(link1.conn.subscribe.call_args_list) == len(config.queues)
+
+    # a broker that cannot be reached is not tried again before the end of its backoff
+    consumer.connect()
+    assert mock_connection.call_count == 3
+    link2.retry_time = 0
+    consumer.connect()
+    assert mock_connection.call_count == 4
+    assert link2.delay == 2.0
+
+    # the messages are acked on the connection they came from
+    with patch.object(consumer._listener, "dispatch") as mock_dispatch:
+        link1.on_message("frame")
+    assert mock_dispatch.call_args[0][:2] == ("frame", link1.conn)
+
+
+@patch("postprocessing.Consumer.signal.signal")
+@patch("postprocessing.Consumer.stomp.Connection")
+def test_broker_link_subscribe_failure(mock_connection, mock_signal, data_server):
+    config = Configuration(data_server.path_to("post_processing.conf"))
+    conn = mock_connection.return_value
+    conn.is_connected.return_value = True
+    conn.subscribe.side_effect = [None, ConnectionError("subscription refused")]
+
+    link = BrokerLink(("broker1", 61613), Listener(config, None))
+    assert not link.connect(config)
+    # the link is not left half subscribed
+    assert link.conn is None and not link.is_connected()
+    conn.disconnect.assert_called_once()
+    assert link.delay == 1.0
+
+    # the control connection does not retry either
+    conn.subscribe.side_effect = None
+    consumer = Consumer(config)
+    conn.subscribe.reset_mock()
+    consumer.get_control_connection()
+    assert mock_connection.call_args[1]["reconnect_attempts_max"] == 1
+    # the control commands are opt-in: only the pings are subscribed to
+    conn.subscribe.assert_called_once_with(destination=config.heartbeat_ping, id="ping", ack="auto")
+
+
+@patch("postprocessing.Consumer.signal.signal")
+def test_pause(mock_signal, data_server):
+    config = Configuration(data_server.path_to("post_processing.conf"))
+    consumer = Consumer(config)
+    listener = consumer._listener
+    link = BrokerLink(("broker1", 61613), listener)
+    link.conn = Mock()
+    link.subscriptions = set(config.queues)
+
+    # a paused queue is left on the broker
+    listener.control({"command": "pause", "queue": "/queue/CATALOG.ONCAT.DATA_READY"})
+    link.sync(config)
+    link.conn.unsubscribe.assert_called_once_with(id="/queue/CATALOG.ONCAT.DATA_READY")
+    assert link.subscriptions == {"/queue/REDUCTION_CATALOG.DATA_READY"}
+
+    # the message of a paused instrument is sent back to the broker, delivered again later, instead of
+    # being rejected until the broker sends it to the dead letter queue
+    listener.control({"command": "pause", "instrument": "EQSANS"})
+    message = make_frame("/queue/REDUCTION.DATA_READY", {"instrument": "EQSANS", "run_number": 12})
+    message.headers["priority"] = "7"
+    with patch("postprocessing.Consumer.subprocess.Popen") as mock_popen:
+        link.on_message(message)
+    mock_popen.assert_not_called()
+    link.conn.nack.assert_not_called()
+    link.conn.send.assert_called_once_with(
+        "/queue/REDUCTION.DATA_READY",
+        message.body,
+        headers={"priority": "7", "persistent": "true", "AMQ_SCHEDULED_DELAY": "60000"},
+    )
+    # acked once sent, so that the message is never lost
+    assert [name for name, _, _ in link.conn.method_calls[-2:]] == ["send", "ack"]
+
+    listener.control({"command": "resume", "queue": "/queue/CATALOG.ONCAT.DATA_READY"})
+    link.sync(config)
+    link.conn.subscribe.assert_called_once()
+    assert link.conn.subscribe.call_args[1]["id"] == "/queue/CATALOG.ONCAT.DATA_READY"
+
+
+def make_frame(destination, body):
+    frame = Mock()
+    frame.headers = {"destination": destination, "message-id": "1", "subscription": "1"}
+    frame.body = json.dumps(body)
+    return frame
+
+
+@patch("postprocessing.Consumer.terminate_or_kill_process_tree")
+@patch("postprocessing.Consumer.subprocess.Popen")
+def test_control(mock_popen, mock_terminate, data_server):
+    config = Configuration(data_server.path_to("post_processing.conf"))
+    config.task_payload_stdin = False
+    config.control_topic = "/topic/SNS.COMMON.POSTPROCESSING.CONTROL"
+    proc = mock_popen.return_value
+    proc.pid = 1234
+    proc.stdout = io.BytesIO(b"")
+    proc.poll.return_value = None
+    conn = Mock()
+    listener = Listener(config, conn)
+    control = Mock()
+    control_listener = ControlListener(listener, control)
+
+    def command(body):
+        control_listener.on_message(make_frame(config.control_topic, body))
+        destination, reply = control.send.call_args[0]
+        return destination, json.loads(reply)
+
+    # the message of a paused instrument is sent back to the broker
+    destination, reply = command({"command": "pause", "instrument": "eqsans", "id": "a"})
+    assert destination == config.heart_beat
+    assert (reply["result"], reply["id"], reply["paused_instruments"]) == ("OK", "a", ["EQSANS"])
+    message = make_frame("/queue/REDUCTION.DATA_READY", {"instrument": "EQSANS", "run_number": 12})
+    listener.on_message(message)
+    conn.send.assert_called_once()
+    mock_popen.assert_not_called()
+
+    command({"command": "resume", "instrument": "EQSANS"})
+    command({"command": "set_limits", "max_procs": 20, "instrument_limits": {"eqsans": 1}})
+    assert (config.max_procs, listener.instrument_limits) == (20, {"EQSANS": 1})
+    listener.on_message(message)
+    assert conn.ack.call_count == 2
+    mock_popen.assert_called_once()
+    # the instrument has reached its own limit
+    listener.on_message(message)
+    conn.nack.assert_called_once()
+
+    _, reply = command({"command": "dump", "reply_to": "/topic/REPLY"})
+    assert [(job["pid"], job["instrument"], job["run_number"]) for job in reply["jobs"]] == [(1234, "EQSANS", "12")]
+
+    _, reply = command({"command": "cancel", "run_number": 12})
+    assert reply["cancelled"] == [1234]
+    mock_terminate.assert_called_once_with(1234)
+
+    _, reply = command({"command": "reboot"})
+    assert (reply["result"], reply["error"]) == ("ERROR", "Unknown command: reboot")
+
+    # commands for another node are ignored
+    control.reset_mock()
+    control_listener.on_message(make_frame(config.control_topic, {"command": "dump", "node": "elsewhere"}))
+    control.send.assert_not_called()
+
+
+@patch("postprocessing.Consumer.subprocess.Popen")
+def test_slot_limits(mock_popen, data_server):
+    config = Configuration(data_server.path_to("post_processing.conf"))
+    processors = ["reduction_processor.ReductionProcessor", "reduction_processor.ReductionProcessorHighMemory"]
+    config.queue_slots = get_queue_resources(processors + ["oncat_processor.ONCatProcessor"])
+    assert config.queue_slots["/queue/REDUCTION.HIMEM.DATA_READY"] == ("heavy", 2.0)
+    assert config.queue_slots["/queue/CATALOG.ONCAT.DATA_READY"] == ("light", 1.0)
+    config.task_payload_stdin = False
+    config.jobs_per_instrument = 0
+    config.slot_limits = {"heavy": 2}
+    config.instrument_slot_limits = {"HYS": {"light": 2}}
+    config.queues = ["/queue/REDUCTION.DATA_READY", "/queue/CATALOG.ONCAT.DATA_READY"]
+    procs = []
+
+    def start_job(*args, **kwargs):
+        proc = Mock(pid=len(procs), stdout=io.BytesIO(b""))
+        proc.poll.return_value = None
+        procs.append(proc)
+        return proc
+
+    mock_popen.side_effect = start_job
+    conn = Mock()
+    listener = Listener(config, conn)
+
+    def started(queue, instrument):
+        jobs = len(procs)
+        listener.on_message(make_frame(queue, {"instrument": instrument, "run_number": 1}))
+        return len(procs) > jobs
+
+    # a high-memory reduction takes both heavy slots, even though it is the first heavy job
+    assert started("/queue/REDUCTION.HIMEM.DATA_READY", "SNAP")
+    # the heavy queues are left to the other nodes
+    assert listener.subscribed_queues(config) == ["/queue/CATALOG.ONCAT.DATA_READY"]
+    assert not started("/queue/REDUCTION.DATA_READY", "EQSANS")
+    # the light jobs keep flowing, up to the limit of the instrument
+    assert started("/queue/CATALOG.ONCAT.DATA_READY", "HYS")
+    assert started("/queue/CATALOG.ONCAT.DATA_READY", "HYS")
+    assert not started("/queue/CATALOG.ONCAT.DATA_READY", "HYS")
+    assert started("/queue/CATALOG.ONCAT.DATA_READY", "EQSANS")
+    assert listener.load_info()["slots_used"] == {"heavy": 2.0, "light": 3.0}
+    # the messages over the limits are rejected, for the other nodes or later, like those over jobs_per_instrument
+    assert conn.nack.call_count == 2
+
+    procs[0].poll.return_value = 0
+    assert listener.subscribed_queues(config) == config.queues
+    assert started("/queue/REDUCTION.DATA_READY", "EQSANS")
+
+
+@patch("postprocessing.Consumer.subprocess.Popen")
+def test_pressure_throttling(mock_popen, data_server, tmp_path):
+    config = Configuration(data_server.path_to("post_processing.conf"))
+    config.queue_slots = get_queue_resources(
+        ["reduction_processor.ReductionProcessor", "oncat_processor.ONCatProcessor"]
+    )
+    config.task_payload_stdin = False
+    config.psi_enabled = True
+    config.psi_thresholds = {"memory": 10.0}
+    mock_popen.return_value = Mock(stdout=io.BytesIO(b""))
+    conn = Mock()
+    listener = Listener(config, conn)
+    listener.pressure.pressure_dir = tmp_path.as_posix()
+    listener.pressure.check_interval = 0
+    (tmp_path / "memory").write_text("some avg10=25.00 avg60=0.00 avg300=0.00 total=0\n")
+
+    config.queues = ["/queue/REDUCTION.DATA_READY", "/queue/CATALOG.ONCAT.DATA_READY"]
+    listener.on_message(make_frame("/queue/REDUCTION.DATA_READY", {"instrument": "EQSANS", "run_number": 1}))
+    # the heavy message is sent back to the broker, delivered again later, and its queue left to the other nodes
+    conn.nack.assert_not_called()
+    mock_popen.assert_not_called()
+    assert conn.send.call_args[0][0] == "/queue/REDUCTION.DATA_READY"
+    assert conn.send.call_args[1]["headers"]["AMQ_SCHEDULED_DELAY"] == "60000"
+    assert listener.load_info()["pressure_throttled"]
+    assert listener.subscribed_queues(config) == ["/queue/CATALOG.ONCAT.DATA_READY"]
+    # the light jobs are not held
+    listener.on_message(make_frame("/queue/CATALOG.ONCAT.DATA_READY", {"instrument": "EQSANS", "run_number": 1}))
+    mock_popen.assert_called_once()
+
+    # the heavy queue is subscribed to again once the pressure is back to normal
+    (tmp_path / "memory").write_text("some avg10=1.00 avg60=0.00 avg300=0.00 total=0\n")
+    assert listener.subscribed_queues(config) == config.queues
+    listener.on_message(make_frame("/queue/REDUCTION.DATA_READY", {"instrument": "EQSANS", "run_number": 1}))
+    assert mock_popen.call_count == 2
+
+
+@patch("postprocessing.Consumer.time.sleep")
+@patch("postprocessing.Consumer.subprocess.Popen")
+def test_scratch_staging(mock_popen, mock_sleep, data_server, tmp_path):
+    config = Configuration(data_server.path_to("post_processing.conf"))
+    config.queue_slots = get_queue_resources(["reduction_processor.ReductionProcessor"])
+    config.task_payload_stdin = False
+    config.jobs_per_instrument = 0
+    config.max_procs = 1
+    config.scratch_staging = True
+    config.scratch_dir = (tmp_path / "scratch").as_posix()
+    data_file = tmp_path / "EQSANS_1.nxs.h5"
+    data_file.write_bytes(bytes(1000))
+    procs = []
+
+    def start_job(*args, **kwargs):
+        proc = Mock(pid=len(procs), stdout=io.BytesIO(b""))
+        proc.poll.return_value = None
+        procs.append(proc)
+        return proc
+
+    mock_popen.side_effect = start_job
+    listener = Listener(config, Mock())
+    message = make_frame("/queue/REDUCTION.DATA_READY", {"instrument": "EQSANS", "data_file": data_file.as_posix()})
+    listener.on_message(message)
+    assert "staged_data_file" not in mock_popen.call_args[0][0][-1]
+
+    # the second job waits for the first one, while its data file is copied
+    def finish_first(delay):
+        for copy, _ in list(listener.stager.copies.values()):
+            copy.result()
+        procs[0].poll.return_value = 0
+
+    mock_sleep.side_effect = finish_first
+    listener.on_message(message)
+    staged = listener.stager.local_path(data_file.as_posix())
+    assert json.loads(mock_popen.call_args[0][0][-1])["staged_data_file"] == staged
+    assert listener.stager.in_use[staged] == 1
+    procs[1].poll.return_value = 0
+    listener.update_processes()
+    assert staged not in listener.stager.in_use
+
+
+@patch("postprocessing.Consumer.time.sleep")
+@patch("postprocessing.Consumer.subprocess.Popen")
+def test_page_cache_prewarm(mock_popen, mock_sleep, data_server, tmp_path):
+    config = Configuration(data_server.path_to("post_processing.conf"))
+    config.queue_slots = get_queue_resources(["reduction_processor.ReductionProcessor"])
+    config.task_payload_stdin = False
+    config.jobs_per_instrument = 0
+    config.max_procs = 1
+    config.page_cache_prewarm = True
+    data_file = tmp_path / "EQSANS_1.nxs.h5"
+    data_file.write_bytes(bytes(1000))
+    procs = []
+
+    def start_job(*args, **kwargs):
+        proc = Mock(pid=len(procs), stdout=io.BytesIO(b""))
+        proc.poll.return_value = None
+        procs.append(proc)
+        return proc
+
+    def finish_first(delay):
+        procs[0].poll.return_value = 0
+
+    mock_popen.side_effect = start_job
+    mock_sleep.side_effect = finish_first
+    listener = Listener(config, Mock())
+    message = make_frame("/queue/REDUCTION.DATA_READY", {"instrument": "EQSANS", "data_file": data_file.as_posix()})
+    with patch("postprocessing.page_cache.prewarm", return_value=1000) as mock_prewarm:
+        listener.on_message(message)
+        mock_prewarm.assert_not_called()
+        # the second job waits for the first one, while its data file is read ahead
+        listener.on_message(message)
+    assert mock_prewarm.call_args[0][:2] == (data_file.as_posix(), 1000)
+    assert json.loads(mock_popen.call_args[0][0][-1])["prewarmed_bytes"] == 1000
+
+
+@patch("postprocessing.Consumer.subprocess.Popen")
+def test_concurrent_jobs(mock_popen, data_server):
+    config = Configuration(data_server.path_to("post_processing.conf"))
+    config.task_payload_stdin = False
+    config.jobs_per_instrument = 0
+    outputs = []
+
+    def start_job(*args, **kwargs):
+        read, write = os.pipe()
+        outputs.append(os.fdopen(write, "wb"))
+        proc = Mock(pid=len(outputs), stdout=os.fdopen(read, "rb"))
+        proc.poll.return_value = None
+        return proc
+
+    mock_popen.side_effect = start_job
+    listener = Listener(config, Mock())
+    # the messages are dispatched while the jobs before them still run
+    for run_number in range(3):
+        listener.on_message(
+            make_frame("/queue/REDUCTION.DATA_READY", {"instrument": "EQSANS", "run_number": run_number})
+        )
+    assert listener.load_info()["jobs_running"] == 3
+
+    # their output is relayed as it comes
+    relay = next(thread for thread in threading.enumerate() if thread.name == "job-2")
+    with patch("postprocessing.Consumer.logging.subprocess", create=True) as mock_log:
+        outputs[1].write(b"reducing run 1\n")
+        outputs[1].close()
+        relay.join(5.0)
+    mock_log.assert_called_once_with("reducing run 1")
+    for output in outputs[::2]:
+        output.close()
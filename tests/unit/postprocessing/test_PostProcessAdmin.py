@@ -1,8 +1,14 @@
 from postprocessing.PostProcessAdmin import PostProcessAdmin
+from postprocessing import processors
+from postprocessing.processors import get_dispatch_table
 
 # third-party imports
 import pytest
 
+# standard imports
+import threading
+from unittest.mock import Mock
+
 
 def createEmptyFile(filename):
     with open(filename, "w"):
@@ -15,5 +21,50 @@ def test_bad_constructor():
         _ = PostProcessAdmin()
 
 
+def test_dispatch_table(mocker):
+    mocker.patch.dict(processors.PROCESSOR_QUEUES, {"fanout.First": "/queue/FANOUT", "fanout.Second": "/queue/FANOUT"})
+    table = get_dispatch_table(
+        ("reduction_processor.ReductionProcessor", "fanout.First", "fanout.Second", "fanout.First")
+    )
+    assert table == {
+        "/queue/REDUCTION.DATA_READY": ("reduction_processor.ReductionProcessor",),
+        "/queue/FANOUT": ("fanout.First", "fanout.Second"),
+    }
+
+
+def test_process_fan_out(mocker):
+    mocker.patch.dict(processors.PROCESSOR_QUEUES, {"fanout.Run": "/queue/FANOUT", "fanout.Fail": "/queue/FANOUT"})
+    # both processors must be running at the same time to get past the barrier
+    barrier = threading.Barrier(2, timeout=5)
+    received = []
+
+    class Processor:
+        def __init__(self, data, conf, send_function):
+            data["processor"] = self
+            received.append(data)
+
+        def __call__(self):
+            barrier.wait()
+
+        def write_trace(self):
+            pass
+
+    class FailingProcessor(Processor):
+        def __call__(self):
+            barrier.wait()
+            raise RuntimeError("failed")
+
+    classes = {"fanout.Run": Processor, "fanout.Fail": FailingProcessor}
+    mocker.patch("postprocessing.PostProcessAdmin.load_processor", side_effect=classes.get)
+    conf = Mock()
+    conf.processors = ["fanout.Run", "fanout.Fail"]
+    pp = PostProcessAdmin({"instrument": "EQSANS"}, conf)
+    with pytest.raises(RuntimeError, match="failed"):
+        pp.process("/queue/FANOUT")
+    # each processor gets its own copy of the data
+    assert len(received) == 2 and received[0] is not received[1]
+    assert "processor" not in pp.data
+
+
 if __name__ == "__main__":
     pytest.main([__file__])
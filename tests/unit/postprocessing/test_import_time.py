@@ -0,0 +1,56 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from postprocessing import processors
+from postprocessing.processors import PROCESSOR_QUEUES, get_input_queue_name, load_processor
+
+# Budget for the imports of PostProcessAdmin.py before it dispatches a message (seconds)
+IMPORT_TIME_BUDGET = 0.5
+# Slow imports that only the processors needing them should pay for
+HEAVY_MODULES = ["h5py", "numpy", "psutil", "pyoncat", "requests"]
+
+STARTUP = """
+import sys
+import postprocessing.PostProcessAdmin
+from postprocessing.Configuration import Configuration
+from postprocessing.processors import get_input_queue_name
+configuration = Configuration(sys.argv[1])
+[get_input_queue_name(p) for p in configuration.processors]
+print(",".join(sorted(name for name in sys.modules if name.split(".")[0] in {heavy})))
+"""
+
+
+@pytest.mark.parametrize("processor", sorted(PROCESSOR_QUEUES))
+def test_manifest(processor):
+    assert load_processor(processor).get_input_queue_name() == PROCESSOR_QUEUES[processor]
+
+
+def test_manifest_fallback(mocker):
+    mocker.patch.dict(processors.PROCESSOR_QUEUES, clear=True)
+    assert get_input_queue_name("reduction_processor.ReductionProcessor") == "/queue/REDUCTION.DATA_READY"
+    with pytest.raises(ValueError):
+        load_processor("ReductionProcessor")
+
+
+def test_import_time(tmp_path):
+    config_file = os.path.join(os.path.dirname(__file__), "../../integration/post_processing.conf")
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", STARTUP.format(heavy=set(HEAVY_MODULES)), config_file],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=tmp_path,
+    )
+    # no processor is imported to resolve the queues, so neither are their dependencies
+    assert result.stdout.strip() == ""
+
+    # import time: self [us] | cumulative | imported package
+    total = 0
+    for line in result.stderr.splitlines():
+        fields = line.split("|")
+        if line.startswith("import time:") and fields[0].split(":")[1].strip().isdigit():
+            total += int(fields[0].split(":")[1])
+    assert total / 1e6 < IMPORT_TIME_BUDGET
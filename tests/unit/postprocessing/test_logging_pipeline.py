@@ -0,0 +1,77 @@
+import json
+import logging
+import queue
+
+from postprocessing.logging_pipeline import (
+    BatchRotatingFileHandler,
+    BatchingQueueListener,
+    BoundedQueueHandler,
+    get_formatter,
+    start_log_pipeline,
+    stop_log_pipeline,
+)
+
+
+def make_record(message, level=logging.INFO):
+    return logging.makeLogRecord(
+        {"name": "test", "levelno": level, "levelname": logging.getLevelName(level), "msg": message}
+    )
+
+
+def test_pipeline(tmp_path):
+    log_file = tmp_path / "postprocessing.log"
+    file_handler = BatchRotatingFileHandler(log_file.as_posix())
+    file_handler.setFormatter(get_formatter("json"))
+    logger = logging.getLogger("test_pipeline")
+    logger.propagate = False
+    logger.addHandler(start_log_pipeline(file_handler, 100))
+    try:
+        logger.warning("first %s", "message")
+        try:
+            raise ValueError("oops")
+        except ValueError:
+            logger.exception("failed")
+    finally:
+        stop_log_pipeline()
+        logger.handlers.clear()
+
+    entries = [json.loads(line) for line in log_file.read_text().splitlines()]
+    assert [(entry["level"], entry["message"].splitlines()[0]) for entry in entries] == [
+        ("WARNING", "first message"),
+        ("ERROR", "failed"),
+    ]
+    assert "ValueError: oops" in entries[1]["message"]
+
+
+def test_drop_policy(tmp_path):
+    log_file = tmp_path / "postprocessing.log"
+    file_handler = BatchRotatingFileHandler(log_file.as_posix())
+    file_handler.setFormatter(get_formatter("text"))
+    queue_handler = BoundedQueueHandler(queue.Queue(2), timeout=0.01)
+    for i in range(4):
+        queue_handler.handle(make_record(f"message {i}"))
+    queue_handler.handle(make_record("error", logging.ERROR))
+    assert queue_handler.dropped == 3
+
+    listener = BatchingQueueListener(queue_handler, file_handler)
+    listener.start()
+    listener.stop()
+    file_handler.close()
+    lines = log_file.read_text().splitlines()
+    assert [line.split(" ", 3)[3] for line in lines] == [
+        "message 0",
+        "message 1",
+        "Log queue full: dropped 3 records",
+    ]
+    assert lines[2].split()[2].startswith("WARNING/")
+
+
+def test_rollover(tmp_path):
+    log_file = tmp_path / "postprocessing.log"
+    file_handler = BatchRotatingFileHandler(log_file.as_posix(), maxBytes=30, backupCount=2)
+    file_handler.setFormatter(get_formatter("json"))
+    file_handler.emit_batch([make_record("a" * 20)])
+    file_handler.emit_batch([make_record("b" * 20), make_record("c" * 20)])
+    file_handler.close()
+    assert "aaaa" in (tmp_path / "postprocessing.log.1").read_text()
+    assert "cccc" in log_file.read_text()
@@ -0,0 +1,174 @@
+import io
+import json
+import socket
+import threading
+import time
+import urllib.request
+from unittest.mock import Mock, patch
+
+import pytest
+
+from postprocessing.Configuration import Configuration
+from postprocessing.Consumer import Listener
+from postprocessing.metrics import Metrics, start_metrics_servers
+
+
+def test_render():
+    metrics = Metrics()
+    metrics.describe("jobs_running", "gauge", "Jobs running")
+    metrics.inc("messages_total", queue="/queue/A", outcome="accepted")
+    metrics.inc("messages_total", queue="/queue/A", outcome="accepted")
+    metrics.set("jobs_running", 3)
+    metrics.observe("latency_seconds", 0.5, queue='/queue/"B"')
+    metrics.observe("latency_seconds", 1.5, queue='/queue/"B"')
+
+    text = metrics.render()
+    assert "# HELP jobs_running Jobs running\n# TYPE jobs_running gauge\njobs_running 3\n" in text
+    assert 'messages_total{outcome="accepted",queue="/queue/A"} 2\n' in text
+    assert 'latency_seconds_count{queue="/queue/\\"B\\""} 2\n' in text
+    assert 'latency_seconds_sum{queue="/queue/\\"B\\""} 2.000000\n' in text
+    assert 'latency_seconds_max{queue="/queue/\\"B\\""} 1.500000\n' in text
+
+
+@pytest.fixture
+def metrics_servers(tmp_path):
+    metrics = Metrics()
+    with metrics.time("step_seconds", step="test"):
+        pass
+    socket_path = str(tmp_path / "metrics.sock")
+    servers = start_metrics_servers(metrics, port=0, socket_path=socket_path)
+    yield servers, socket_path
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_scrape(metrics_servers):
+    servers, socket_path = metrics_servers
+    host, port = servers[0].server_address[:2]
+    with urllib.request.urlopen(f"http://{host}:{port}/metrics", timeout=5) as response:
+        assert response.status == 200
+        assert 'step_seconds_count{step="test"} 1' in response.read().decode()
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(socket_path)
+    text = b""
+    while chunk := client.recv(4096):
+        text += chunk
+    client.close()
+    assert 'step_seconds_count{step="test"} 1' in text.decode()
+
+
+def test_metrics_disabled():
+    assert start_metrics_servers(Metrics(), port=None, socket_path="") == []
+
+
+@patch("postprocessing.Consumer.subprocess.Popen")
+def test_listener_metrics(mock_popen):
+    config = Mock(spec=Configuration)
+    config.heartbeat_ping = "/topic/SNS.COMMON.STATUS.PING"
+    config.jobs_per_instrument = 2
+    config.max_procs = 5
+    config.python_dir = "/opt/postprocessing"
+    config.start_script = "python"
+    config.task_script = "PostProcessAdmin.py"
+    config.task_script_queue_arg = "-q"
+    config.task_script_data_arg = "-d"
+    proc = mock_popen.return_value
+    proc.stdout = io.BytesIO(b"")
+    proc.poll.return_value = 0
+
+    metrics = Metrics()
+    listener = Listener(config, Mock(), metrics)
+    frame = Mock()
+    frame.headers = {"destination": "/queue/REDUCTION.DATA_READY", "message-id": "1", "subscription": "1"}
+    frame.body = json.dumps({"instrument": "EQSANS", "facility": "SNS"})
+    listener.on_message(frame)
+
+    text = metrics.render()
+    labels = 'instrument="EQSANS",queue="/queue/REDUCTION.DATA_READY"'
+    assert "postprocessing_ack_latency_seconds_count{" + labels + "} 1" in text
+    assert "postprocessing_dispatch_latency_seconds_count{" + labels + "} 1" in text
+    assert "postprocessing_job_wall_time_seconds_count{" + labels + "} 1" in text
+    assert 'postprocessing_messages_total{instrument="EQSANS",outcome="accepted",queue=' in text
+    assert "postprocessing_jobs_running 0" in text
+
+
+@patch("postprocessing.Consumer.get_total_memory_usage", return_value=2048)
+@patch("postprocessing.Consumer.subprocess.Popen")
+def test_sample_running_job(mock_popen, mock_memory):
+    config = Mock(spec=Configuration)
+    config.heartbeat_ping = "/topic/SNS.COMMON.STATUS.PING"
+    config.jobs_per_instrument = 2
+    config.max_procs = 5
+    config.python_dir = "/opt/postprocessing"
+    config.start_script = "python"
+    config.task_script = "PostProcessAdmin.py"
+    config.task_script_queue_arg = "-q"
+    config.task_script_data_arg = "-d"
+    proc = mock_popen.return_value
+    proc.pid = 1234
+    proc.stdout = io.BytesIO(b"")
+    proc.poll.return_value = None
+
+    metrics = Metrics()
+    listener = Listener(config, Mock(), metrics)
+    frame = Mock()
+    frame.headers = {"destination": "/queue/REDUCTION.DATA_READY", "message-id": "1", "subscription": "1"}
+    frame.body = json.dumps({"instrument": "EQSANS", "facility": "SNS"})
+    with patch("postprocessing.Consumer.psutil.Process"):
+        listener.on_message(frame)
+        assert "postprocessing_jobs_running 1" in metrics.render()
+
+        # the memory of the job is sampled while no message arrives
+        mock_memory.return_value = 4096
+        assert listener.sample()
+        proc.poll.return_value = 0
+        with patch("postprocessing.Consumer.time.monotonic", return_value=time.monotonic() + 10.0):
+            assert listener.sample()
+
+    text = metrics.render()
+    labels = 'instrument="EQSANS",queue="/queue/REDUCTION.DATA_READY"'
+    assert "postprocessing_job_peak_memory_bytes_sum{" + labels + "} 4096" in text
+    assert "postprocessing_job_wall_time_seconds_count{" + labels + "} 1" in text
+    assert "postprocessing_jobs_running 0" in text
+    assert len(listener.finished_jobs) == 1
+
+    # skipped while a message is being dispatched
+    locked = threading.Event()
+    release = threading.Event()
+
+    def dispatching():
+        with listener.lock:
+            locked.set()
+            release.wait()
+
+    thread = threading.Thread(target=dispatching)
+    thread.start()
+    locked.wait()
+    assert not listener.sample()
+    release.set()
+    thread.join()
+
+
+def test_load_info():
+    config = Mock(spec=Configuration)
+    config.max_procs = 5
+    config.system_mem_limit_perc = 70.0
+    listener = Listener(config, Mock())
+    running, finished = Mock(), Mock()
+    running.poll.return_value = None
+    finished.poll.return_value = 0
+    listener.procList = [running, finished]
+    listener.instrument_jobs = {"EQSANS": [running, finished], "CNCS": [finished]}
+    listener.update_processes()
+
+    load = listener.load_info()
+    assert load["jobs_running"] == 1
+    assert load["jobs_waiting"] == 0
+    assert load["jobs_per_instrument"] == {"EQSANS": 1}
+    assert load["free_slots"] == 4
+    assert load["jobs_finished"] == 1
+    assert len(load["load_average"]) == 3
+    assert load["memory_available_mb"] >= load["memory_headroom_mb"] >= 0
+    json.dumps(load)
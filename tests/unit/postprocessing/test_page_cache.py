@@ -0,0 +1,45 @@
+import os
+import threading
+from unittest.mock import Mock, patch
+
+import pytest
+
+from postprocessing import page_cache
+from postprocessing.page_cache import PageCacheWarmer, prewarm
+
+
+@pytest.fixture
+def data_file(tmp_path):
+    path = tmp_path / "EQSANS_1.nxs.h5"
+    path.write_bytes(bytes(1000))
+    return path.as_posix()
+
+
+@pytest.mark.skipif(not hasattr(os, "posix_fadvise"), reason="posix_fadvise not available")
+def test_prewarm(data_file, monkeypatch):
+    monkeypatch.setattr(page_cache, "PREWARM_BLOCK_SIZE", 300)
+    with patch.object(page_cache.os, "posix_fadvise") as mock_fadvise:
+        assert prewarm(data_file, 10000) == 1000
+    assert [call[0][1:] for call in mock_fadvise.call_args_list] == [
+        (0, 300, os.POSIX_FADV_WILLNEED),
+        (300, 300, os.POSIX_FADV_WILLNEED),
+        (600, 300, os.POSIX_FADV_WILLNEED),
+        (900, 100, os.POSIX_FADV_WILLNEED),
+    ]
+    # within the bytes per file
+    assert prewarm(data_file, 500) == 500
+    # cancelled
+    cancel = threading.Event()
+    cancel.set()
+    assert prewarm(data_file, 10000, cancel=cancel) == 0
+
+
+@pytest.mark.skipif(not hasattr(os, "posix_fadvise"), reason="posix_fadvise not available")
+def test_memory_pressure(data_file):
+    warmer = PageCacheWarmer(10000, memory_fraction=0.5)
+    future, _ = warmer.submit(data_file)
+    assert future.result() == 1000
+    # skipped when the file does not fit in the memory available
+    with patch.object(page_cache.psutil, "virtual_memory", return_value=Mock(available=1500)):
+        future, _ = warmer.submit(data_file)
+        assert future.result() == 0
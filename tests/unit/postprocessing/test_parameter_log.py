@@ -0,0 +1,90 @@
+# package imports
+from postprocessing.parameter_log import INDEX_RECORD, ParameterLog
+
+# third-party imports
+import pytest
+
+# standard imports
+import multiprocessing
+import os
+
+
+@pytest.fixture
+def parameter_log(tmp_path):
+    return ParameterLog(str(tmp_path / "reduction_parameters.jsonl"))
+
+
+def test_parameters_at(parameter_log):
+    assert parameter_log.parameters_at(100.0) is None
+    parameter_log.append({"mask": "a\nb", "e_min": -0.95}, timestamp=10.0, instrument="CNCS")
+    parameter_log.append({"mask": "c"}, timestamp=20.0, instrument="CNCS")
+    parameter_log.append({"mask": "d"}, timestamp=30.0, instrument="CNCS")
+
+    assert parameter_log.parameters_at(5.0) is None
+    assert parameter_log.parameters_at(10.0) == {"mask": "a\nb", "e_min": -0.95}
+    assert parameter_log.parameters_at(29.9) == {"mask": "c"}
+    assert parameter_log.entry_at(1000.0) == {"time": 30.0, "instrument": "CNCS", "parameters": {"mask": "d"}}
+    assert [entry["time"] for entry in parameter_log.entries()] == [10.0, 20.0, 30.0]
+
+
+def test_times_never_decrease(parameter_log):
+    parameter_log.append({"mask": "a"}, timestamp=20.0)
+    # an agent with a late clock
+    entry = parameter_log.append({"mask": "b"}, timestamp=10.0)
+    assert entry["time"] == 20.0
+    assert parameter_log.parameters_at(20.0) == {"mask": "b"}
+
+
+def test_index_recovery(parameter_log):
+    for i in range(5):
+        parameter_log.append({"run": i}, timestamp=float(i))
+    # a writer killed between writing the entry and its index record, or in the middle of a record
+    with open(parameter_log.index_file, "r+b") as index:
+        index.truncate(3 * INDEX_RECORD.size + 5)
+    parameter_log.append({"run": 5}, timestamp=5.0)
+    assert os.path.getsize(parameter_log.index_file) == 6 * INDEX_RECORD.size
+    assert [parameter_log.parameters_at(float(i)) for i in range(6)] == [{"run": i} for i in range(6)]
+
+    # a missing index is rebuilt
+    os.remove(parameter_log.index_file)
+    assert parameter_log.parameters_at(2.5) == {"run": 2}
+
+
+def test_torn_entry(parameter_log):
+    parameter_log.append({"run": 0}, timestamp=0.0)
+    # a writer killed in the middle of an entry
+    with open(parameter_log.log_file, "ab") as log:
+        log.write(b'{"parameters": {"run": ')
+    parameter_log.append({"run": 1}, timestamp=1.0)
+    parameter_log.append({"run": 2}, timestamp=2.0)
+    assert [entry["parameters"] for entry in parameter_log.entries()] == [{"run": i} for i in range(3)]
+    assert [parameter_log.parameters_at(float(i)) for i in range(3)] == [{"run": i} for i in range(3)]
+    os.remove(parameter_log.index_file)
+    assert parameter_log.parameters_at(1.5) == {"run": 1}
+
+
+def _append_entries(log_file, worker):
+    log = ParameterLog(log_file)
+    for i in range(50):
+        log.append({"worker": worker, "i": i, "padding": "x" * 5000})
+
+
+def test_concurrent_appends(parameter_log):
+    workers = [
+        multiprocessing.Process(target=_append_entries, args=(parameter_log.log_file, worker)) for worker in range(4)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    entries = list(parameter_log.entries())
+    assert len(entries) == 200
+    assert os.path.getsize(parameter_log.index_file) == 200 * INDEX_RECORD.size
+    times = [entry["time"] for entry in entries]
+    assert times == sorted(times)
+    assert parameter_log.entry_at(times[-1]) == entries[-1]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,47 @@
+from postprocessing.pressure import PressureGate, read_pressure
+
+
+def write_pressure(pressure_dir, resource, some, full=0.0):
+    (pressure_dir / resource).write_text(
+        f"some avg10={some:.2f} avg60=0.00 avg300=0.00 total=100\n"
+        f"full avg10={full:.2f} avg60=0.00 avg300=0.00 total=0\n"
+    )
+
+
+def test_read_pressure(tmp_path):
+    write_pressure(tmp_path, "memory", 12.5, 3.0)
+    pressure = read_pressure("memory", tmp_path.as_posix())
+    assert pressure["some"] == {"avg10": 12.5, "avg60": 0.0, "avg300": 0.0, "total": 100.0}
+    assert pressure["full"]["avg10"] == 3.0
+
+
+def test_pressure_gate(tmp_path):
+    thresholds = {"cpu": 80.0, "memory.full": 10.0}
+    write_pressure(tmp_path, "cpu", 30.0)
+    write_pressure(tmp_path, "memory", 90.0, 5.0)
+    gate = PressureGate(tmp_path.as_posix(), check_interval=0)
+    assert not gate.is_closed(thresholds, 0.5)
+    assert gate.averages == {"cpu": 30.0, "memory.full": 5.0}
+
+    write_pressure(tmp_path, "memory", 90.0, 20.0)
+    assert gate.is_closed(thresholds, 0.5)
+    # below the threshold, but not enough to open again
+    write_pressure(tmp_path, "memory", 90.0, 8.0)
+    assert gate.is_closed(thresholds, 0.5)
+    write_pressure(tmp_path, "memory", 90.0, 4.0)
+    assert not gate.is_closed(thresholds, 0.5)
+
+
+def test_pressure_gate_interval(tmp_path):
+    write_pressure(tmp_path, "io", 50.0)
+    gate = PressureGate(tmp_path.as_posix(), check_interval=60)
+    assert gate.is_closed({"io": 30.0})
+    # not read again before the interval
+    write_pressure(tmp_path, "io", 0.0)
+    assert gate.is_closed({"io": 30.0})
+
+
+def test_pressure_unavailable(tmp_path):
+    gate = PressureGate((tmp_path / "missing").as_posix(), check_interval=0)
+    assert not gate.is_closed({"cpu": 0.0})
+    assert gate.averages == {}
@@ -1,5 +1,6 @@
 # package imports
-from postprocessing.reduction_script_writer import ScriptWriter
+from postprocessing import reduction_script_writer
+from postprocessing.reduction_script_writer import ScriptWriter, load_template
 
 # third-party imports
 import pytest
@@ -11,6 +12,7 @@ import filecmp
 import os
 import shutil
 import tempfile
+import time
 
 
 @pytest.fixture(scope="module")  # 'yield_fixture' deprecated in favor of 'yield' when using python 3.x
@@ -125,6 +127,33 @@ class TestScriptWriter:
             writer_local.write_script(**arguments)
         assert "\"Template arguments missing: ['do_tib']\"" == str(exception_info.value)
 
+    def test_load_template_cache(self, tmp_path, mocker):
+        template_path = tmp_path / "reduce_TEST.py.template"
+        template_path.write_text("print($first, ${second})\nprice = '$$5'\n")
+        template, identifiers = load_template(str(template_path))
+        assert identifiers == {"first", "second"}
+        # an unchanged template is not read again
+        mock_open = mocker.patch("postprocessing.reduction_script_writer.open", side_effect=AssertionError)
+        assert load_template(str(template_path)) == (template, identifiers)
+        mocker.stop(mock_open)
+        # a modified template is
+        template_path.write_text("print($third)\n")
+        os.utime(template_path, ns=(0, 0))
+        _, identifiers = load_template(str(template_path))
+        assert identifiers == {"third"}
+        del reduction_script_writer._template_cache[str(template_path)]
+
+    def test_write_script_atomic(self, writer_local):
+        script_path = os.path.join(writer_local.autoreduction_dir, writer_local.script_name)
+        writer_local.write_script(**self.arguments)
+        os.chmod(script_path, 0o640)
+        writer_local.write_script(**self.arguments)
+        # the script is replaced in place, keeping its permissions and leaving no temporary file behind
+        assert os.stat(script_path).st_mode & 0o777 == 0o640
+        assert sorted(os.listdir(writer_local.autoreduction_dir)) == sorted(
+            [writer_local.template_name, writer_local.script_name]
+        )
+
     def test_process_request(self, data_server, writer_local):
         # mock the inputs for a successful call to ScriptWriter.process_request
         request_data = {"instrument": "CNCS"}
@@ -146,6 +175,7 @@ class TestScriptWriter:
         writer_local.process_request(request_data, configuration, send_function)
         assert "Created CNCS reduction script" in open(amq_data_file, "r").read()
         assert os.path.isfile(writer_local.log_file)
+        assert writer_local.parameters_at(time.time())["grouping"] == "8x2"
 
         # report error when using the default script
         request_data["use_default"] = True
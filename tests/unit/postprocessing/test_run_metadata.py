@@ -0,0 +1,63 @@
+# package imports
+from postprocessing.run_metadata import RunMetadata, RunMetadataCache, read_header
+
+# third-party imports
+import h5py
+import pytest
+
+# standard imports
+import os
+
+
+def write_nexus_file(filepath, duration=42.0):
+    with h5py.File(filepath, "w") as handle:
+        entry = handle.create_group("entry")
+        entry.create_dataset("start_time", data=["2023-08-16T13:30:00.123456-04:00"])
+        entry.create_dataset("end_time", data=["2023-08-16T13:31:00.654321-04:00"])
+        entry.create_dataset("duration", (1,), data=[duration])
+        # a large dataset that must not be read
+        entry.create_dataset("bank1_events", data=range(100000), chunks=(1000,))
+
+
+def test_read_header(tmp_path):
+    filepath = tmp_path / "PG3_56301.nxs.h5"
+    write_nexus_file(filepath)
+    assert read_header(str(filepath)) == RunMetadata(
+        "2023-08-16T13:30:00.123456-04:00", "2023-08-16T13:31:00.654321-04:00", 42.0
+    )
+
+
+def test_cache(tmp_path, mocker):
+    filepath = tmp_path / "PG3_56301.nxs.h5"
+    write_nexus_file(filepath)
+    cache_dir = tmp_path / "cache"
+
+    cache = RunMetadataCache(str(cache_dir))
+    assert cache.get(filepath).duration == 42.0
+    assert len(os.listdir(cache_dir)) == 1
+
+    # other processes find the metadata in the shared directory without opening the file
+    mock_read_header = mocker.patch("postprocessing.run_metadata.read_header", side_effect=AssertionError)
+    assert RunMetadataCache(str(cache_dir)).get(filepath).duration == 42.0
+    assert cache.get(filepath).duration == 42.0
+    mocker.stop(mock_read_header)
+
+    # a modified file is read again
+    write_nexus_file(filepath, duration=21.0)
+    os.utime(filepath, ns=(0, 0))
+    assert cache.get(filepath).duration == 21.0
+    assert RunMetadataCache(str(cache_dir)).get(filepath).duration == 21.0
+
+
+def test_cache_in_memory(tmp_path, mocker):
+    filepath = tmp_path / "PG3_56301.nxs.h5"
+    write_nexus_file(filepath)
+    cache = RunMetadataCache()
+    assert cache.get(filepath).start_time == "2023-08-16T13:30:00.123456-04:00"
+    mocker.patch("postprocessing.run_metadata.read_header", side_effect=AssertionError)
+    assert cache.get(filepath).start_time == "2023-08-16T13:30:00.123456-04:00"
+    assert not os.path.exists(tmp_path / "cache")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,81 @@
+import os
+import time
+
+import pytest
+
+from postprocessing import scratch
+from postprocessing.scratch import ScratchStager
+
+
+@pytest.fixture
+def shared(tmp_path):
+    """Data files of 1 kB on the shared filesystem"""
+    directory = tmp_path / "shared"
+    directory.mkdir()
+    for run in range(3):
+        (directory / f"EQSANS_{run}.nxs.h5").write_bytes(bytes(1000))
+    return directory
+
+
+def test_stage(shared, tmp_path):
+    stager = ScratchStager((tmp_path / "scratch").as_posix(), 10000)
+    source = (shared / "EQSANS_0.nxs.h5").as_posix()
+    copy = stager.stage(source)
+    copy.result()
+    local = stager.acquire(copy)
+    assert local == stager.local_path(source)
+    assert os.path.basename(local) == "EQSANS_0.nxs.h5"
+    assert open(local, "rb").read() == bytes(1000)
+    assert stager.in_use[local] == 1
+    stager.release(local)
+    assert local not in stager.in_use
+    # a complete copy is used again
+    assert stager.stage(source).done()
+
+
+def test_stale(shared, tmp_path):
+    stager = ScratchStager((tmp_path / "scratch").as_posix(), 10000)
+    source = shared / "EQSANS_0.nxs.h5"
+    local = stager.stage(source.as_posix()).result()
+    assert os.stat(local).st_mtime_ns == source.stat().st_mtime_ns
+    stager.acquire(stager.stage(source.as_posix()))
+    assert os.stat(local).st_mtime_ns == source.stat().st_mtime_ns
+
+    # the shared file is written again with the same size: the copy is made again
+    source.write_bytes(bytes([1]) * 1000)
+    os.utime(source, ns=(0, source.stat().st_mtime_ns + 1))
+    copy = stager.stage(source.as_posix())
+    assert copy.result() == local
+    assert open(local, "rb").read() == bytes([1]) * 1000
+
+
+def test_eviction(shared, tmp_path):
+    stager = ScratchStager((tmp_path / "scratch").as_posix(), 2500)
+    sources = [(shared / f"EQSANS_{run}.nxs.h5").as_posix() for run in range(3)]
+    locals_ = [stager.stage(source).result() for source in sources[:2]]
+    # last used at access times 0 and 1
+    for last_use, local in enumerate(locals_):
+        os.utime(local, ns=(last_use, os.stat(local).st_mtime_ns))
+    # the least recently used copy makes room for the new one
+    stager.stage(sources[2]).result()
+    assert not os.path.exists(locals_[0]) and os.path.exists(locals_[1])
+
+    # the copies in use are kept
+    in_use = stager.acquire(stager.stage(sources[1]))
+    stager.acquire(stager.stage(sources[2]))
+    with pytest.raises(OSError):
+        stager.stage(sources[0]).result()
+    assert os.path.exists(in_use)
+
+
+def test_abandoned(shared, tmp_path, monkeypatch):
+    monkeypatch.setattr(scratch, "COPY_BLOCK_SIZE", 100)
+    stager = ScratchStager((tmp_path / "scratch").as_posix(), 10000, bandwidth_bytes=1000)
+    source = (shared / "EQSANS_0.nxs.h5").as_posix()
+    copy = stager.stage(source)
+    time.sleep(0.1)
+    # the job starts before the end of the copy: it reads the shared file
+    assert stager.acquire(copy) is None
+    with pytest.raises(scratch.StagingCancelled):
+        copy.result()
+    assert stager.usage() == []
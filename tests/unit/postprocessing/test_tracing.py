@@ -0,0 +1,70 @@
+import json
+from unittest.mock import Mock
+
+from postprocessing.processors.base_processor import BaseProcessor
+from postprocessing.tracing import NULL_TRACER, Tracer
+
+
+def test_tracer():
+    tracer = Tracer(enabled=True)
+    with tracer.span("reduction", script="reduce_EQSANS.py"):
+        with tracer.span("spawn"):
+            pass
+        with tracer.span("supervise"):
+            pass
+    with tracer.span("send"):
+        pass
+    with tracer.span("send"):
+        pass
+    summary = tracer.summary()
+    assert sorted(summary) == ["reduction", "reduction/spawn", "reduction/supervise", "send"]
+    assert summary["reduction"] >= summary["reduction/spawn"] + summary["reduction/supervise"]
+    assert len(tracer.spans) == 5
+
+
+def test_tracer_disabled():
+    with NULL_TRACER.span("reduction"):
+        pass
+    assert NULL_TRACER.spans == []
+    assert NULL_TRACER.summary() == {}
+
+
+def test_tracer_write(tmp_path):
+    tracer = Tracer(enabled=True)
+    with tracer.span("reduction", script="reduce_EQSANS.py"):
+        with tracer.span("spawn"):
+            pass
+    trace_file = tmp_path / "trace.json"
+    tracer.write(str(trace_file))
+    events = json.loads(trace_file.read_text())["traceEvents"]
+    assert [event["name"] for event in events] == ["spawn", "reduction"]
+    assert events[0]["args"] == {"path": "reduction/spawn"}
+    assert events[1]["args"] == {"path": "reduction", "script": "reduce_EQSANS.py"}
+    assert all(event["ph"] == "X" and event["dur"] >= 0 for event in events)
+
+
+def test_processor_timing(tmp_path):
+    data_file = tmp_path / "EQSANS_30892_event.nxs"
+    data_file.write_text("")
+    data = {
+        "run_number": "30892",
+        "instrument": "EQSANS",
+        "ipts": "IPTS-10674",
+        "facility": "SNS",
+        "data_file": str(data_file),
+    }
+    conf = Mock()
+    conf.tracing_enabled = True
+    conf.trace_dir = str(tmp_path / "traces")
+    send_function = Mock()
+    processor = BaseProcessor(data, conf, send_function)
+
+    processor.send("/queue/REDUCTION.STARTED", json.dumps(data))
+    processor.send("/queue/REDUCTION.COMPLETE", json.dumps(data))
+    started = json.loads(send_function.call_args_list[0][0][1])
+    complete = json.loads(send_function.call_args_list[1][0][1])
+    assert "timing" not in started
+    assert sorted(complete["timing"]) == ["open_data_file", "send"]
+
+    processor.write_trace()
+    assert len(list((tmp_path / "traces").glob("EQSANS_30892_BaseProcessor_*.trace.json"))) == 1
@@ -75,9 +75,51 @@ def test_getPropDir(nexus_file):
     assert prop_dir_test == prop_dir_correct
 
 
-@pytest.mark.skip("not yet implemented")
-def test_getRuns():
-    pass
+def test_startingWith():
+    names = sorted(["PG3_1.log", "PG3_12.log", "PG3_2.log", "PG3_1.err", "REF_L_1.log"])
+    assert startingWith(names, "PG3_1") == ["PG3_1.err", "PG3_1.log", "PG3_12.log"]
+    assert startingWith(names, "PG3_3") == []
+    assert startingWith([], "PG3_1") == []
+
+
+def write_nexus_file(filepath, duration=42.0):
+    with h5py.File(filepath, "w") as handle:
+        entry = handle.create_group("entry")
+        entry.create_dataset("start_time", data=["2023-08-16T13:30:00"])
+        entry.create_dataset("end_time", data=["2023-08-16T13:31:00"])
+        entry.create_dataset("duration", (1,), data=[duration])
+
+
+@pytest.fixture(scope="function")
+def proposal_dir(tmp_path):
+    propdir = tmp_path / "SNS" / "PG3" / "IPTS-1234"
+    nexusdir = propdir / "nexus"
+    nexusdir.mkdir(parents=True)
+    for run in range(56300, 56305):
+        write_nexus_file(nexusdir / f"PG3_{run}.nxs.h5")
+    logdir = propdir / "shared" / "autoreduce" / REDUCTION_LOG
+    logdir.mkdir(parents=True)
+    shutil.copyfile(INPUT_LOGFILE, logdir / "PG3_56301.nxs.h5.log")
+    (propdir / "shared" / "autoreduce" / "PG3_56301.gsa").write_text("reduced")
+    return propdir
+
+
+def test_getRuns(proposal_dir):
+    runs = getRuns(str(proposal_dir))
+    assert [str(run) for run in runs] == [f"PG3_{run}" for run in range(56300, 56305)]
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_main_proposal(proposal_dir, output_dir, jobs):
+    main(str(proposal_dir), output_dir, jobs=jobs)
+    with open(os.path.join(output_dir, "PG3-IPTS-1234.csv")) as handle:
+        lines = [line.strip().split(",") for line in handle]
+    assert lines[0] == list(ARstatus.header())
+    assert [line[0] for line in lines[1:]] == [f"PG3_{run}" for run in range(56300, 56305)]
+    reduced = {line[0]: line for line in lines[1:] if line[7] != "0"}
+    assert list(reduced) == ["PG3_56301"]
+    assert reduced["PG3_56301"][6] == "autoreducer3.sns.gov"
+    assert reduced["PG3_56301"][8] == "6.7.0"
 
 
 @pytest.mark.skip("not yet implemented")
@@ -151,6 +193,19 @@ def test_ReductionLogFile():
     duration = 4.62 + 0.74 + 0.42 + 2.99 + 23.42 + 1.07 + 7.41 + 5.08 + 3.83
     assert reduction_log_file.loadDurationTotal == pytest.approx(duration), "loadDurationTotal"
     assert reduction_log_file.loadEventNexusDuration == pytest.approx(4.62 + 0.74), "loadEventNexusDuration"
+    assert reduction_log_file.prewarmedMiB == 0.0
+
+
+def test_ReductionLogFile_prewarmed(tmp_path):
+    logfile = tmp_path / "TEST_123.nxs.h5.log"
+    logfile.write_text(
+        "LoadEventNexus-[Notice] LoadEventNexus successful, Duration 1.20 seconds\n"
+        "PageCache-[Notice] Prewarmed 512.5 MiB of TEST_123.nxs.h5\n"
+    )
+    reduction_log_file = ReductionLogFile(str(logfile), "TEST_123")
+    assert reduction_log_file.prewarmedMiB == pytest.approx(512.5)
+    # not a load
+    assert reduction_log_file.loadDurationTotal == pytest.approx(1.2)
 
 
 def check_bad_ReductionLogFile_values(
@@ -367,3 +422,35 @@ def test_ARstatus_properties():
         assert len(ar_status.reduxfiles) == 2
         assert ar_status.loadDurationTotal > 0.0
         assert ar_status.loadEventNexusDuration >= 0.0
+
+
+def test_main_incremental(proposal_dir, output_dir, mocker):
+    import ar_report
+
+    csvfile = os.path.join(output_dir, "PG3-IPTS-1234.csv")
+    spy = mocker.patch("ar_report.reportRun", wraps=ar_report.reportRun)
+
+    main(str(proposal_dir), output_dir, jobs=1, incremental=True)
+    assert spy.call_count == 5
+    with open(csvfile) as handle:
+        first = handle.read()
+    assert os.path.isfile(os.path.join(output_dir, "PG3-IPTS-1234.cache.json"))
+
+    # nothing changed: nothing is processed again and the csv is the same
+    spy.reset_mock()
+    main(str(proposal_dir), output_dir, jobs=1, incremental=True)
+    assert spy.call_count == 0
+    with open(csvfile) as handle:
+        assert handle.read() == first
+
+    # a new reduction log and a new run
+    logdir = proposal_dir / "shared" / "autoreduce" / REDUCTION_LOG
+    shutil.copyfile(INPUT_LOGFILE, logdir / "PG3_56303.nxs.h5.log")
+    write_nexus_file(proposal_dir / "nexus" / "PG3_56305.nxs.h5")
+    spy.reset_mock()
+    main(str(proposal_dir), output_dir, jobs=1, incremental=True)
+    assert sorted(call.args[2] for call in spy.call_args_list) == ["PG3_56303.nxs.h5", "PG3_56305.nxs.h5"]
+    with open(csvfile) as handle:
+        lines = [line.strip().split(",") for line in handle][1:]
+    assert [line[0] for line in lines] == [f"PG3_{run}" for run in range(56300, 56306)]
+    assert [line[8] for line in lines if line[8] != "UNKNOWN"] == ["6.7.0", "6.7.0"]
@@ -0,0 +1,81 @@
+import threading
+
+import pytest
+import stomp
+
+from scripts.benchmark import FakeBroker, encode_frame, main, parse_frames, parse_mix, percentiles
+
+
+def test_parse_frames():
+    data = b"\n" + encode_frame("SEND", {"destination": "/queue/A", "note": "a:b\nc"}, b"x\0y") + b"\r\n"
+    data += b"MESSAGE\r\ndestination:/queue/B\r\n\r\nbody\0"
+    frames, rest = parse_frames(data + b"SEND\ndestination:/queue/C\n\npartial")
+    assert frames == [
+        ("SEND", {"destination": "/queue/A", "note": "a:b\nc", "content-length": "3"}, b"x\0y"),
+        ("MESSAGE", {"destination": "/queue/B"}, b"body"),
+    ]
+    assert rest == b"SEND\ndestination:/queue/C\n\npartial"
+
+
+def test_parse_mix():
+    assert parse_mix("REDUCTION.DATA_READY=3,/queue/CATALOG.ONCAT.DATA_READY") == {
+        "REDUCTION.DATA_READY": 3.0,
+        "CATALOG.ONCAT.DATA_READY": 1.0,
+    }
+    with pytest.raises(ValueError):
+        parse_mix("UNKNOWN.DATA_READY=1")
+
+
+def test_percentiles():
+    summary = percentiles([float(i) for i in range(1, 101)])
+    assert (summary["p50"], summary["p90"], summary["p99"], summary["max"]) == (50.0, 90.0, 99.0, 100.0)
+    assert percentiles([]) == {}
+
+
+class Collector(stomp.ConnectionListener):
+    def __init__(self, conn, reject_first=False):
+        self.conn = conn
+        self.reject_first = reject_first
+        self.bodies = []
+        self.event = threading.Event()
+
+    def on_message(self, frame):
+        if self.reject_first:
+            self.reject_first = False
+            self.conn.nack(frame.headers["message-id"], frame.headers["subscription"])
+            return
+        self.bodies.append(frame.body)
+        self.conn.ack(frame.headers["message-id"], frame.headers["subscription"])
+        if len(self.bodies) == 2:
+            self.event.set()
+
+
+def test_fake_broker():
+    broker = FakeBroker(redelivery_delay=0.1)
+    broker.start()
+    sent = []
+    broker.add_listener(lambda destination, body: sent.append(destination))
+    conn = stomp.Connection(host_and_ports=[broker.address])
+    collector = Collector(conn, reject_first=True)
+    conn.set_listener("test", collector)
+    try:
+        conn.connect("user", "password", wait=True)
+        conn.subscribe(destination="/queue/A", id="A", ack="client", headers={"activemq.prefetchSize": 0})
+        conn.send("A", b"first")
+        conn.send("/queue/A", b"second")
+        assert collector.event.wait(5)
+        # the rejected message is delivered again, after the next one
+        assert collector.bodies == ["second", "first"]
+        assert sent == ["/queue/A", "/queue/A"]
+        conn.disconnect()
+    finally:
+        broker.stop()
+
+
+def test_benchmark(tmp_path, capsys):
+    output = tmp_path / "report.json"
+    args = ["--messages", "4", "--instruments", "2", "--reduction-duration", "0", "--timeout", "60"]
+    args += ["--mix", "REDUCTION.DATA_READY=1,CALVERA.RAW.DATA_READY=1", "--workdir", str(tmp_path / "work")]
+    assert main(args + ["--output", str(output)]) == 0
+    assert "Messages: 4 answered: 4 missing: 0 outcomes: {'COMPLETE': 4}" in capsys.readouterr().out
+    assert output.exists()